@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Asynchronous successive halving (ASHA) for sweep jobs run by run.py.
+
+The scheduler runs next to run.py and watches the validation metric of every
+job in jobs/queue and jobs/done (metrics.jsonl or TF event files in the
+'# [LOGDIR]' of the job script). Rungs are
+placed at r_min * eta^k training steps. When a job reaches a rung, its metric is
+recorded and compared with all the records at that rung. If it is not in the
+best 1/eta, a STOP file is written to its log directory, and the trainer exits
+cleanly after its next validation. The surviving jobs continue training (they
+are promoted to the next rung), so the same compute budget explores many more
+configurations.
+
+    python asha_scheduler.py --jobdir=jobs --r_min=5000 --eta=3 --max_itr=50000
+
+Note that trainers started with --clear_logs restart from scratch when the job is re-run,
+so a stopped job cannot be resumed by moving it back to todo.
+"""
+from __future__ import print_function
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+
+from sweep_planner import read_job_header
+
+STOP_FILE = 'STOP' # same as xxx_train.py
+
+class MetricReader(object):
+    """Read the validation metric from log_dir/metrics.jsonl, or from TF event files for older runs"""
+    def __init__(self, tag):
+        self.tag = tag
+        self.event_reader = EventMetricReader(tag)
+
+    def read(self, log_dir):
+        from utils.metrics_utils import METRICS_FILE, read_metric_history
+        if os.path.exists(os.path.join(log_dir, METRICS_FILE)):
+            return read_metric_history(log_dir, self.tag, phase='valid')
+        return self.event_reader.read(log_dir)
+
+class EventMetricReader(object):
+    """Read scalar summaries of log_dir/valid/events.out.tfevents.* (parsed files are cached by size)"""
+    def __init__(self, tag):
+        self.tag = tag
+        self.cache = {} # event file -> (size, [(step, value)])
+
+    def read(self, log_dir):
+        import tensorflow as tf
+        history = []
+        for event_file in sorted(glob.glob(os.path.join(log_dir, 'valid', 'events.out.tfevents.*'))):
+            size = os.path.getsize(event_file)
+            cached = self.cache.get(event_file)
+            if cached is None or cached[0] != size:
+                values = []
+                try:
+                    for event in tf.train.summary_iterator(event_file):
+                        for v in event.summary.value:
+                            if v.tag == self.tag:
+                                values.append((event.step, v.simple_value))
+                except Exception as e: # file is being written
+                    print('[Warning] fail to read {} ({})'.format(event_file, e))
+                cached = (size, values)
+                self.cache[event_file] = cached
+            history.extend(cached[1])
+        history.sort()
+        return history
+
+class ASHAScheduler(object):
+    def __init__(self, r_min, eta, max_itr, mode='min', min_samples=None):
+        self.eta = eta
+        self.mode = mode
+        self.min_samples = min_samples if min_samples is not None else eta
+        self.rungs = []
+        r = r_min
+        while r < max_itr:
+            self.rungs.append(int(r))
+            r *= eta
+        self.records = {str(r): {} for r in self.rungs} # rung -> {job: metric}
+        self.stopped = {} # job -> rung
+
+    def load(self, filename):
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                state = json.load(f)
+            for rung, records in state['records'].items():
+                self.records.setdefault(rung, {}).update(records)
+            self.stopped.update(state['stopped'])
+
+    def save(self, filename):
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump({'rungs': self.rungs, 'records': self.records, 'stopped': self.stopped}, f, indent=2)
+        os.rename(tmp_filename, filename)
+
+    def is_promising(self, value, records):
+        # True if value is in the best 1/eta of records
+        values = sorted(records.values(), reverse=(self.mode == 'max'))
+        num_keep = max(1, len(values) // self.eta)
+        cutoff = values[num_keep-1]
+        return value <= cutoff if self.mode == 'min' else value >= cutoff
+
+    def update(self, job, history):
+        """Record rung metrics of a job from its (step, value) history.
+
+        Return: the rung at which the job should stop, or None
+        """
+        if job in self.stopped:
+            return None
+        for rung in self.rungs:
+            # the latest evaluation not beyond the rung
+            values = [value for step, value in history if step <= rung]
+            reached = any(step >= rung for step, _ in history)
+            if not reached or len(values) == 0:
+                break
+            records = self.records[str(rung)]
+            if job in records:
+                continue
+            records[job] = values[-1]
+            if len(records) >= self.min_samples and not self.is_promising(values[-1], records):
+                self.stopped[job] = rung
+                return rung
+        return None
+
+def schedule_once(config, scheduler, reader):
+    for state in ['queue', 'done']:
+        for job_file in glob.glob(os.path.join(config.jobdir, state, '*.sh')):
+            job = os.path.basename(job_file)
+            log_dir = read_job_header(job_file).get('LOGDIR')
+            if log_dir is None or not os.path.isdir(log_dir):
+                continue
+            history = reader.read(log_dir)
+            stop_rung = scheduler.update(job, history)
+            if stop_rung is not None and state == 'queue':
+                print('[{}] stop {} at rung {} ({}={:g}) {}'.format(
+                        time.asctime(), job, stop_rung, config.metric,
+                        scheduler.records[str(stop_rung)][job], log_dir))
+                with open(os.path.join(log_dir, STOP_FILE), 'w') as f:
+                    f.write('{} {}\n'.format(stop_rung, scheduler.records[str(stop_rung)][job]))
+
+def print_rungs(scheduler):
+    for rung in scheduler.rungs:
+        records = scheduler.records[str(rung)]
+        num_stopped = sum([1 for r in scheduler.stopped.values() if r == rung])
+        print('rung {:>7d}: #records={} #stopped={}'.format(rung, len(records), num_stopped))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--jobdir', type=str, default='jobs',
+                            help='where to place the jobs')
+    parser.add_argument('--metric', type=str, default='loss_ev',
+                            help='validation metric written by the trainers')
+    parser.add_argument('--mode', type=str, default='min',
+                            help='min|max, whether smaller metric is better')
+    parser.add_argument('--r_min', type=int, default=5000,
+                            help='training steps of the first rung')
+    parser.add_argument('--eta', type=int, default=3,
+                            help='reduction factor, only the best 1/eta continue at each rung')
+    parser.add_argument('--max_itr', type=int, default=50000,
+                            help='max_itr of the trainers')
+    parser.add_argument('--interval', type=float, default=60,
+                            help='seconds between checks')
+    parser.add_argument('--once', action='store_const',
+                            const=True, default=False,
+                            help='check once and quit')
+    config, unparsed = parser.parse_known_args()
+    if len(unparsed) > 0:
+        print('[Error] unparsed args: {}'.format(unparsed))
+        exit(1)
+
+    state_file = os.path.join(config.jobdir, 'asha_{}.json'.format(config.metric))
+    scheduler = ASHAScheduler(config.r_min, config.eta, config.max_itr, config.mode)
+    scheduler.load(state_file)
+    reader = MetricReader(config.metric)
+    print('rungs = {}'.format(scheduler.rungs))
+
+    stop_file = '{}_stop'.format(os.uname()[1])
+    while True:
+        schedule_once(config, scheduler, reader)
+        scheduler.save(state_file)
+        if config.once:
+            print_rungs(scheduler)
+            break
+        if os.path.exists(stop_file):
+            print('Detect {} and scheduler is finished'.format(stop_file))
+            break
+        time.sleep(config.interval)
@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Loader-only throughput benchmark of the input pipelines in datasets.py.
+
+Only the dataset iterator is run (no network), so the reported examples/sec
+is the upper bound the input pipeline can feed to training.
+
+    python benchmark_datasets.py --dataset=cfcf --tuned_pipeline=True --num_threads=8
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+
+LOCAL_PATH = './'
+if LOCAL_PATH not in sys.path:
+    sys.path.append(LOCAL_PATH)
+
+from datasets import SiameseVIDDataset, CFVIDDataset, ImageNet
+from utils.runtime_utils import setup_runtime, get_session_config, apply_dataset_threading, add_runtime_arguments
+
+def build_dataset(config):
+    if config.dataset == 'siamese':
+        provider = SiameseVIDDataset(template_image_size=127, query_image_size=255,
+                            max_seq_length=config.max_length, num_threads=config.num_threads)
+        dataset = provider.get_dataset(config.vid_dir, phase=config.phase, batch_size=config.batch_size,
+                            shuffle=True, tuned=config.tuned_pipeline)
+    elif config.dataset == 'cfcf':
+        provider = CFVIDDataset(template_image_size=255, query_image_size=255,
+                            max_seq_length=config.max_length, num_threads=config.num_threads)
+        dataset = provider.get_dataset(config.vid_dir, phase=config.phase, batch_size=config.batch_size,
+                            shuffle=True, tuned=config.tuned_pipeline)
+    elif config.dataset == 'imagenet':
+        provider = ImageNet(num_threads=config.num_threads)
+        dataset = provider.get_dataset(config.imagenet_dir, phase=config.phase, batch_size=config.batch_size,
+                            is_training=True, shuffle=True, tuned=config.tuned_pipeline)
+    else:
+        raise ValueError('Unknown dataset: {}'.format(config.dataset))
+    dataset = apply_dataset_threading(dataset, config.dataset_private_threads)
+    return dataset
+
+def main(config):
+    tf.reset_default_graph()
+    setup_runtime(config, num_input_threads=config.dataset_private_threads or config.num_threads)
+
+    start_time = time.time()
+    dataset = build_dataset(config)
+    next_batch = dataset.make_one_shot_iterator().get_next()
+    # run the batch without copying the tensors to python
+    if not isinstance(next_batch, (tuple, list)):
+        next_batch = [next_batch]
+    batch_op = tf.group(*next_batch)
+    print('Setup dataset ({:.1f} sec)'.format(time.time()-start_time))
+
+    sess = tf.Session(config=get_session_config(config))
+
+    for _ in range(config.num_warmup):
+        sess.run(batch_op)
+
+    elapsed = []
+    for _ in range(config.num_iter):
+        step_start = time.time()
+        sess.run(batch_op)
+        elapsed.append(time.time()-step_start)
+    elapsed = np.array(elapsed)
+
+    total = np.sum(elapsed)
+    print('===== {} (tuned={}) batch_size={} num_threads={} ====='.format(
+            config.dataset, config.tuned_pipeline, config.batch_size, config.num_threads))
+    print('{:.1f} examples/sec, {:.1f} ms/batch (median {:.1f}, p90 {:.1f})'.format(
+            config.num_iter * config.batch_size / total, 1000 * total / config.num_iter,
+            1000 * np.median(elapsed), 1000 * np.percentile(elapsed, 90)))
+
+if __name__ == '__main__':
+
+    from utils.argparse_utils import *
+    parser = get_parser()
+
+    general_arg = add_argument_group('General', parser)
+    general_arg.add_argument('--num_threads', type=int, default=8,
+                            help='the number of threads (for dataset)')
+    add_runtime_arguments(parser)
+
+    bench_arg = add_argument_group('Benchmark', parser)
+    bench_arg.add_argument('--dataset', type=str, default='cfcf',
+                            help='siamese|cfcf|imagenet')
+    bench_arg.add_argument('--phase', type=str, default='train',
+                            help='train|val')
+    bench_arg.add_argument('--batch_size', type=int, default=8,
+                            help='batch size')
+    bench_arg.add_argument('--num_warmup', type=int, default=20,
+                            help='the number of batches to skip (fill buffers)')
+    bench_arg.add_argument('--num_iter', type=int, default=200,
+                            help='the number of batches to measure')
+
+    dataset_arg = add_argument_group('Dataset', parser)
+    dataset_arg.add_argument('--vid_dir', type=str, default='/cvlabdata1/home/ono/datasets/VID/ILSVRC2015',
+                            help='VID root directory')
+    dataset_arg.add_argument('--imagenet_dir', type=str, default='/cvlabdata1/home/ono/datasets/imagenet',
+                            help='imagenet root directory')
+    dataset_arg.add_argument('--max_length', type=int, default=500,
+                            help='max_length')
+    dataset_arg.add_argument('--tuned_pipeline', type=str2bool, default=False,
+                            help='prefetch, fused map_and_batch and small-buffer shuffle of a pre-shuffled index')
+
+    config, unparsed = get_config(parser)
+
+    if len(unparsed) > 0:
+        raise ValueError('Warning: miss identify argument ?? unparsed={}\n'.format(unparsed))
+
+    main(config)
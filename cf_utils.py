@@ -2,10 +2,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import re
 import collections
 
 import numpy as np
 import tensorflow as tf
+from tensorflow.python.framework import function
 import cv2
 
 from utils.misc import get_center
@@ -48,6 +50,136 @@ def batch_ifft2d(inputs, transpose=True):
         outputs = tf.transpose(outputs, [0,2,3,1]) # [B,H,W,C]
     return outputs    
 
+def cf_response(feats_X, feats_Z, GZ, reglambda):
+    # Response of the correlation filter learned on the template feats_Z (desired response GZ)
+    # and applied to the query feats_X: [B,H,W,C], [B,H,W,C], [B,H,W,1] --> [B,H,W,1]
+    FZ = batch_fft2d(feats_Z)
+    FX = batch_fft2d(feats_X)
+    FGZ = batch_fft2d(GZ)
+    FH = (tf.conj(FGZ) * FZ) / (tf.reduce_sum(FZ * tf.conj(FZ), axis=-1, keep_dims=True) + reglambda)
+    return tf.reduce_sum(tf.real(batch_ifft2d(tf.conj(FH) * FX)), axis=-1, keep_dims=True)
+
+def cf_response_grads(feats_X, feats_Z, GZ, grad, reglambda, pairwise_chunk_size=0):
+    """Closed-form gradients of cf_response w.r.t. feats_X and feats_Z.
+
+    grad: dL/d(response) [B,H,W,1]. With FE = fft(grad), D = sum_c |FZ_c|^2 + reglambda
+    and S = sum_c conj(FE) FGZ FX_c conj(FZ_c) (all channels at once, no loop over channel pairs)
+        dL/dX_c = real(ifft(FE conj(FGZ) FZ_c / D))
+        dL/dZ_c = real(ifft(conj(FE) FGZ FX_c / D - 2 real(S) FZ_c / D^2))
+    pairwise_chunk_size > 0 computes dL/dZ from the K1/K2/K3 terms of [1] instead (see cf_delLZ_pairwise).
+    Return: (dL/dX, dL/dZ)
+    """
+    FZ = batch_fft2d(feats_Z)
+    FX = batch_fft2d(feats_X)
+    FGZ = batch_fft2d(GZ)
+    FE = batch_fft2d(grad)
+    D = tf.real(tf.reduce_sum(FZ * tf.conj(FZ), axis=-1, keep_dims=True)) + reglambda
+    D = tf.complex(D, tf.zeros_like(D))
+
+    delLX = tf.real(batch_ifft2d(FE * tf.conj(FGZ) * FZ / D))
+    if pairwise_chunk_size > 0:
+        return delLX, cf_delLZ_pairwise(FX, FZ, FGZ, FE, D, pairwise_chunk_size)
+    EG = tf.conj(FE) * FGZ
+    S = tf.real(tf.reduce_sum(EG * FX * tf.conj(FZ), axis=-1, keep_dims=True))
+    S = tf.complex(S, tf.zeros_like(S))
+    delLZ = tf.real(batch_ifft2d(EG * FX / D - 2.0 * S * FZ / tf.square(D)))
+    return delLX, delLZ
+
+def cf_delLZ_pairwise(FX, FZ, FGZ, FE, D, chunk_size=64):
+    """dL/dZ from the terms of [1] over all channel pairs (l, k), in the frequency domain.
+
+        dL/dZ_k = real(ifft(K1 A_k - sum_l K2_lk A_l - sum_l K3_lk conj(A_l)))
+        A = conj(FE) FX, K1 = FGZ / D, K2_lk = FGZ conj(FZ_l) FZ_k / D^2, K3_lk = conj(FGZ) FZ_l FZ_k / D^2
+    The sums over l are batched matmuls with the [B,H,W,C,chunk_size] pair matrices of
+    chunk_size channels k, the chunks run one after another to bound the memory.
+    """
+    channels = FZ.get_shape().as_list()[-1] # must be fixed
+    A = tf.conj(FE) * FX # [B,H,W,C]
+    A_row = tf.expand_dims(A, -2) # [B,H,W,1,C]
+    A_conj_row = tf.conj(A_row)
+    K1 = FGZ / D
+    K23 = 1.0 / tf.square(D)
+
+    grads = []
+    for k in range(0, channels, chunk_size):
+        with tf.control_dependencies(grads[-1:]):
+            FZ_k = tf.expand_dims(FZ[..., k:k+chunk_size], -2) # [B,H,W,1,c]
+            pairs2 = tf.expand_dims(tf.conj(FZ), -1) * FZ_k # conj(FZ_l) FZ_k [B,H,W,C,c]
+            pairs3 = tf.expand_dims(FZ, -1) * FZ_k # FZ_l FZ_k
+            K2A = tf.squeeze(tf.matmul(A_row, pairs2), -2) # sum_l over the pairs [B,H,W,c]
+            K3A = tf.squeeze(tf.matmul(A_conj_row, pairs3), -2)
+            grads.append(K1 * A[..., k:k+chunk_size] - (FGZ * K2A + tf.conj(FGZ) * K3A) * K23)
+    return tf.real(batch_ifft2d(tf.concat(grads, axis=-1)))
+
+_cf_response_ops = {} # reglambda -> Defun
+
+def get_cf_response_op(reglambda):
+    if reglambda not in _cf_response_ops:
+        def grad_func(op, grad):
+            delLX, delLZ = cf_response_grads(op.inputs[0], op.inputs[1], op.inputs[2], grad, reglambda)
+            return delLX, delLZ, tf.zeros_like(op.inputs[2]) # GZ is a constant
+
+        @function.Defun(tf.float32, tf.float32, tf.float32, python_grad_func=grad_func,
+                        shape_func=lambda op: [op.inputs[2].get_shape()])
+        def CFResponse(feats_X, feats_Z, GZ):
+            return cf_response(feats_X, feats_Z, GZ, reglambda)
+        _cf_response_ops[reglambda] = CFResponse
+    return _cf_response_ops[reglambda]
+
+def cf_response_closed_form(feats_X, feats_Z, GZ, reglambda):
+    """cf_response as a single op whose gradient is cf_response_grads.
+
+    Only the inputs are kept for the backward pass (the FFTs are recomputed)
+    instead of every complex intermediate tensor of autodiff.
+    """
+    GZ = tf.cast(GZ, tf.float32)
+    response = get_cf_response_op(float(reglambda))(feats_X, feats_Z, GZ)
+    response.set_shape(GZ.get_shape())
+    return response
+
+#-------------------
+# Multi-layer fusion
+# The feature maps of all layers are resized to a common grid, zero-padded to the same number of channels
+# and stacked along the batch axis [L*B,H,W,C], so one CF solve (one FFT/IFFT each) serves every layer.
+# Zero channels add nothing to the denominator nor to the response, each layer keeps its own template.
+#-------------------
+def parse_feat_layers(feat_layer):
+    # 'vgg_16/conv3/conv3_3,vgg_16/conv4/conv4_3' --> ['vgg_16/conv3/conv3_3', 'vgg_16/conv4/conv4_3']
+    return [layer.strip() for layer in feat_layer.split(',') if len(layer.strip()) > 0]
+
+def parse_layer_weights(text, num_layers):
+    # comma separated weights of the layer responses (equal if empty), normalized to sum 1
+    if len(text.strip()) == 0:
+        return [1.0 / num_layers] * num_layers
+    weights = [float(w) for w in text.split(',')]
+    if len(weights) != num_layers:
+        raise ValueError('#weights ({}) != #layers ({})'.format(len(weights), num_layers))
+    return [w / sum(weights) for w in weights]
+
+def get_deepest_layer(feat_layers):
+    # backbone output_layer building all feat_layers (natural order: layer_9 < layer_14, conv3 < conv5)
+    natural_key = lambda name: [int(s) if s.isdigit() else s for s in re.split(r'(\d+)', name)]
+    return max(feat_layers, key=natural_key)
+
+def stack_layer_features(feats_list, grid_size):
+    """Resize [B,H_l,W_l,C_l] feature maps to grid_size [H,W] and stack them into [L*B,H,W,max C_l]"""
+    max_channels = max([feats.get_shape().as_list()[-1] for feats in feats_list])
+    stacked = []
+    for feats in feats_list:
+        if feats.get_shape().as_list()[1:3] != list(grid_size):
+            feats = tf.image.resize_images(feats, grid_size, method=tf.image.ResizeMethod.BILINEAR,
+                                           align_corners=True)
+        channels = feats.get_shape().as_list()[-1]
+        if channels < max_channels:
+            feats = tf.pad(feats, [[0,0],[0,0],[0,0],[0,max_channels-channels]])
+        stacked.append(feats)
+    return tf.concat(stacked, axis=0)
+
+def fuse_layer_responses(responses, weights):
+    """Weighted sum of the layer responses [L*B,H,W,1] (stacked by stack_layer_features) --> [B,H,W,1]"""
+    layer_responses = tf.split(responses, len(weights), axis=0)
+    return tf.add_n([w * response for w, response in zip(weights, layer_responses)])
+
 def get_cx(rect):
     return (rect[0]+rect[2])*0.5
 
@@ -15,9 +15,14 @@ LOCAL_PATH = './'
 if LOCAL_PATH not in sys.path:
     sys.path.append(LOCAL_PATH)
 
-from datasets import CFVIDDataset
+from datasets import CFVIDDataset, materialize_dataset
 from utils.tf_layer_utils import *
-from utils.tf_train_utils import get_optimizer, get_piecewise_lr, get_activation_fn
+from utils.tf_train_utils import run_profiled_step, run_accumulation, get_optimizer, get_block_checkpoints, get_piecewise_lr, get_activation_fn
+from utils.runtime_utils import setup_runtime, get_session_config, apply_dataset_threading, add_runtime_arguments
+from utils.metrics_utils import MetricsLogger, StepTimer
+from utils.dist_utils import DistributedContext, add_distributed_arguments
+from utils.precision_utils import call_backbone, get_loss_scale, add_precision_arguments
+from utils.restore_utils import restore_with_cache, add_restore_arguments
 
 from models import *
 from cf_utils import *
@@ -28,48 +33,70 @@ if MY_UTILS_PATH not in sys.path:
 import tfvisualizer as tv
 from utils.io_utils import read_text
 SAVE_MODEL = True
+STOP_FILE = 'STOP' # early stopping request from a scheduler
 
 def patch_eval_one_epoch(sess, ops, ev_params, name='valid'):
     num_examples = ev_params['num_examples']
     batch_size = ev_params['batch_size']
     summary_writer = ev_params['summary_writer']
-    num_iter = num_examples // batch_size
+    arrays = ev_params.get('arrays') # fixed validation set (numpy), otherwise the dataset iterator is used
+    fixed_set = ev_params.get('fixed_set', False) # finite dataset of num_examples, the last batch is smaller
 
-    sess.run(ev_params['ev_init_op'])
+    if arrays is None:
+        sess.run(ev_params['ev_init_op'])
+        if fixed_set:
+            num_iter = (num_examples + batch_size - 1) // batch_size
+        else:
+            num_iter = num_examples // batch_size
+    else:
+        num_examples = len(arrays[0])
+        num_iter = (num_examples + batch_size - 1) // batch_size
+    num_done = 0
 
-    metrics = np.zeros(1, dtype=np.float32)
+    metrics = np.zeros(2, dtype=np.float32)
 
     for i in range(num_iter):
         feed_dict = {
             ops['is_training']: False,
             ops['handle']: ev_params['handle'],
         }
+        curr_batch_size = batch_size
+        if arrays is not None:
+            batch = [x[i*batch_size:(i+1)*batch_size] for x in arrays]
+            feed_dict.update(zip(ev_params['batch_tensors'], batch))
+            curr_batch_size = len(batch[0])
+        elif fixed_set:
+            curr_batch_size = min(batch_size, num_examples - i*batch_size)
 
         fetch_dict = {
             'loss': ops['loss'],
+            'mean_error_dist': ops['mean_error_dist'],
         }
 
         outs = sess.run(fetch_dict, feed_dict=feed_dict)
 
-        metrics += np.array([outs['loss']])
+        metrics += curr_batch_size * np.array([outs['loss'], outs['mean_error_dist']]) # weighted by the last smaller batch
+        num_done += curr_batch_size
 
     #------ END OF ALL SAMPLES
     step = sess.run(ops['step'])
-    metrics /= num_iter
+    metrics /= num_done
 
-    loss_ev, = metrics
+    loss_ev, mean_error_dist_ev = metrics
 
     print('')
-    print('[{}] iter={} Loss: {:g} '.format(
+    print('[{}] iter={} Loss: {:g} ErrorDist: {:g}'.format(
                 name, step, 
-                loss_ev))
+                loss_ev, mean_error_dist_ev))
 
-    tag_list = ['loss_ev']
+    tag_list = ['loss_ev', 'mean_error_dist_ev']
     summaries = []
     for _tag in tag_list:
         summaries.append( tf.Summary.Value(tag=_tag, simple_value=eval(_tag)) )
     summary_writer.add_summary(tf.Summary(value=summaries), global_step=step)
 
+    if ev_params.get('metrics_logger') is not None:
+        ev_params['metrics_logger'].log(step, name, **dict([(v.tag, v.simple_value) for v in summaries]))
 
 def build_network(config, next_batch, is_training):
 
@@ -107,15 +134,40 @@ def build_network(config, next_batch, is_training):
         query_img = query_src - IMAGENET_RGB_MEAN
 
     # Get CNN response of query and template
-    _, endpoints_X = backbone(query_img, is_training=is_training, reuse=False)
-    _, endpoints_Z = backbone(template_img, is_training=is_training, reuse=True)
+    # layers after feat_layer are not built (no variables to initialize, restore and save)
+    feat_layers = parse_feat_layers(config.feat_layer) # several layers are fused from one backbone pass
+    output_layer = get_deepest_layer(feat_layers)
+    if config.batched_backbone:
+        # one pass over [query; template] with the shared weights, then split along the batch axis
+        _, endpoints_X = call_backbone(backbone, tf.concat([query_img, template_img], axis=0), config.precision,
+                                       is_training=is_training, reuse=False, output_layer=output_layer)
+        layer_feats = [tf.split(endpoints_X[layer], 2, axis=0) for layer in feat_layers] # [(query, template)]
+        feats_X_list = [feats[0] for feats in layer_feats]
+        feats_Z_list = [feats[1] for feats in layer_feats]
+    else:
+        _, endpoints_X = call_backbone(backbone, query_img, config.precision, is_training=is_training, reuse=False,
+                                       output_layer=output_layer)
+        _, endpoints_Z = call_backbone(backbone, template_img, config.precision, is_training=is_training, reuse=True,
+                                       output_layer=output_layer)
+        feats_X_list = [endpoints_X[layer] for layer in feat_layers] # query
+        feats_Z_list = [endpoints_Z[layer] for layer in feat_layers] # template
+    if len(feat_layers) > 1:
+        # [L*B,H,W,C] on the grid of the first layer
+        grid_size = feats_Z_list[0].get_shape().as_list()[1:3]
+        feats_X = stack_layer_features(feats_X_list, grid_size)
+        feats_Z = stack_layer_features(feats_Z_list, grid_size)
+    else:
+        feats_X, feats_Z = feats_X_list[0], feats_Z_list[0]
     var_list = endpoints_X['var_list']
+    # block boundaries and the feature maps, kept for the backward pass with --recompute_gradients
+    if config.batched_backbone:
+        checkpoints = get_block_checkpoints(endpoints_X, [endpoints_X[layer] for layer in feat_layers])
+    else:
+        checkpoints = get_block_checkpoints(endpoints_X) + get_block_checkpoints(endpoints_Z, feats_X_list + feats_Z_list)
     # for k, v in endpoints_X.items():
     #     if isinstance(v, tf.Tensor):
     #         print(k, v.shape)
 
-    feats_X = endpoints_X[config.feat_layer] # query
-    feats_Z = endpoints_Z[config.feat_layer] # template
     print('FEAT-SIZE [Q] {}, [T] {}'.format(feats_X.get_shape().as_list(), feats_Z.get_shape().as_list()))
 
     # Correlation Filter
@@ -123,15 +175,17 @@ def build_network(config, next_batch, is_training):
     feats_height, feats_width = feats_Z.get_shape().as_list()[1:3]
     gauss_response = get_template_correlation_response(im_size=temp_size, out_size=[feats_width, feats_height])
     GZ = tf.convert_to_tensor(gauss_response[None,...,None]) # [1,H,W,1]
-    GZ = tf.tile(GZ, [batch_size,1,1,1]) # [B,H,W,1]
-
-    FZ = batch_fft2d(feats_Z)
-    FX = batch_fft2d(feats_X)
-    FGZ = batch_fft2d(GZ) # centerized
+    GZ = tf.tile(GZ, [batch_size*len(feat_layers),1,1,1]) # [L*B,H,W,1]
 
-    FH = (tf.conj(FGZ) * FZ) / (tf.reduce_sum(FZ * tf.conj(FZ), axis=-1, keep_dims=True) + reglambda)
-    # h_response = tf.real(batch_ifft2d(FH))
-    estimated = tf.reduce_sum(tf.real(batch_ifft2d(tf.conj(FH) * FX)), axis=-1, keep_dims=True)
+    if config.cf_grad == 'closed_form':
+        # one op with the closed-form backward pass (see check_gradients.py)
+        estimated = cf_response_closed_form(feats_X, feats_Z, GZ, reglambda)
+    elif config.cf_grad == 'autodiff':
+        estimated = cf_response(feats_X, feats_Z, GZ, reglambda)
+    else:
+        raise ValueError('Unknown cf_grad: {}'.format(config.cf_grad))
+    if len(feat_layers) > 1:
+        estimated = fuse_layer_responses(estimated, parse_layer_weights(config.feat_layer_weights, len(feat_layers)))
 
     desired = tf.image.resize_images(query_res, [feats_height, feats_width]) # desired output (ground truth)
 
@@ -192,7 +246,9 @@ def build_network(config, next_batch, is_training):
         'feats_X': feats_X,
         'feats_Z': feats_Z,
         'loss': loss,
+        'mean_error_dist': mean_error_dist,
         'var_list': var_list,
+        'checkpoints': checkpoints,
         'backbone_name': backbone.name,
         'backbone_ckpt': backbone_ckpt,
     }
@@ -204,55 +260,82 @@ def main(config):
     tf.reset_default_graph() # for sure
     log_dir = config.log_dir
     learning_rate = config.lr
-    va_batch_size = 1
+    va_batch_size = config.valid_batch_size if config.fixed_valid_set else 1
+    setup_runtime(config, num_input_threads=config.dataset_private_threads or config.num_threads)
+    dist = DistributedContext(config, get_session_config(config))
+    dist.join_if_ps()
     print('Setup dataset')
     assert config.template_image_size == config.query_image_size
     tr_provider = CFVIDDataset(template_image_size=config.template_image_size, query_image_size=config.query_image_size, 
                         max_seq_length=config.max_length, num_threads=config.num_threads)
     va_provider = CFVIDDataset(template_image_size=config.template_image_size, query_image_size=config.query_image_size, 
                         max_seq_length=config.max_length, num_threads=config.num_threads)
-    tr_dataset = tr_provider.get_dataset(config.vid_dir, phase='train', batch_size=config.batch_size, shuffle=True)
-    va_dataset = va_provider.get_dataset(config.vid_dir, phase='val', batch_size=va_batch_size, shuffle=True, seed=1234)
+    tr_dataset = tr_provider.get_dataset(config.vid_dir, phase='train', batch_size=config.batch_size, shuffle=True,
+                                tuned=config.tuned_pipeline,
+                                num_shards=dist.num_workers, shard_index=dist.worker_index)
+    if config.fixed_valid_set:
+        va_dataset = va_provider.get_dataset(config.vid_dir, phase='val', batch_size=va_batch_size, shuffle=False, seed=config.valid_seed,
+                                    fixed_num_examples=config.valid_num_examples)
+    else:
+        va_dataset = va_provider.get_dataset(config.vid_dir, phase='val', batch_size=va_batch_size, shuffle=True, seed=1234)
+    tr_dataset = apply_dataset_threading(tr_dataset, config.dataset_private_threads)
+    va_dataset = apply_dataset_threading(va_dataset, config.dataset_private_threads)
     tr_num_examples = tr_provider.num_examples
-    va_num_examples = min(va_provider.num_examples, 1000)
+    va_num_examples = min(va_provider.num_examples, config.valid_num_examples)
     print('#examples = {}, {}'.format(tr_num_examples, va_num_examples))
 
     handle = tf.placeholder(tf.string, shape=[])
 
     dataset_iter = tf.data.Iterator.from_string_handle(handle, tr_dataset.output_types, tr_dataset.output_shapes) # create mock of iterator
     next_batch = list(dataset_iter.get_next()) #tuple --> list to make it possible to modify each elements
+    batch_tensors = list(next_batch) # raw iterator outputs (fed directly by profiled steps)
 
     tr_iter = tr_dataset.make_one_shot_iterator() # infinite loop
     va_iter = va_dataset.make_initializable_iterator() # require initialization in every epoch
 
-    is_training = tf.placeholder(tf.bool, name='is_training')
-    global_step = tf.Variable(0, name='global_step', trainable=False)
-
-    print('Build network')
-    loss, endpoints = build_network(config, next_batch, is_training)
-
-    if config.lr_decay:
-        max_epoch = 50
-        boundaries = list((np.arange(max_epoch, dtype=np.int32)+1) * 5000)
-        lr_values = list(np.logspace(-2, -5, max_epoch))
-        learning_rate = get_piecewise_lr(global_step, boundaries, lr_values, show_summary=True)
-        print('Enable adaptive learning. LR will decrease {} when #iter={}'.format(lr_values, boundaries))        
-
-
-    minimize_op = get_optimizer(config.optim_method, global_step, learning_rate, loss, endpoints['var_list'], show_var_and_grad=config.show_histogram)
+    with dist.device(): # variables on the parameter servers (no-op without --job_name)
+        is_training = tf.placeholder(tf.bool, name='is_training')
+        global_step = tf.Variable(0, name='global_step', trainable=False)
+
+        print('Build network')
+        loss, endpoints = build_network(config, next_batch, is_training)
+
+        if config.lr_decay:
+            max_epoch = 50
+            boundaries = list((np.arange(max_epoch, dtype=np.int32)+1) * 5000)
+            lr_values = list(np.logspace(-2, -5, max_epoch))
+            learning_rate = get_piecewise_lr(global_step, boundaries, lr_values, show_summary=True)
+            print('Enable adaptive learning. LR will decrease {} when #iter={}'.format(lr_values, boundaries))        
+
+
+        minimize_op = get_optimizer(config.optim_method, global_step, learning_rate, loss, endpoints['var_list'], show_var_and_grad=config.show_histogram,
+                                    loss_scale=get_loss_scale(config.precision, config.loss_scale),
+                                    checkpoints=endpoints['checkpoints'] if config.recompute_gradients else None,
+                                    accum_steps=config.accum_steps, wrap_optimizer=dist.wrap_optimizer,
+                                    accum_device=dist.local_device())
+        accum_op = None
+        if config.accum_steps > 1:
+            accum_op, minimize_op = minimize_op # one update per accum_steps micro-batches
     print('Done.')
 
 
-    tfconfig = tf.ConfigProto()
-    tfconfig.gpu_options.allow_growth = True # almost the same as tf.InteractiveSession
-    sess = tf.Session(config=tfconfig)
+    sess = dist.create_session(get_session_config(config))
 
     summary = tf.summary.merge_all()
-    sess.run(tf.global_variables_initializer())
+    dist.initialize(sess) # workers wait here until the chief has restored the variables
     tr_handle = sess.run(tr_iter.string_handle())
     va_handle = sess.run(va_iter.string_handle())
-
-    if config.clear_logs and tf.gfile.Exists(log_dir):
+    va_arrays = None
+    if config.fixed_valid_set and dist.is_chief and len(config.valid_cache_dir) > 0:
+        # decode the validation patches once, evaluation feeds them in large batches
+        # (without cache dir the fixed set is streamed, holding it in memory takes GBs per process)
+        cache_prefix = os.path.join(config.valid_cache_dir, 'cfcf_val_seed{}_n{}_z{}_x{}_len{}'.format(
+                                config.valid_seed, config.valid_num_examples, config.template_image_size,
+                                config.query_image_size, config.max_length))
+        va_arrays = materialize_dataset(sess, va_iter, cache_prefix)
+        print('Fixed validation set: {} examples'.format(len(va_arrays[0])))
+
+    if config.clear_logs and dist.is_chief and tf.gfile.Exists(log_dir):
         print('Clear all files in {}'.format(log_dir))
         try:
             tf.gfile.DeleteRecursively(log_dir) 
@@ -260,7 +343,7 @@ def main(config):
             print('Fail to delete {}. You probably have to kill tensorboard process.'.format(log_dir))
 
     # load pretrained detector model
-    if not config.ignore_pretrain:
+    if not config.ignore_pretrain and dist.is_chief:
         pretrained_model = endpoints['backbone_ckpt']
         if os.path.isdir(pretrained_model):
             checkpoint = tf.train.latest_checkpoint(pretrained_model)
@@ -281,17 +364,13 @@ def main(config):
 
             if len(pretrained_vars) == 0:
                 raise ValueError('Cannot find any variables to resume')
-            print('Resume pretrained variables...'.format(len(pretrained_vars)))
-            for i, var in enumerate(pretrained_vars):
-                print('#{} {} [{}]'.format(i, var.name, var.shape))
-
-            saver = tf.train.Saver(pretrained_vars)
-            saver.restore(sess, checkpoint)
-            saver = None
+            print('Resume {} pretrained variables...'.format(len(pretrained_vars)))
+            restore_with_cache(sess, pretrained_vars, checkpoint, cache_dir=config.restore_cache_dir,
+                               cache_key='{}-{}'.format(endpoints['backbone_name'], config.feat_layer), num_threads=config.restore_threads)
             print('Load pretrained model from {}'.format(checkpoint))
         else:
             raise ValueError('Cannot open checkpoint: {}'.format(checkpoint))
-    else:
+    elif config.ignore_pretrain:
         print('Skip loading pretrained model...')
 
     best_saver = tf.train.Saver(max_to_keep=10, save_relative_paths=True)
@@ -300,7 +379,7 @@ def main(config):
     latest_checkpoint = tf.train.latest_checkpoint(log_dir)
     best_score_filename = os.path.join(log_dir, 'valid', 'best_score.txt')
     best_score = 0 # larger is better
-    if latest_checkpoint is not None:
+    if latest_checkpoint is not None and dist.is_chief:
         from parse import parse
         print('Resume the previous model...')
         latest_saver.restore(sess, latest_checkpoint)
@@ -312,18 +391,22 @@ def main(config):
             best_score = dump_res['best_score']
             print('Previous best score = {} @ #step={}'.format(best_score, curr_step))
 
-    train_writer = tf.summary.FileWriter(
-        os.path.join(log_dir, 'train'), graph=sess.graph
-    )
-    valid_writer = tf.summary.FileWriter(
-        os.path.join(log_dir, 'valid'), graph=sess.graph
-    )    
-
-    if SAVE_MODEL:
-        latest_saver.export_meta_graph(os.path.join(log_dir, "models.meta"))
-    # Save config
-    with open(os.path.join(log_dir, 'config.pkl'), 'wb') as f:
-        pickle.dump(config, f)    
+    train_writer = valid_writer = metrics_logger = None
+    if dist.is_chief: # only the chief writes logs
+        train_writer = tf.summary.FileWriter(
+            os.path.join(log_dir, 'train'), graph=sess.graph
+        )
+        valid_writer = tf.summary.FileWriter(
+            os.path.join(log_dir, 'valid'), graph=sess.graph
+        )    
+
+        if SAVE_MODEL:
+            latest_saver.export_meta_graph(os.path.join(log_dir, "models.meta"))
+        # Save config
+        with open(os.path.join(log_dir, 'config.pkl'), 'wb') as f:
+            pickle.dump(config, f)    
+        metrics_logger = MetricsLogger(log_dir)
+    dist.start(sess) # release the workers
 
     ops = {
         'is_training': is_training,
@@ -331,6 +414,8 @@ def main(config):
         'step': global_step,
         'summary': summary,
         'minimize_op': minimize_op,
+        'accum_op': accum_op,
+        'updated_step': dist.get_updated_step(minimize_op, global_step), # None without --job_name
     }
     for k, v in endpoints.items():
         if isinstance(v, tf.Tensor):
@@ -342,6 +427,9 @@ def main(config):
     save_summary_interval = 100
     save_model_interval = 5000
     valid_interval = 500
+    if not dist.is_chief:
+        # the chief writes summaries and checkpoints and validates, the other workers only train
+        save_summary_interval = save_model_interval = valid_interval = 0
 
     va_params = {
         'batch_size': va_batch_size,
@@ -349,53 +437,82 @@ def main(config):
         'summary_writer': valid_writer,
         'handle': va_handle,
         'ev_init_op': va_iter.initializer,
+        'arrays': va_arrays,
+        'fixed_set': config.fixed_valid_set,
+        'batch_tensors': batch_tensors,
+        'metrics_logger': metrics_logger,
     }
 
     def check_counter(counter, interval):
         return (interval > 0 and counter % interval == 0)
 
+    def passed_counter(prev_counter, counter, interval):
+        # counter can skip a multiple of interval when sync replicas drop stale gradients
+        return (interval > 0 and counter // interval > prev_counter // interval)
+
     start_itr = sess.run(ops['step'])
+    step_timer = StepTimer(config.batch_size * config.accum_steps * dist.num_workers)
+    step = start_itr
 
-    for _ in range(start_itr, config.max_itr):
+    while step < config.max_itr:
 
         feed_dict = {
             ops['is_training']: True,
             ops['handle']: tr_handle,
         }        
 
-        step, _ = sess.run([ops['step'], ops['minimize_op']], feed_dict=feed_dict)
-
-        if check_counter(step, save_summary_interval):
-            feed_dict = {
-                ops['is_training']: False,
-                ops['handle']: tr_handle,
-            }
-            fetch_dict = {
+        prev_step = step
+        fetch_dict = {
+            'minimize_op': ops['minimize_op'],
+        }
+        if dist.enabled:
+            fetch_dict['step'] = ops['updated_step']
+        if check_counter(step+1, save_summary_interval):
+            # computed from the batch of this update, no extra forward pass
+            fetch_dict.update({
                 'loss': ops['loss'],
+                'mean_error_dist': ops['mean_error_dist'],
                 'summary': ops['summary'],
-            }
-            start_time = time.time()
+            })
+
+        if check_counter(step+1, config.profile_interval):
+            outs, input_time, compute_time = run_profiled_step(sess, batch_tensors, fetch_dict, feed_dict,
+                                                               ops['accum_op'], config.accum_steps)
+            step_timer.add_profile(input_time, compute_time)
+        else:
+            step_timer.tic()
+            run_accumulation(sess, ops['accum_op'], config.accum_steps, feed_dict)
             outs = sess.run(fetch_dict, feed_dict=feed_dict)
-            elapsed_time = time.time() - start_time
+            step_timer.toc()
+        # global_step after this update (counted in python to avoid fetching it, unless distributed)
+        step = int(outs['step']) if dist.enabled else step + 1
+
+        if 'summary' in outs:
             train_writer.add_summary(outs['summary'], step) # save summary
-            summaries = [tf.Summary.Value(tag='sec/step', simple_value=elapsed_time)]
+            stats = step_timer.get_stats() # rolling average of the training steps
+            summaries = [tf.Summary.Value(tag='throughput/'+k, simple_value=v) for k, v in stats.items()]
             train_writer.add_summary(tf.Summary(value=summaries), global_step=step)
             train_writer.flush()
 
-            print('[Train] {}step Loss: {:g} ({:.1f}sec)'.format(
+            print('[Train] {}step Loss: {:g} ({:.3f}sec/step, {:.1f}examples/sec, input-bound {:.2f})'.format(
                         step,
                         outs['loss'],
-                        elapsed_time))
+                        stats['sec_per_step'], stats['examples_per_sec'], stats['input_bound_ratio']))
+            metrics_logger.log(step, 'train', loss=outs['loss'], mean_error_dist=outs['mean_error_dist'], **stats)
             if SAVE_MODEL and latest_saver is not None:
                 latest_saver.save(sess, os.path.join(log_dir, 'models-latest'), global_step=step, write_meta_graph=False)
 
 
-        if SAVE_MODEL and best_saver is not None and check_counter(step, save_model_interval):
+        if SAVE_MODEL and best_saver is not None and passed_counter(prev_step, step, save_model_interval):
             # print('#{}step Save latest model'.format(step))
             best_saver.save(sess, os.path.join(log_dir, 'models-best'), global_step=step, write_meta_graph=False)
 
-        if check_counter(step, valid_interval):
+        if passed_counter(prev_step, step, valid_interval):
             patch_eval_one_epoch(sess, ops, va_params)
+            if os.path.exists(os.path.join(log_dir, STOP_FILE)):
+                # created by asha_scheduler.py when this run is worse than its siblings
+                print('Find {}, stop training at #step={}'.format(os.path.join(log_dir, STOP_FILE), step))
+                break
 
 if __name__ == '__main__':
 
@@ -405,6 +522,10 @@ if __name__ == '__main__':
     general_arg = add_argument_group('General', parser)
     general_arg.add_argument('--num_threads', type=int, default=8,
                             help='the number of threads (for dataset)')
+    add_runtime_arguments(parser)
+    add_distributed_arguments(parser)
+    add_precision_arguments(parser)
+    add_restore_arguments(parser)
 
     train_arg = add_argument_group('Train', parser)
     train_arg.add_argument('--log_dir', type=str, default='logs/cfcf',
@@ -417,10 +538,16 @@ if __name__ == '__main__':
                             help='show variable / gradient histograms on tensorboard (consume a lot of disk space)')
     train_arg.add_argument('--max_itr', type=int, default=50000,
                             help='max epoch')
+    train_arg.add_argument('--profile_interval', type=int, default=100,
+                            help='split every N-th step into input wait and compute (0: disable)')
     train_arg.add_argument('--batch_size', type=int, default=8,
                             help='batch size')
+    train_arg.add_argument('--accum_steps', type=int, default=1,
+                            help='accumulate gradients of N batches before each update (effective batch size: batch_size*N)')
     train_arg.add_argument('--ignore_pretrain', type=str2bool, default=False,
                             help='ignore loading pretrained model')
+    train_arg.add_argument('--recompute_gradients', type=str2bool, default=False,
+                            help='keep only block boundary activations and recompute the rest in the backward pass (less memory, slower). Not with several --feat_layer (the CF head reads layers which depend on each other)')
     train_arg.add_argument('--optim_method', type=str, default='adam',
                             help='adam, momentum, ftrl, rmsprop')
     train_arg.add_argument('--lr', type=float, default=1e-5,
@@ -439,8 +566,20 @@ if __name__ == '__main__':
                             help='template_image_size')
     dataset_arg.add_argument('--query_image_size', type=int, default=255,
                             help='query_image_size')
+    dataset_arg.add_argument('--fixed_valid_set', type=str2bool, default=False,
+                            help='validate on a fixed seeded set of patches evaluated in large batches (not comparable with the loss of runs validated on the random set)')
+    dataset_arg.add_argument('--valid_num_examples', type=int, default=1000,
+                            help='the number of validation examples')
+    dataset_arg.add_argument('--valid_batch_size', type=int, default=32,
+                            help='batch size of the fixed validation set')
+    dataset_arg.add_argument('--valid_seed', type=int, default=1234,
+                            help='seed of the fixed validation set')
+    dataset_arg.add_argument('--valid_cache_dir', type=str, default='',
+                            help='decode the fixed validation set once, save it as .npy here and memory-map it (streamed from the images if empty)')
     dataset_arg.add_argument('--max_length', type=int, default=500,
                             help='max_length')
+    dataset_arg.add_argument('--tuned_pipeline', type=str2bool, default=False,
+                            help='prefetch, fused map_and_batch and small-buffer shuffle of a pre-shuffled index (training set)')
 
     net_arg = add_argument_group('Network', parser)
     net_arg.add_argument('--ckpt_dir', type=str, default='/cvlabdata1/home/ono/datasets/CFCF/pretrained/ckpt/',
@@ -465,13 +604,22 @@ if __name__ == '__main__':
     #   - [7, 7, 160] --> layer_15/output
     #   - [7, 7, 320] --> layer_18/output
     #   - [7, 7, 1280] --> layer_19
+    net_arg.add_argument('--batched_backbone', type=str2bool, default=False,
+                            help='run query and template through the backbone in one batch (batch norm statistics are shared)')
     net_arg.add_argument('--feat_layer', type=str, default='vgg_16/conv4/conv4_3',
-                            help='feature maps layer in backbone')
+                            help='feature maps layer in backbone (comma separated layers are fused, e.g. vgg_16/conv3/conv3_3,vgg_16/conv4/conv4_3)')
+    net_arg.add_argument('--feat_layer_weights', type=str, default='',
+                            help='comma separated weights of the fused layer responses (equal if empty)')
     net_arg.add_argument('--reglambda', type=float, default=0.01,
                             help='lambda for regularization')
+    net_arg.add_argument('--cf_grad', type=str, default='closed_form',
+                            help='backward pass of the CF layer: closed_form|autodiff')
     config, unparsed = get_config(parser)
 
     if len(unparsed) > 0:
         raise ValueError('Miss finding argument: unparsed={}\n'.format(unparsed))
+    if config.recompute_gradients and len(parse_feat_layers(config.feat_layer)) > 1:
+        # the head would read checkpoints on one chain (e.g. conv3_3 -> conv4_3), see recompute_gradients
+        parser.error('--recompute_gradients does not support several --feat_layer, use one layer or disable it')
 
     main(config)
\ No newline at end of file
@@ -17,11 +17,6 @@ def build_network(config, feats_X, feats_Y, GX, GY):
     # GX : [B,H,W,1] correlation filter of query (Ground truth)
     # GY : [B,H,W,1] correlation filter of template (always center)
     reglambda = config.reglambda
-    batch_size = tf.shape(feats_X)[0]
-    height = tf.shape(feats_X)[1]
-    width = tf.shape(feats_X)[2]
-    channels = feats_X.get_shape().as_list()[-1] # must be fixed
-
     #-------------------
     #  Forward
     #-------------------
@@ -45,47 +40,22 @@ def build_network(config, feats_X, feats_Y, GX, GY):
     #-------------------
     gt_delLX, gt_delLY = tf.gradients(loss, [feats_X, feats_Y])
 
+    # closed-form backward pass used in training (cf_utils.cf_response_closed_form)
+    op_estimated = cf_response_closed_form(feats_X, feats_Y, GY, reglambda)
+    op_loss_diff = op_estimated - desired
+    op_loss = tf.reduce_mean(op_loss_diff * op_loss_diff)
+    op_delLX, op_delLY = tf.gradients(op_loss, [feats_X, feats_Y])
+
     #-------------------
     #  custom gradients
     #  We don't need to implement by ourselves in practical training because TF-auto differentiation takes care all of them
-    #  You can also use "Defun" of tensorflow if you want to implement custom gradient from scratch.
+    #  K1/K2/K3 terms of [1] over all channel pairs, as batched matmuls over chunks of channels
     #-------------------
-    FE = batch_fft2d(loss_diff / tf.cast(batch_size*height*width, tf.float32))
-    delLH = tf.real(batch_ifft2d(FE * FX))
-    delLX = tf.real(batch_ifft2d(FE * FH1))
-
-    DY = tf.reduce_sum(FY * tf.conj(FY), axis=-1, keep_dims=True) + reglambda
-    DY2 = tf.square(DY)
-    K1_pre = tf.conj(FGY) / DY
-    FA = batch_fft2d(delLH)    
-
-    def inner_loop_body(l, k, grad):
-        if k != l:
-            K1 = 0
-        else:
-            K1 = K1_pre
-        K2 = tf.conj(FGY) * (FY[...,l] * tf.conj(FY[...,k]))[...,None] / DY2
-        K3 = tf.conj(FGY) * (FY[...,l] * FY[...,k])[...,None] / DY2
-        FA_l = FA[...,l][...,None] # [B,H,W,1]
-        grad = grad + (K1 - K2) * FA_l - K3 * tf.conj(FA_l)
-        return l+1, k, grad
-
-    num_parallel = 1
-    back_prop = False
-    delLY = []
-
-    for k in range(channels):
-        init_state = [0, k, tf.zeros_like(K1_pre)]
-        condition = lambda l, _, _2: l < channels
-
-        l, _, grad = tf.while_loop(condition, inner_loop_body, init_state,
-                                       parallel_iterations=num_parallel,
-                                       back_prop=back_prop)
-        grad = batch_ifft2d(grad)
-        delLY.append(grad)
-
-    delLY = tf.concat(delLY, axis=-1)
-    delLY = tf.real(delLY)
+    grad_estimated = tf.gradients(loss, estimated)[0] # dL/d(estimated)
+    FE = batch_fft2d(grad_estimated)
+    delLH = tf.real(batch_ifft2d(tf.conj(FE) * FX))
+    delLX, delLY = cf_response_grads(feats_X, feats_Y, GY, grad_estimated, reglambda,
+                                     pairwise_chunk_size=config.chunk_size)
 
     endpoints = {
         'feats_X': feats_X,
@@ -98,6 +68,9 @@ def build_network(config, feats_X, feats_Y, GX, GY):
         'delLH': delLH,
         'gt_delLX': gt_delLX,
         'gt_delLY': gt_delLY,
+        'op_loss': op_loss,
+        'op_delLX': op_delLX,
+        'op_delLY': op_delLY,
     }
 
     return endpoints
@@ -109,7 +82,7 @@ def main(config):
     batch_size = 4
     height = 24
     width = 16
-    channels = 32
+    channels = config.channels
 
     feats_X = tf.placeholder(tf.float32, [batch_size, height, width, channels])
     feats_Y = tf.placeholder(tf.float32, [batch_size, height, width, channels])
@@ -122,6 +95,7 @@ def main(config):
     tfconfig.gpu_options.allow_growth = True # almost the same as tf.InteractiveSession
     sess = tf.Session(config=tfconfig)
 
+    num_failed = 0
     for itr in range(config.N):
 
         feed_dict = {
@@ -136,13 +110,31 @@ def main(config):
             'delLY': endpoints['delLY'],
             'gt_delLX': endpoints['gt_delLX'],
             'gt_delLY': endpoints['gt_delLY'],
+            'loss': endpoints['loss'],
+            'op_loss': endpoints['op_loss'],
+            'op_delLX': endpoints['op_delLX'],
+            'op_delLY': endpoints['op_delLY'],
         }
         outs = sess.run(fetch_dict, feed_dict=feed_dict)
 
-        Ex = np.max(np.abs(outs['delLX']-outs['gt_delLX']))
-        Ey = np.max(np.abs(outs['delLY']-outs['gt_delLY']))
+        # regression test against autodiff (relative to the gradient scale)
+        errors = {
+            'loss': relative_error(outs['op_loss'], outs['loss']),
+            'delLX': relative_error(outs['op_delLX'], outs['gt_delLX']),
+            'delLY': relative_error(outs['op_delLY'], outs['gt_delLY']),
+            'pairwise_delLX': relative_error(outs['delLX'], outs['gt_delLX']),
+            'pairwise_delLY': relative_error(outs['delLY'], outs['gt_delLY']),
+        }
+        print('#{}/{} '.format(itr+1, config.N) + ', '.join(['{}={:.2e}'.format(k, v) for k, v in sorted(errors.items())]))
+        num_failed += sum([1 for v in errors.values() if not v <= config.tol])
+
+    if num_failed > 0:
+        print('[FAIL] {} relative errors are larger than {:g}'.format(num_failed, config.tol))
+        sys.exit(1)
+    print('[OK] closed-form CF gradients match autodiff (tol={:g})'.format(config.tol))
 
-        print('#{}/{} Ex={}, Ey={}'.format(itr+1, config.N, Ex, Ey))
+def relative_error(value, expected):
+    return np.max(np.abs(value - expected)) / max(np.max(np.abs(expected)), 1e-12)
 
 
 if __name__ == '__main__':
@@ -153,6 +145,12 @@ if __name__ == '__main__':
                         help='the number of iteration')
     parser.add_argument('--reglambda', type=float, default=0.01,
                             help='lambda for regularization')
+    parser.add_argument('--channels', type=int, default=32,
+                            help='the number of feature channels (e.g. 512 for VGG conv4)')
+    parser.add_argument('--chunk_size', type=int, default=64,
+                            help='channels per chunk of the pairwise K1/K2/K3 terms')
+    parser.add_argument('--tol', type=float, default=1e-3,
+                            help='max relative error of the closed-form gradients (exit with 1 if exceeded)')
     config, unparsed = get_config(parser)
 
     if len(unparsed) > 0:
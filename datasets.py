@@ -7,6 +7,91 @@ from cf_utils import get_exemplar_images
 from utils.misc import get_center
 from utils.io_utils import read_text
 
+def build_index_pipeline(num_examples, map_fn, batch_size, num_threads, shuffle=True, num_epoch=None, seed=None,
+                         tuned=False, shuffle_buffer_size=10000, prefetch_size=2, num_shards=1, shard_index=0):
+    """Dataset of example indices mapped to examples by map_fn and batched.
+
+    num_shards/shard_index: only the indices shard_index, shard_index+num_shards, ... are used
+    (disjoint shards for the workers of distributed training).
+
+    tuned=False keeps the original pipeline: range -> shuffle(num_examples) -> repeat -> map -> batch.
+    tuned=True shuffles the indices once in numpy and only uses a small shuffle buffer on top,
+    fuses shuffle/repeat and map/batch when tf.contrib.data provides them,
+    and prefetches batches to overlap the input pipeline with the training step.
+    """
+    if not tuned:
+        dataset = tf.data.Dataset.range(shard_index, num_examples, num_shards)
+        if shuffle:
+            dataset = dataset.shuffle(num_examples // num_shards + 1, seed=seed)
+        dataset = dataset.repeat(count=num_epoch)
+        dataset = dataset.map(map_fn, num_parallel_calls=num_threads)
+        dataset = dataset.batch(batch_size)
+        return dataset
+
+    contrib_data = getattr(getattr(tf, 'contrib', None), 'data', None)
+    if shuffle:
+        indices = np.arange(shard_index, num_examples, num_shards, dtype=np.int64)
+        indices = np.random.RandomState(seed).permutation(indices)
+        dataset = tf.data.Dataset.from_tensor_slices(indices)
+        buffer_size = min(shuffle_buffer_size, len(indices))
+        if contrib_data is not None and hasattr(contrib_data, 'shuffle_and_repeat'):
+            dataset = dataset.apply(contrib_data.shuffle_and_repeat(buffer_size, count=num_epoch, seed=seed))
+        else:
+            dataset = dataset.shuffle(buffer_size, seed=seed)
+            dataset = dataset.repeat(count=num_epoch)
+    else:
+        dataset = tf.data.Dataset.range(shard_index, num_examples, num_shards)
+        dataset = dataset.repeat(count=num_epoch)
+
+    if contrib_data is not None and hasattr(contrib_data, 'map_and_batch'):
+        num_parallel_batches = max(1, int(np.ceil(num_threads / batch_size)))
+        dataset = dataset.apply(contrib_data.map_and_batch(map_fn, batch_size, num_parallel_batches=num_parallel_batches))
+    else:
+        dataset = dataset.map(map_fn, num_parallel_calls=num_threads)
+        dataset = dataset.batch(batch_size)
+    dataset = dataset.prefetch(prefetch_size)
+    return dataset
+
+def materialize_dataset(sess, iterator, cache_prefix=None):
+    """Run a finite dataset once and keep its batches as numpy arrays.
+
+    With cache_prefix, the arrays are saved as <cache_prefix>_<i>.npy and memory-mapped,
+    so that later runs skip decoding and the examples are not held in memory.
+    Return: list of arrays, one per dataset component
+    """
+    def get_cache_files(num_arrays):
+        return ['{}_{}.npy'.format(cache_prefix, i) for i in range(num_arrays)]
+
+    if cache_prefix is not None and os.path.exists(get_cache_files(1)[0]):
+        num_arrays = 1
+        while os.path.exists(get_cache_files(num_arrays+1)[-1]):
+            num_arrays += 1
+        print('Load cached dataset from {}_*.npy'.format(cache_prefix))
+        return [np.load(f, mmap_mode='r') for f in get_cache_files(num_arrays)]
+
+    sess.run(iterator.initializer)
+    next_batch = iterator.get_next()
+    batches = []
+    while True:
+        try:
+            batches.append(sess.run(next_batch))
+        except tf.errors.OutOfRangeError:
+            break
+    arrays = [np.concatenate(x, axis=0) for x in zip(*batches)]
+
+    if cache_prefix is not None:
+        cache_dir = os.path.dirname(cache_prefix)
+        if len(cache_dir) > 0 and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # <cache_prefix>_0.npy is written last, its existence means the cache is complete
+        for array, cache_file in reversed(list(zip(arrays, get_cache_files(len(arrays))))):
+            tmp_file = cache_file + '.tmp.npy'
+            np.save(tmp_file, array)
+            os.rename(tmp_file, cache_file)
+        print('Save dataset to {}_*.npy'.format(cache_prefix))
+        arrays = [np.load(f, mmap_mode='r') for f in get_cache_files(len(arrays))]
+    return arrays
+
 class SiameseVIDDataset(object):
     def __init__(self, context_amount=0.5, template_image_size=127, query_image_size=255, max_seq_length=500, max_motion=0.5, loc_thresh=16, num_threads=8):
         self.context_amount = context_amount
@@ -17,7 +102,8 @@ class SiameseVIDDataset(object):
         self.max_motion = max_motion
         self.loc_thresh = loc_thresh
 
-    def get_dataset(self, root_dir, phase='train', batch_size=16, shuffle=True, num_epoch=None, seed=None):
+    def get_dataset(self, root_dir, phase='train', batch_size=16, shuffle=True, num_epoch=None, seed=None, tuned=False, fixed_num_examples=0,
+                    num_shards=1, shard_index=0):
         if phase == 'train':
             data_dir = os.path.join(root_dir, 'Data/VID/train/')
             ann_dir = os.path.join(root_dir, 'tfann/train')
@@ -35,6 +121,8 @@ class SiameseVIDDataset(object):
         seq_inds = []
         seq_lengths = []
         curr_id = 0
+        # seeded frame selection gives the same fixed validation set, otherwise random as before
+        rng = np.random.RandomState(seed) if fixed_num_examples > 0 and seed is not None else np.random
 
         for t, sub_dir in enumerate(sub_dirs):
             ann_files = [x.path for x in os.scandir(sub_dir) if x.name.endswith('.npz')]
@@ -48,7 +136,7 @@ class SiameseVIDDataset(object):
                 _bboxes = ann_data['bbox']
                 if self.max_seq_length > 0 and N > self.max_seq_length:
                     indices = np.arange(N)
-                    np.random.shuffle(indices)
+                    rng.shuffle(indices)
                     indices = np.sort(indices[:self.max_seq_length])
                     _filenames = _filenames[indices]
                     _imsizes = _imsizes[indices]
@@ -97,21 +185,37 @@ class SiameseVIDDataset(object):
         self.num_examples = len(filenames)
         print('#SEQ={} #frames={}, min-len={}, max-len={}'.format(len(seq_lengths), self.num_examples, seq_lengths.min(), seq_lengths.max()))
 
-        dataset = tf.data.Dataset.range(self.num_examples)
-        if shuffle:
-            dataset = dataset.shuffle(self.num_examples, seed=seed)
-        dataset = dataset.repeat(count=num_epoch)
-        dataset = dataset.map(self.parser, num_parallel_calls=self.num_threads)
-        dataset = dataset.batch(batch_size)
+        if fixed_num_examples > 0:
+            # fixed set: targets, reference frames and motions are drawn once from the seed (one epoch, no shuffle)
+            rng = np.random.RandomState(seed)
+            tgt_ids = rng.choice(self.num_examples, min(fixed_num_examples, self.num_examples), replace=False)
+            rands = rng.uniform(size=(len(tgt_ids), 3)).astype(np.float32)
+            self.num_examples = len(tgt_ids)
+            dataset = tf.data.Dataset.from_tensor_slices((tgt_ids.astype(np.int64), rands))
+            dataset = dataset.map(self.parser, num_parallel_calls=self.num_threads)
+            dataset = dataset.batch(batch_size)
+            return dataset
+
+        dataset = build_index_pipeline(self.num_examples, self.parser, batch_size, self.num_threads,
+                                       shuffle=shuffle, num_epoch=num_epoch, seed=seed, tuned=tuned,
+                                       num_shards=num_shards, shard_index=shard_index)
 
         return dataset
 
-    def parser(self, tgt_id):
+    def parser(self, tgt_id, rands=None):
+        # rands: [3] uniform values in [0,1) to choose the reference frame and motion (random if None)
         tgt_id = tf.cast(tgt_id, tf.int32) # tf.int64->tf.int32
         seq_id = self.seq_inds[tgt_id]
         length = self.seq_lengths[seq_id]
 
-        ref_id = self.seq_offsets[seq_id] + tf.random_uniform((), 0, length, dtype=tf.int32) # low <= val < high
+        if rands is None:
+            ref_id = self.seq_offsets[seq_id] + tf.random_uniform((), 0, length, dtype=tf.int32) # low <= val < high
+            rand_x = tf.random_uniform((), -1.0, 1.0)
+            rand_y = tf.random_uniform((), -1.0, 1.0)
+        else:
+            ref_id = self.seq_offsets[seq_id] + tf.minimum(tf.to_int32(rands[0] * tf.to_float(length)), length-1)
+            rand_x = rands[1] * 2.0 - 1.0
+            rand_y = rands[2] * 2.0 - 1.0
         image_z = self.decode_image(self.data_root_dir+self.filenames[tgt_id])
         image_x = self.decode_image(self.data_root_dir+self.filenames[ref_id])
 
@@ -124,8 +228,8 @@ class SiameseVIDDataset(object):
         patch_z, _, _ = self.build_search_image(image_z, box_z, 1.0)
         _cy, _cx, _height, _width = tf.unstack(box_x)
         _max_length = tf.maximum(_height, _width)
-        motion_x = _max_length * self.max_motion * tf.random_uniform((), -1.0, 1.0)
-        motion_y = _max_length * self.max_motion * tf.random_uniform((), -1.0, 1.0)
+        motion_x = _max_length * self.max_motion * rand_x
+        motion_y = _max_length * self.max_motion * rand_y
 
         box_x_perturb = tf.stack([_cy+motion_y, _cx+motion_x, _height, _width])
 
@@ -223,7 +327,8 @@ class CFVIDDataset(object):
         self.max_motion = max_motion
         self.loc_thresh = loc_thresh
 
-    def get_dataset(self, root_dir, phase='train', batch_size=16, shuffle=True, num_epoch=None, seed=None):
+    def get_dataset(self, root_dir, phase='train', batch_size=16, shuffle=True, num_epoch=None, seed=None, tuned=False, fixed_num_examples=0,
+                    num_shards=1, shard_index=0):
         if phase == 'train':
             data_dir = os.path.join(root_dir, 'Data/VID/train/')
             ann_dir = os.path.join(root_dir, 'tfann/train')
@@ -241,6 +346,8 @@ class CFVIDDataset(object):
         seq_inds = []
         seq_lengths = []
         curr_id = 0
+        # seeded frame selection gives the same fixed validation set, otherwise random as before
+        rng = np.random.RandomState(seed) if fixed_num_examples > 0 and seed is not None else np.random
 
         for t, sub_dir in enumerate(sub_dirs):
             ann_files = [x.path for x in os.scandir(sub_dir) if x.name.endswith('.npz')]
@@ -254,7 +361,7 @@ class CFVIDDataset(object):
                 _bboxes = ann_data['bbox']
                 if self.max_seq_length > 0 and N > self.max_seq_length:
                     indices = np.arange(N)
-                    np.random.shuffle(indices)
+                    rng.shuffle(indices)
                     indices = np.sort(indices[:self.max_seq_length])
                     _filenames = _filenames[indices]
                     _imsizes = _imsizes[indices]
@@ -303,21 +410,37 @@ class CFVIDDataset(object):
         self.num_examples = len(filenames)
         print('#SEQ={} #frames={}, min-len={}, max-len={}'.format(len(seq_lengths), self.num_examples, seq_lengths.min(), seq_lengths.max()))
 
-        dataset = tf.data.Dataset.range(self.num_examples)
-        if shuffle:
-            dataset = dataset.shuffle(self.num_examples, seed=seed)
-        dataset = dataset.repeat(count=num_epoch)
-        dataset = dataset.map(self.parser, num_parallel_calls=self.num_threads)
-        dataset = dataset.batch(batch_size)
+        if fixed_num_examples > 0:
+            # fixed set: targets, reference frames and motions are drawn once from the seed (one epoch, no shuffle)
+            rng = np.random.RandomState(seed)
+            tgt_ids = rng.choice(self.num_examples, min(fixed_num_examples, self.num_examples), replace=False)
+            rands = rng.uniform(size=(len(tgt_ids), 3)).astype(np.float32)
+            self.num_examples = len(tgt_ids)
+            dataset = tf.data.Dataset.from_tensor_slices((tgt_ids.astype(np.int64), rands))
+            dataset = dataset.map(self.parser, num_parallel_calls=self.num_threads)
+            dataset = dataset.batch(batch_size)
+            return dataset
+
+        dataset = build_index_pipeline(self.num_examples, self.parser, batch_size, self.num_threads,
+                                       shuffle=shuffle, num_epoch=num_epoch, seed=seed, tuned=tuned,
+                                       num_shards=num_shards, shard_index=shard_index)
 
         return dataset
 
-    def parser(self, tgt_id):
+    def parser(self, tgt_id, rands=None):
+        # rands: [3] uniform values in [0,1) to choose the reference frame and motion (random if None)
         tgt_id = tf.cast(tgt_id, tf.int32) # tf.int64->tf.int32
         seq_id = self.seq_inds[tgt_id]
         length = self.seq_lengths[seq_id]
 
-        ref_id = self.seq_offsets[seq_id] + tf.random_uniform((), 0, length, dtype=tf.int32) # low <= val < high
+        if rands is None:
+            ref_id = self.seq_offsets[seq_id] + tf.random_uniform((), 0, length, dtype=tf.int32) # low <= val < high
+            rand_x = tf.random_uniform((), -1.0, 1.0)
+            rand_y = tf.random_uniform((), -1.0, 1.0)
+        else:
+            ref_id = self.seq_offsets[seq_id] + tf.minimum(tf.to_int32(rands[0] * tf.to_float(length)), length-1)
+            rand_x = rands[1] * 2.0 - 1.0
+            rand_y = rands[2] * 2.0 - 1.0
         image_z = self.decode_image(self.data_root_dir+self.filenames[tgt_id])
         image_x = self.decode_image(self.data_root_dir+self.filenames[ref_id])
 
@@ -330,8 +453,8 @@ class CFVIDDataset(object):
         patch_z, _, _ = self.build_search_image(image_z, box_z, 1.0)
         _cy, _cx, _height, _width = tf.unstack(box_x)
         _max_length = tf.maximum(_height, _width)
-        motion_x = _max_length * self.max_motion * tf.random_uniform((), -1.0, 1.0)
-        motion_y = _max_length * self.max_motion * tf.random_uniform((), -1.0, 1.0)
+        motion_x = _max_length * self.max_motion * rand_x
+        motion_y = _max_length * self.max_motion * rand_y
 
         box_x_perturb = tf.stack([_cy+motion_y, _cx+motion_x, _height, _width])
 
@@ -433,7 +556,8 @@ class ImageNet(object):
         self.NUM_CLASSES = 1001 # background(0) + objects(1,...,1000)
         self._RESIZE_MIN = 256
         
-    def get_dataset(self, root_dir, phase='train', batch_size=16, is_training=True, one_hot=True, shuffle=True, subtract_mean=True, num_epoch=None, seed=None):
+    def get_dataset(self, root_dir, phase='train', batch_size=16, is_training=True, one_hot=True, shuffle=True, subtract_mean=True, num_epoch=None, seed=None, tuned=False,
+                    num_shards=1, shard_index=0):
         ann_dir = os.path.join(root_dir, 'annotations', phase)
         data_dir = os.path.join(root_dir, 'ILSVRC2015/Data/CLS-LOC', phase) + '/' # data_dir must end with '/'
         
@@ -473,13 +597,11 @@ class ImageNet(object):
         
         print('[{}] #Examples={}'.format(phase, self.num_examples))
         
-        dataset = tf.data.Dataset.range(self.num_examples)
-        if shuffle:
-            dataset = dataset.shuffle(self.num_examples, seed=seed)
-        dataset = dataset.repeat(count=num_epoch)
-        dataset = dataset.map(
-                    lambda x: self.parser(x, is_training, one_hot, subtract_mean), num_parallel_calls=self.num_threads)
-        dataset = dataset.batch(batch_size)
+        dataset = build_index_pipeline(self.num_examples,
+                                       lambda x: self.parser(x, is_training, one_hot, subtract_mean),
+                                       batch_size, self.num_threads,
+                                       shuffle=shuffle, num_epoch=num_epoch, seed=seed, tuned=tuned,
+                                       num_shards=num_shards, shard_index=shard_index)
         return dataset
     
     def parser(self, tgt_id, is_training, one_hot, subtract_mean):
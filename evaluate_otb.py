@@ -0,0 +1,224 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""OTB-style success/precision evaluation of tracking results.
+
+run_tracking.py writes `<log_dir>/<video>/track_rect.txt` for every sequence.
+This module scores them against `<root_dir>/<video>/groundtruth_rect.txt`
+with vectorized numpy, so that a full benchmark run (or the many runs of a
+hyper-parameter sweep) is evaluated in seconds without the MATLAB toolkit.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import re
+import glob
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+SUCCESS_THRESHOLDS = np.linspace(0, 1, 21) # IoU thresholds of the success plot
+PRECISION_THRESHOLDS = np.arange(51) # pixel thresholds of the precision plot
+PRECISION_AT = 20 # representative precision score (pixels)
+
+_GROUNDTRUTH_CACHE = {} # filename -> (mtime, rects)
+
+def load_rects(filename):
+    """Read [x,y,width,height] boxes (one per line, separated by comma, tab or space)"""
+    rects = []
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            rects.append([float(v) for v in re.split(r'[,\s]+', line)[:4]])
+    return np.array(rects, dtype=np.float64).reshape(-1, 4)
+
+def load_groundtruth(video_dir, gt_name='groundtruth_rect.txt'):
+    """Load groundtruth boxes of a sequence. Parsed files are cached until they are modified."""
+    filename = os.path.join(video_dir, gt_name)
+    mtime = os.path.getmtime(filename)
+    cached = _GROUNDTRUTH_CACHE.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    rects = load_rects(filename)
+    rects.setflags(write=False) # shared between callers
+    _GROUNDTRUTH_CACHE[filename] = (mtime, rects)
+    return rects
+
+def clear_groundtruth_cache():
+    _GROUNDTRUTH_CACHE.clear()
+
+def compute_ious(rects1, rects2):
+    # rects: [N,4] x,y,width,height
+    # Return: [N,] IoU of each pair of boxes
+    x1 = np.maximum(rects1[:,0], rects2[:,0])
+    y1 = np.maximum(rects1[:,1], rects2[:,1])
+    x2 = np.minimum(rects1[:,0]+rects1[:,2], rects2[:,0]+rects2[:,2])
+    y2 = np.minimum(rects1[:,1]+rects1[:,3], rects2[:,1]+rects2[:,3])
+    area_I = np.maximum(x2-x1, 0) * np.maximum(y2-y1, 0)
+    area1 = rects1[:,2] * rects1[:,3]
+    area2 = rects2[:,2] * rects2[:,3]
+    union = area1 + area2 - area_I
+    ious = np.zeros(len(rects1), dtype=np.float64)
+    np.divide(area_I, union, out=ious, where=union > 0)
+    return ious
+
+def compute_center_errors(rects1, rects2):
+    # rects: [N,4] x,y,width,height
+    # Return: [N,] euclidean distance between box centers (pixels)
+    centers1 = rects1[:,:2] + rects1[:,2:] * 0.5
+    centers2 = rects2[:,:2] + rects2[:,2:] * 0.5
+    return np.sqrt(np.sum((centers1-centers2)**2, axis=1))
+
+def success_curve(ious, thresholds=SUCCESS_THRESHOLDS):
+    # Return: [T,] ratio of frames whose IoU is larger than each threshold
+    if len(ious) == 0:
+        return np.zeros(len(thresholds))
+    return np.mean(ious[None,:] > thresholds[:,None], axis=1)
+
+def precision_curve(errors, thresholds=PRECISION_THRESHOLDS):
+    # Return: [T,] ratio of frames whose center error is no larger than each threshold
+    if len(errors) == 0:
+        return np.zeros(len(thresholds))
+    return np.mean(errors[None,:] <= thresholds[:,None], axis=1)
+
+def evaluate_rects(results, groundtruth):
+    """Score tracked boxes against groundtruth boxes of one sequence.
+
+    Frames whose groundtruth is invalid (NaN or empty box) are ignored.
+    If the lengths differ, only the common leading frames are scored.
+    """
+    num_frames = min(len(results), len(groundtruth))
+    if num_frames != len(groundtruth):
+        print('[Warning] #results={} but #groundtruth={}'.format(len(results), len(groundtruth)))
+    results = results[:num_frames]
+    groundtruth = groundtruth[:num_frames]
+
+    valid = np.all(np.isfinite(groundtruth), axis=1) & (groundtruth[:,2] > 0) & (groundtruth[:,3] > 0)
+    results = results[valid]
+    groundtruth = groundtruth[valid]
+
+    ious = compute_ious(results, groundtruth)
+    errors = compute_center_errors(results, groundtruth)
+    success = success_curve(ious)
+    precision = precision_curve(errors)
+
+    return {
+        'num_frames': int(np.sum(valid)),
+        'ious': ious,
+        'errors': errors,
+        'success': success,
+        'precision': precision,
+        'auc': float(np.mean(success)),
+        'prec': float(precision[PRECISION_AT]),
+        'mean_iou': float(np.mean(ious)) if len(ious) > 0 else 0.0,
+    }
+
+def evaluate_run(log_dir, root_dir, seq_names=None, result_name='track_rect.txt'):
+    """Evaluate all sequences of one tracking run.
+
+    Args:
+        log_dir: output directory of run_tracking.py (contains one sub-directory per sequence)
+        root_dir: OTB root directory
+        seq_names: sequences to evaluate, all result sub-directories of log_dir if None
+
+    Returns:
+        per_seq: OrderedDict of sequence name -> result of evaluate_rects
+        overall: success/precision curves averaged over sequences, and AUC/precision
+    """
+    if seq_names is None:
+        seq_names = sorted([os.path.basename(os.path.dirname(x))
+                        for x in glob.glob(os.path.join(log_dir, '*', result_name))])
+
+    per_seq = OrderedDict()
+    for seq_name in seq_names:
+        result_file = os.path.join(log_dir, seq_name, result_name)
+        if not os.path.exists(result_file):
+            print('[Warning] Not find {}'.format(result_file))
+            continue
+        groundtruth = load_groundtruth(os.path.join(root_dir, seq_name))
+        per_seq[seq_name] = evaluate_rects(load_rects(result_file), groundtruth)
+
+    if len(per_seq) == 0:
+        raise ValueError('Cannot find any results in {}'.format(log_dir))
+
+    success = np.mean([res['success'] for res in per_seq.values()], axis=0)
+    precision = np.mean([res['precision'] for res in per_seq.values()], axis=0)
+    overall = {
+        'num_seqs': len(per_seq),
+        'success': success,
+        'precision': precision,
+        'auc': float(np.mean(success)),
+        'prec': float(precision[PRECISION_AT]),
+    }
+    return per_seq, overall
+
+def print_results(per_seq, overall, name=''):
+    print('===== {} ====='.format(name))
+    for seq_name, res in per_seq.items():
+        print('{:20s} AUC={:.3f} Prec@{}={:.3f} ({}frames)'.format(
+                seq_name, res['auc'], PRECISION_AT, res['prec'], res['num_frames']))
+    print('[Overall] #seqs={} AUC={:.3f} Prec@{}={:.3f}'.format(
+                overall['num_seqs'], overall['auc'], PRECISION_AT, overall['prec']))
+
+def dump_results(filename, per_seq, overall):
+    data = OrderedDict()
+    data['overall'] = {
+        'num_seqs': overall['num_seqs'],
+        'auc': overall['auc'],
+        'prec': overall['prec'],
+        'success': overall['success'].tolist(),
+        'precision': overall['precision'].tolist(),
+    }
+    data['sequences'] = OrderedDict()
+    for seq_name, res in per_seq.items():
+        data['sequences'][seq_name] = {
+            'num_frames': res['num_frames'],
+            'auc': res['auc'],
+            'prec': res['prec'],
+            'mean_iou': res['mean_iou'],
+        }
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=2)
+
+if __name__ == '__main__':
+
+    from utils.argparse_utils import *
+    parser = get_parser()
+
+    parser.add_argument('--log_dir', type=str, default='logs_track/src_siamese',
+                        help='output directory of run_tracking.py (wildcards are allowed to compare several runs)')
+    parser.add_argument('--root_dir', type=str, default='/cvlabdata2/home/ono/Datasets/OTB2015',
+                        help='dataset root directory')
+    parser.add_argument('--seq_text', type=str, default='',
+                        help='sequence text (evaluate all results in log_dir if empty)')
+    parser.add_argument('--verbose', type=str2bool, default=False,
+                        help='print scores of each sequence')
+    parser.add_argument('--save_json', type=str2bool, default=True,
+                        help='save scores as log_dir/otb_eval.json')
+    config, unparsed = get_config(parser)
+
+    if len(unparsed) > 0:
+        raise ValueError('Warning: miss identify argument ?? unparsed={}\n'.format(unparsed))
+
+    seq_names = None
+    if len(config.seq_text) > 0:
+        with open(config.seq_text, 'r') as f:
+            seq_names = [line.strip() for line in f if len(line.strip()) > 0]
+
+    log_dirs = sorted([x for x in glob.glob(config.log_dir) if os.path.isdir(x)])
+    scores = []
+    for log_dir in log_dirs:
+        per_seq, overall = evaluate_run(log_dir, config.root_dir, seq_names)
+        if config.verbose:
+            print_results(per_seq, overall, name=log_dir)
+        if config.save_json:
+            dump_results(os.path.join(log_dir, 'otb_eval.json'), per_seq, overall)
+        scores.append((overall['auc'], overall['prec'], log_dir))
+
+    print('===== Ranking (AUC) =====')
+    for auc, prec, log_dir in sorted(scores, reverse=True):
+        print('AUC={:.3f} Prec@{}={:.3f} {}'.format(auc, PRECISION_AT, prec, log_dir))
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import itertools
 import copy
+import random
 import pickle
 import inspect
 import numpy as np
@@ -73,27 +74,109 @@ class ParamGenerator(object):
         else:
             assert False, 'Not register {} or {} in var_params'.format(parent, child)
         
-    def generate(self, base_params=None, shuffle=False, idx_offset=0):
-        if base_params is None:
-            base_params = HyperParamsBasic()
-        
-        # Generate variable param combinations
+    def _get_var_params(self):
+        # Split variable params into independent ones and linked children
         var_param_names = [k for k in self.var_params.keys()]
         var_param_vals = [v for v in self.var_params.values()]
-        
         var_link_names = []
         var_link_vals = []
         var_link_parents = []
-        
-        # delete dependency params
         for parent, children in self.links.items():
             for child in children:
                 for i, name in enumerate(var_param_names):
                     if name == child:
-                        var_link_names.append(var_param_names.pop(i)) 
+                        var_link_names.append(var_param_names.pop(i))
                         var_link_vals.append(var_param_vals.pop(i))
                         var_link_parents.append(parent)
                         break
+        return var_param_names, var_param_vals, var_link_names, var_link_vals, var_link_parents
+
+    def _make_params(self, base_params, var_param_names, var_values, var_link_names, var_link_vals, var_link_parents):
+        cur_params = copy.deepcopy(base_params)
+        param_str = ''
+
+        # Set fix params
+        for (name, values) in self.fixed_params.items():
+            if not hasattr(cur_params, name):
+                print('[Warning] hyparams doesnot have <{}> attribute'.format(name))
+            setattr(cur_params, name, values[0])
+
+        # Set variable params
+        for name, value in zip(var_param_names, var_values):
+            if not hasattr(cur_params, name):
+                print('[Warning] hyparams doesnot have <{}> attribute'.format(name))
+            setattr(cur_params, name, value)
+            param_str += '{}-{}/'.format(name, value)
+
+        # Set link params
+        for parent, child, values in zip(var_link_parents, var_link_names, var_link_vals):
+            pval = getattr(cur_params, parent)
+            idx = self.var_params[parent].index(pval)
+            setattr(cur_params, child, values[idx])
+            param_str += '{}-{}/'.format(child, values[idx])
+
+        param_str = param_str[:-1] # remove last '_'
+        setattr(cur_params, 'param_str', param_str)
+        return cur_params
+
+    def num_combinations(self):
+        var_param_names, var_param_vals, _, _, _ = self._get_var_params()
+        return int(np.prod([len(v) for v in var_param_vals], dtype=np.float64)) if len(var_param_vals) > 0 else 1
+
+    def _decode_index(self, index, var_param_vals):
+        # mixed-radix decoding in the same order as itertools.product (last param changes fastest)
+        values = [None] * len(var_param_vals)
+        for d in reversed(range(len(var_param_vals))):
+            index, r = divmod(index, len(var_param_vals[d]))
+            values[d] = var_param_vals[d][r]
+        return values
+
+    def sample(self, num_samples, base_params=None, method='random', seed=None):
+        """Draw param combinations without materializing the whole grid.
+
+        method='random': num_samples distinct combinations chosen uniformly
+        method='lhs': latin hypercube, every value of each param is used (num_samples / #values) times
+        """
+        if base_params is None:
+            base_params = HyperParamsBasic()
+        var_param_names, var_param_vals, var_link_names, var_link_vals, var_link_parents = self._get_var_params()
+        total = self.num_combinations()
+        rng = random.Random(seed)
+
+        if method == 'random':
+            if num_samples >= total:
+                indices = list(range(total))
+                rng.shuffle(indices)
+            else:
+                indices = rng.sample(range(total), num_samples) # lazy for huge ranges
+            all_values = [self._decode_index(i, var_param_vals) for i in indices]
+        elif method == 'lhs':
+            num_samples = min(num_samples, total)
+            strata = []
+            for vals in var_param_vals:
+                perm = list(range(num_samples))
+                rng.shuffle(perm)
+                strata.append([vals[int((p + rng.random()) / num_samples * len(vals))] for p in perm])
+            all_values = []
+            seen = set()
+            for i in range(num_samples):
+                values = [col[i] for col in strata]
+                key = repr(values)
+                if key not in seen: # drop duplicated combinations of coarse params
+                    seen.add(key)
+                    all_values.append(values)
+        else:
+            raise ValueError('Unknown sampling method: {}'.format(method))
+
+        return [self._make_params(base_params, var_param_names, values, var_link_names, var_link_vals, var_link_parents)
+                for values in all_values]
+
+    def generate(self, base_params=None, shuffle=False, idx_offset=0):
+        if base_params is None:
+            base_params = HyperParamsBasic()
+        
+        # Generate variable param combinations
+        var_param_names, var_param_vals, var_link_names, var_link_vals, var_link_parents = self._get_var_params()
 
         var_param_list = list(itertools.product(*var_param_vals))
         all_params = []
@@ -103,33 +186,8 @@ class ParamGenerator(object):
             np.random.shuffle(indices)
         
         for i in indices:
-            cur_params = copy.deepcopy(base_params)
-            
-            # param_str = '{:02d}_'.format(i+idx_offset)
-            param_str = ''
-            
-            # Set fix params
-            for (name, values) in self.fixed_params.items():
-                if not hasattr(cur_params, name):
-                    print('[Warning] hyparams doesnot have <{}> attribute'.format(name))
-                setattr(cur_params, name, values[0])
-                
-            # Set variable params
-            for name, value in zip(var_param_names, var_param_list[i]):
-                if not hasattr(cur_params, name):
-                    print('[Warning] hyparams doesnot have <{}> attribute'.format(name))
-                setattr(cur_params, name, value)
-                param_str += '{}-{}/'.format(name, value)
-            
-            # Set link params
-            for parent, child, values in zip(var_link_parents, var_link_names, var_link_vals):
-                pval = getattr(cur_params, parent)
-                idx = self.var_params[parent].index(pval)
-                setattr(cur_params, child, values[idx])
-                param_str += '{}-{}/'.format(child, values[idx])
-            
-            param_str = param_str[:-1] # remove last '_'
-            setattr(cur_params, 'param_str', param_str)
+            cur_params = self._make_params(base_params, var_param_names, var_param_list[i],
+                                           var_link_names, var_link_vals, var_link_parents)
             all_params.append(cur_params)
             
-        return all_params
\ No newline at end of file
+        return all_params
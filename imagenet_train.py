@@ -13,7 +13,10 @@ import pickle
 
 from datasets import ImageNet
 from utils.tf_layer_utils import *
-from utils.tf_train_utils import get_optimizer, get_piecewise_lr, get_activation_fn
+from utils.tf_train_utils import run_profiled_step, run_accumulation, get_optimizer, get_piecewise_lr, get_activation_fn
+from utils.runtime_utils import setup_runtime, get_session_config, apply_dataset_threading, add_runtime_arguments
+from utils.metrics_utils import MetricsLogger, StepTimer
+from utils.dist_utils import DistributedContext, add_distributed_arguments
 import utils.tfvisualizer as tv
 from utils.io_utils import read_text
 
@@ -22,6 +25,7 @@ if MODEL_PATH not in sys.path:
     sys.path.append(MODEL_PATH)
 
 SAVE_MODEL = True
+STOP_FILE = 'STOP' # early stopping request from a scheduler
 
 def eval_one_epoch(sess, ops, ev_params, name='valid'):
     num_examples = ev_params['num_examples']
@@ -68,6 +72,8 @@ def eval_one_epoch(sess, ops, ev_params, name='valid'):
         summaries.append( tf.Summary.Value(tag=_tag, simple_value=eval(_tag)) )
     summary_writer.add_summary(tf.Summary(value=summaries), global_step=step)
 
+    if ev_params.get('metrics_logger') is not None:
+        ev_params['metrics_logger'].log(step, name, **dict([(v.tag, v.simple_value) for v in summaries]))
 
 def build_network(config, next_batch, is_training, num_classes=1001):
 
@@ -131,14 +137,20 @@ def main(config):
     learning_rate = config.lr
     va_batch_size = 10
 
+    setup_runtime(config, num_input_threads=config.dataset_private_threads or config.num_threads)
+    dist = DistributedContext(config, get_session_config(config))
+    dist.join_if_ps()
     print('Setup dataset')
 
     tr_provider = ImageNet(num_threads=config.num_threads)
     va_provider = ImageNet(num_threads=config.num_threads)
     tr_dataset = tr_provider.get_dataset(config.imagenet_dir, phase='train', batch_size=config.batch_size, 
-                                is_training=True, shuffle=True)
+                                is_training=True, shuffle=True, tuned=config.tuned_pipeline,
+                                num_shards=dist.num_workers, shard_index=dist.worker_index)
     va_dataset = va_provider.get_dataset(config.imagenet_dir, phase='val', batch_size=va_batch_size, 
                                 is_training=False, shuffle=True, seed=1234)
+    tr_dataset = apply_dataset_threading(tr_dataset, config.dataset_private_threads)
+    va_dataset = apply_dataset_threading(va_dataset, config.dataset_private_threads)
     tr_num_examples = tr_provider.num_examples
     va_num_examples = min(va_provider.num_examples, 10000)
     print('#examples = {}, {}'.format(tr_num_examples, va_num_examples))
@@ -147,46 +159,51 @@ def main(config):
 
     dataset_iter = tf.data.Iterator.from_string_handle(handle, tr_dataset.output_types, tr_dataset.output_shapes) # create mock of iterator
     next_batch = list(dataset_iter.get_next()) #tuple --> list to make it possible to modify each elements
+    batch_tensors = list(next_batch) # raw iterator outputs (fed directly by profiled steps)
 
     tr_iter = tr_dataset.make_one_shot_iterator() # infinite loop
     va_iter = va_dataset.make_initializable_iterator() # require initialization in every epoch
 
-    is_training = tf.placeholder(tf.bool, name='is_training')
-    global_step = tf.Variable(0, name='global_step', trainable=False)
-
-    print('Build network')
-    loss, endpoints = build_network(config, next_batch, is_training, num_classes=tr_provider.NUM_CLASSES)
-
-    if config.lr_decay:
-        # copy from official/resnet
-        batch_denom = 256
-        initial_learning_rate = 0.1 * config.batch_size / batch_denom
-        batches_per_epoch = tr_num_examples / config.batch_size
-        boundary_epochs = [30, 60, 80, 90]
-        decay_rates=[1, 0.1, 0.01, 0.001, 1e-4]
-        boundaries = [int(batches_per_epoch * epoch) for epoch in boundary_epochs]
-        lr_values = [initial_learning_rate * decay for decay in decay_rates]
-        learning_rate = get_piecewise_lr(global_step, boundaries, lr_values, show_summary=True)
-
-        # max_epoch = 50
-        # boundaries = list((np.arange(max_epoch, dtype=np.int32)+1) * 5000)
-        # lr_values = list(np.logspace(-1, -5, max_epoch))
-        # learning_rate = get_piecewise_lr(global_step, boundaries, lr_values, show_summary=True)
-        print('Enable adaptive learning. LR will decrease {} when #iter={}'.format(lr_values, boundaries))        
-
-    minimize_op = get_optimizer(config.optim_method, global_step, learning_rate, loss, endpoints['var_list'], show_var_and_grad=config.show_histogram)
+    with dist.device(): # variables on the parameter servers (no-op without --job_name)
+        is_training = tf.placeholder(tf.bool, name='is_training')
+        global_step = tf.Variable(0, name='global_step', trainable=False)
+
+        print('Build network')
+        loss, endpoints = build_network(config, next_batch, is_training, num_classes=tr_provider.NUM_CLASSES)
+
+        if config.lr_decay:
+            # copy from official/resnet
+            batch_denom = 256
+            initial_learning_rate = 0.1 * config.batch_size / batch_denom
+            batches_per_epoch = tr_num_examples / config.batch_size
+            boundary_epochs = [30, 60, 80, 90]
+            decay_rates=[1, 0.1, 0.01, 0.001, 1e-4]
+            boundaries = [int(batches_per_epoch * epoch) for epoch in boundary_epochs]
+            lr_values = [initial_learning_rate * decay for decay in decay_rates]
+            learning_rate = get_piecewise_lr(global_step, boundaries, lr_values, show_summary=True)
+
+            # max_epoch = 50
+            # boundaries = list((np.arange(max_epoch, dtype=np.int32)+1) * 5000)
+            # lr_values = list(np.logspace(-1, -5, max_epoch))
+            # learning_rate = get_piecewise_lr(global_step, boundaries, lr_values, show_summary=True)
+            print('Enable adaptive learning. LR will decrease {} when #iter={}'.format(lr_values, boundaries))        
+
+        minimize_op = get_optimizer(config.optim_method, global_step, learning_rate, loss, endpoints['var_list'], show_var_and_grad=config.show_histogram,
+                                    accum_steps=config.accum_steps, wrap_optimizer=dist.wrap_optimizer,
+                                    accum_device=dist.local_device())
+        accum_op = None
+        if config.accum_steps > 1:
+            accum_op, minimize_op = minimize_op # one update per accum_steps micro-batches
     print('Done.')
 
-    tfconfig = tf.ConfigProto()
-    tfconfig.gpu_options.allow_growth = True # almost the same as tf.InteractiveSession
-    sess = tf.Session(config=tfconfig)
+    sess = dist.create_session(get_session_config(config))
 
     summary = tf.summary.merge_all()
-    sess.run(tf.global_variables_initializer())
+    dist.initialize(sess) # workers wait here until the chief has restored the variables
     tr_handle = sess.run(tr_iter.string_handle())
     va_handle = sess.run(va_iter.string_handle())
 
-    if config.clear_logs and tf.gfile.Exists(log_dir):
+    if config.clear_logs and dist.is_chief and tf.gfile.Exists(log_dir):
         print('Clear all files in {}'.format(log_dir))
         try:
             tf.gfile.DeleteRecursively(log_dir) 
@@ -199,7 +216,7 @@ def main(config):
     latest_checkpoint = tf.train.latest_checkpoint(log_dir)
     best_score_filename = os.path.join(log_dir, 'valid', 'best_score.txt')
     best_score = 0 # larger is better
-    if latest_checkpoint is not None:
+    if latest_checkpoint is not None and dist.is_chief:
         from parse import parse
         print('Resume the previous model...')
         latest_saver.restore(sess, latest_checkpoint)
@@ -211,18 +228,22 @@ def main(config):
             best_score = dump_res['best_score']
             print('Previous best score = {} @ #step={}'.format(best_score, curr_step))
 
-    train_writer = tf.summary.FileWriter(
-        os.path.join(log_dir, 'train'), graph=sess.graph
-    )
-    valid_writer = tf.summary.FileWriter(
-        os.path.join(log_dir, 'valid'), graph=sess.graph
-    )    
-
-    if SAVE_MODEL:
-        latest_saver.export_meta_graph(os.path.join(log_dir, "models.meta"))
-    # Save config
-    with open(os.path.join(log_dir, 'config.pkl'), 'wb') as f:
-        pickle.dump(config, f)    
+    train_writer = valid_writer = metrics_logger = None
+    if dist.is_chief: # only the chief writes logs
+        train_writer = tf.summary.FileWriter(
+            os.path.join(log_dir, 'train'), graph=sess.graph
+        )
+        valid_writer = tf.summary.FileWriter(
+            os.path.join(log_dir, 'valid'), graph=sess.graph
+        )    
+
+        if SAVE_MODEL:
+            latest_saver.export_meta_graph(os.path.join(log_dir, "models.meta"))
+        # Save config
+        with open(os.path.join(log_dir, 'config.pkl'), 'wb') as f:
+            pickle.dump(config, f)    
+        metrics_logger = MetricsLogger(log_dir)
+    dist.start(sess) # release the workers
 
     ops = {
         'is_training': is_training,
@@ -230,6 +251,8 @@ def main(config):
         'step': global_step,
         'summary': summary,
         'minimize_op': minimize_op,
+        'accum_op': accum_op,
+        'updated_step': dist.get_updated_step(minimize_op, global_step), # None without --job_name
     }
     for k, v in endpoints.items():
         if isinstance(v, tf.Tensor):
@@ -241,6 +264,9 @@ def main(config):
     save_summary_interval = 1000
     save_model_interval = 5000
     valid_interval = 5000
+    if not dist.is_chief:
+        # the chief writes summaries and checkpoints and validates, the other workers only train
+        save_summary_interval = save_model_interval = valid_interval = 0
 
     va_params = {
         'batch_size': va_batch_size,
@@ -248,50 +274,73 @@ def main(config):
         'summary_writer': valid_writer,
         'handle': va_handle,
         'ev_init_op': va_iter.initializer,
+        'metrics_logger': metrics_logger,
     }
 
     def check_counter(counter, interval):
         return (interval > 0 and counter % interval == 0)
 
+    def passed_counter(prev_counter, counter, interval):
+        # counter can skip a multiple of interval when sync replicas drop stale gradients
+        return (interval > 0 and counter // interval > prev_counter // interval)
+
     start_itr = sess.run(ops['step'])
+    step_timer = StepTimer(config.batch_size * config.accum_steps * dist.num_workers)
+    step = start_itr
+    num_failed = 0 # failed updates still count towards max_itr as before
 
-    for _ in range(start_itr, config.max_itr):
+    while step + num_failed < config.max_itr:
 
         feed_dict = {
             ops['is_training']: True,
             ops['handle']: tr_handle,
         }        
 
-        try:
-            step, _ = sess.run([ops['step'], ops['minimize_op']], feed_dict=feed_dict)
-        except:
-            print('Error happens but keep training...')
-
-        if check_counter(step, save_summary_interval):
-            feed_dict = {
-                ops['is_training']: False,
-                ops['handle']: tr_handle,
-            }
-            fetch_dict = {
+        prev_step = step
+        fetch_dict = {
+            'minimize_op': ops['minimize_op'],
+        }
+        if dist.enabled:
+            fetch_dict['step'] = ops['updated_step']
+        if check_counter(step+1, save_summary_interval):
+            # computed from the batch of this update, no extra forward pass
+            fetch_dict.update({
                 'loss': ops['loss'],
                 'top1': ops['top1'],
                 'top5': ops['top5'],
                 'summary': ops['summary'],
-            }
-            try:
-                outs = sess.run(fetch_dict, feed_dict=feed_dict)
-                start_time = time.time()
+            })
+
+        try:
+            if check_counter(step+1, config.profile_interval):
+                outs, input_time, compute_time = run_profiled_step(sess, batch_tensors, fetch_dict, feed_dict,
+                                                                   ops['accum_op'], config.accum_steps)
+                step_timer.add_profile(input_time, compute_time)
+            else:
+                step_timer.tic()
+                run_accumulation(sess, ops['accum_op'], config.accum_steps, feed_dict)
                 outs = sess.run(fetch_dict, feed_dict=feed_dict)
-                elapsed_time = time.time() - start_time
+                step_timer.toc()
+            # global_step after this update (counted in python to avoid fetching it, unless distributed)
+            step = int(outs['step']) if dist.enabled else step + 1
+        except:
+            print('Error happens but keep training...')
+            num_failed += 1
+            continue
+
+        if 'summary' in outs:
+            try:
                 train_writer.add_summary(outs['summary'], step) # save summary
-                summaries = [tf.Summary.Value(tag='sec/step', simple_value=elapsed_time)]
+                stats = step_timer.get_stats() # rolling average of the training steps
+                summaries = [tf.Summary.Value(tag='throughput/'+k, simple_value=v) for k, v in stats.items()]
                 train_writer.add_summary(tf.Summary(value=summaries), global_step=step)
                 train_writer.flush()
 
-                print('[Train] {}step Loss: {:g}, Top1: {:g}, Top5: {:g} ({:.1f}sec)'.format(
+                print('[Train] {}step Loss: {:g}, Top1: {:g}, Top5: {:g} ({:.3f}sec/step, {:.1f}examples/sec, input-bound {:.2f})'.format(
                             step,
                             outs['loss'], outs['top1'], outs['top5'],
-                            elapsed_time))
+                            stats['sec_per_step'], stats['examples_per_sec'], stats['input_bound_ratio']))
+                metrics_logger.log(step, 'train', loss=outs['loss'], top1=outs['top1'], top5=outs['top5'], **stats)
             except:
                 print('Error happens but keep training...')
 
@@ -302,8 +351,12 @@ def main(config):
         #     # print('#{}step Save latest model'.format(step))
         #     best_saver.save(sess, os.path.join(log_dir, 'models-best'), global_step=step, write_meta_graph=False)
 
-        if check_counter(step, valid_interval):
+        if passed_counter(prev_step, step, valid_interval):
             eval_one_epoch(sess, ops, va_params)
+            if os.path.exists(os.path.join(log_dir, STOP_FILE)):
+                # created by asha_scheduler.py when this run is worse than its siblings
+                print('Find {}, stop training at #step={}'.format(os.path.join(log_dir, STOP_FILE), step))
+                break
 
 if __name__ == '__main__':
 
@@ -313,6 +366,8 @@ if __name__ == '__main__':
     general_arg = add_argument_group('General', parser)
     general_arg.add_argument('--num_threads', type=int, default=8,
                             help='the number of threads (for dataset)')
+    add_runtime_arguments(parser)
+    add_distributed_arguments(parser)
 
     train_arg = add_argument_group('Train', parser)
     train_arg.add_argument('--log_dir', type=str, default='logs/imagenet',
@@ -325,8 +380,12 @@ if __name__ == '__main__':
                             help='show variable / gradient histograms on tensorboard (consume a lot of disk space)')
     train_arg.add_argument('--max_itr', type=int, default=1000000,
                             help='max epoch')
+    train_arg.add_argument('--profile_interval', type=int, default=100,
+                            help='split every N-th step into input wait and compute (0: disable)')
     train_arg.add_argument('--batch_size', type=int, default=32,
                             help='batch size')
+    train_arg.add_argument('--accum_steps', type=int, default=1,
+                            help='accumulate gradients of N batches before each update (effective batch size: batch_size*N)')
     train_arg.add_argument('--optim_method', type=str, default='adam',
                             help='adam, momentum, ftrl, rmsprop')
     train_arg.add_argument('--lr', type=float, default=1e-3,
@@ -339,6 +398,8 @@ if __name__ == '__main__':
     dataset_arg = add_argument_group('Dataset', parser)
     dataset_arg.add_argument('--imagenet_dir', type=str, default='/cvlabdata1/home/ono/datasets/imagenet',
                             help='imagenet root directory')
+    dataset_arg.add_argument('--tuned_pipeline', type=str2bool, default=False,
+                            help='prefetch, fused map_and_batch and small-buffer shuffle of a pre-shuffled index (training set)')
 
     net_arg = add_argument_group('Network', parser)
     net_arg.add_argument('--model', type=str, default='custom_alexnet',
@@ -0,0 +1,115 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+class FeatureCache(object):
+    """LRU cache of backbone embeddings of search images (in memory, optionally backed by disk).
+
+    The search images only depend on the frame, the target box and the scale step,
+    so runs which share a tracking state (e.g. trials of a parameter sweep, or
+    re-evaluations of the same checkpoint) can skip the backbone forward pass
+    by feeding the cached embeddings.
+
+    Args:
+        max_entries: max number of embeddings kept in memory
+        cache_dir: if given, embeddings are also stored as <cache_dir>/<checkpoint_hash>/<key_hash>.npy
+        checkpoint_hash: identifies the weights (see utils.restore_utils.get_checkpoint_hash)
+        quant: if > 0, target boxes are snapped to a grid of quant pixels,
+               so that nearly identical crops share an entry
+    """
+
+    def __init__(self, max_entries=2000, cache_dir=None, checkpoint_hash='', quant=0.0):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.checkpoint_hash = checkpoint_hash
+        self.quant = quant
+        self.cache_dir = None
+        if cache_dir:
+            self.cache_dir = os.path.join(cache_dir, checkpoint_hash or 'default')
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_mem_hits = 0
+        self.num_disk_hits = 0
+        self.num_misses = 0
+
+    def quantize(self, target_bbox):
+        # Return the target box which is actually fed, so that the crop matches the key
+        if self.quant > 0:
+            return [float(np.round(x / self.quant) * self.quant) for x in target_bbox]
+        return target_bbox
+
+    def get_key(self, image_path, target_bbox, scale_step):
+        return (self.checkpoint_hash, image_path,
+                tuple(float(x) for x in self.quantize(target_bbox)), float(scale_step))
+
+    def _get_filename(self, key):
+        key_hash = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key_hash + '.npy')
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+            self.num_mem_hits += 1
+            return value
+        if self.cache_dir is not None:
+            filename = self._get_filename(key)
+            if os.path.exists(filename):
+                try:
+                    value = np.load(filename)
+                except (IOError, ValueError):
+                    value = None # broken file (e.g. killed while writing)
+                if value is not None:
+                    self.num_disk_hits += 1
+                    self._put_memory(key, value)
+                    return value
+        self.num_misses += 1
+        return None
+
+    def _put_memory(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def put(self, key, value):
+        self._put_memory(key, value)
+        if self.cache_dir is not None:
+            filename = self._get_filename(key)
+            tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+            with open(tmp_filename, 'wb') as f:
+                np.save(f, value)
+            os.rename(tmp_filename, filename) # atomic, concurrent runs may share cache_dir
+
+    def clear(self):
+        # Only clear the memory tier, disk entries stay valid for later runs
+        self.entries.clear()
+
+    def get_stats(self):
+        num_queries = self.num_mem_hits + self.num_disk_hits + self.num_misses
+        hit_rate = (self.num_mem_hits + self.num_disk_hits) / num_queries if num_queries > 0 else 0.0
+        return {
+            'queries': num_queries,
+            'mem_hits': self.num_mem_hits,
+            'disk_hits': self.num_disk_hits,
+            'misses': self.num_misses,
+            'hit_rate': hit_rate,
+        }
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print('[FeatureCache] #queries={} mem_hits={} disk_hits={} misses={} hit_rate={:.3f}'.format(
+                stats['queries'], stats['mem_hits'], stats['disk_hits'], stats['misses'], stats['hit_rate']))
@@ -15,6 +15,7 @@ import tensorflow as tf
 from utils.misc import *
 from models import *
 from cf_utils import *
+from utils.precision_utils import call_backbone
 
 class InferenceCFCF():
 
@@ -29,6 +30,8 @@ class InferenceCFCF():
         self.model_config = None
         self.track_config = None
         self.response_up = None
+        self.feature_cache = None # FeatureCache to skip backbone on repeated crops
+        self.fetch_embeds = False # return the embeddings of search images (e.g. for the scale filter)
 
         if config.backbone == 'vgg16':
             self.backbone = vgg.vgg_16
@@ -47,10 +50,10 @@ class InferenceCFCF():
         # Filter out State variables
         variables_to_restore_filterd = {}
         for key, value in variables_to_restore.items():
-            print(key)
             if key.split('/')[1] != 'State':
                 variables_to_restore_filterd[key] = value
 
+        print('#variables to restore = {}'.format(len(variables_to_restore_filterd)))
         return variables_to_restore_filterd
 
     def build_model(self):
@@ -95,7 +98,9 @@ class InferenceCFCF():
         num_scales = config.num_scales # 3
         scales = np.arange(num_scales) - get_center(num_scales) # [-1,0,1]
         assert np.sum(scales) == 0, 'scales should be symmetric'
-        search_factors = [config.scale_step ** x for x in scales] # scale_step=1.0375, [0.9638554216867469, 1.0, 1.0375]
+        # scale_step is fed at run time so that it can be changed without rebuilding the graph
+        self.scale_step = tf.placeholder_with_default(np.float32(config.scale_step), [], name='scale_step_feed')
+        search_factors = [self.scale_step ** float(x) for x in scales] # scale_step=1.0375, [0.9638554216867469, 1.0, 1.0375]
 
         frame_sz = tf.shape(self.image)
         target_yx = self.target_bbox_feed[0:2] #y,x
@@ -153,9 +158,16 @@ class InferenceCFCF():
         print('Subtract ImageNet mean')
         images = images - imgnet_mean
 
-        _, endpoints = self.backbone(images, is_training=False, reuse=reuse)
+        feat_layers = parse_feat_layers(self.config.feat_layer)
+        _, endpoints = call_backbone(self.backbone, images, getattr(self.config, 'precision', 'fp32'), is_training=False, reuse=reuse,
+                                     output_layer=get_deepest_layer(feat_layers))
 
-        embed = endpoints[self.config.feat_layer]
+        if len(feat_layers) > 1:
+            # layer-major [L*N,H,W,C] on the grid of the first layer, one CF solve for all the layers
+            feats_list = [endpoints[layer] for layer in feat_layers]
+            embed = stack_layer_features(feats_list, feats_list[0].get_shape().as_list()[1:3])
+        else:
+            embed = endpoints[feat_layers[0]]
 
         emb_height, emb_width = embed.get_shape().as_list()[1:3]
         cyclic_window = self.get_hanning_tensor(emb_height, emb_width)
@@ -176,16 +188,21 @@ class InferenceCFCF():
         tf.summary.image('template_images', exemplar_images)
         feat_maps = self.get_image_embedding(exemplar_images)
 
+        # the template of every layer comes from the center scale: [L*num_scales,H,W,C]
+        num_layers = len(parse_feat_layers(config.feat_layer))
         center_scale = int(get_center(num_scales))
-        center_feat_maps = tf.identity(feat_maps[center_scale])
-        feat_maps = tf.stack([center_feat_maps for _ in range(num_scales)])
+        feat_shape = feat_maps.get_shape().as_list()[1:]
+        feat_maps = tf.reshape(feat_maps, [num_layers, num_scales] + feat_shape)
+        center_feat_maps = tf.identity(feat_maps[:, center_scale])
+        feat_maps = tf.reshape(tf.stack([center_feat_maps for _ in range(num_scales)], axis=1),
+                               [num_layers*num_scales] + feat_shape)
 
         # Correlation Filter
         im_size, _ = exemplar_images.get_shape().as_list()[1:3]
         feat_size, _ = feat_maps.get_shape().as_list()[1:3]
         gauss_response = get_template_correlation_response(im_size=im_size, out_size=[feat_size, feat_size])
         GZ = tf.convert_to_tensor(gauss_response[None,...,None]) # [1,H,W,1]
-        GZ = tf.tile(GZ, [num_scales,1,1,1]) # [B,H,W,1]
+        GZ = tf.tile(GZ, [num_layers*num_scales,1,1,1]) # [B,H,W,1]
 
         FZ = batch_fft2d(feat_maps)
         FGZ = batch_fft2d(GZ) # centerized
@@ -197,6 +214,7 @@ class InferenceCFCF():
 
         with tf.variable_scope('target_template'):
             # Store template in Variable such that we don't have to feed this template every time.
+            # With several feat_layers it holds the spectrum of every layer (layer-major).
             with tf.variable_scope('State'):
                 state = tf.get_variable('exemplar',
                                         initializer=tf.zeros(templates.get_shape().as_list(), dtype=templates.dtype),
@@ -204,17 +222,24 @@ class InferenceCFCF():
                 with tf.control_dependencies([templates]):
                     self.init = tf.assign(state, templates, validate_shape=True) # if you run 'init', template value will be hold
             self.templates = state
-            self.update_op = tf.assign(state, config.update_rate*self.templates+(1.0-config.update_rate)*self.templates_feed)
+            self.update_rate = tf.placeholder_with_default(np.float32(config.update_rate), [], name='update_rate_feed')
+            update_rate = tf.cast(self.update_rate, tf.complex64)
+            self.update_op = tf.assign(state, update_rate*self.templates+(1.0-update_rate)*self.templates_feed)
 
     def build_detection(self):
         config = self.config
         tf.summary.image('search_images', self.search_images)
         feat_maps = self.get_image_embedding(self.search_images, reuse=True)
+        self.embeds = feat_maps
 
         # Apply correlation filter on frequency domain
         FX = batch_fft2d(feat_maps)
         FH = self.templates
         self.response = tf.reduce_sum(tf.real(batch_ifft2d(tf.conj(FH) * FX)), axis=-1, keep_dims=True)
+        feat_layers = parse_feat_layers(config.feat_layer)
+        if len(feat_layers) > 1:
+            self.response = fuse_layer_responses(self.response, parse_layer_weights(
+                                    getattr(config, 'feat_layer_weights', ''), len(feat_layers))) # [num_scales,H,W,1]
         # MMR
         max_vals = tf.reduce_max(self.response, axis=[1,2,3])
         mean_vals = tf.reduce_mean(self.response, axis=[1,2,3])
@@ -241,12 +266,16 @@ class InferenceCFCF():
             tf.summary.histogram('response_up', response_up)
             self.response_up = response_up
 
+    def get_feed_dict(self, image_path, target_bbox):
+        return {'filename:0': image_path,
+                'target_bbox_feed:0': target_bbox,
+                'scale_step_feed:0': self.config.scale_step, }
+
     def initialize(self, sess, input_feed):
         image_path, target_bbox = input_feed
 
         scale_xs, _, summaries = sess.run([self.scale_xs, self.init, self.summary_op],
-                                feed_dict={'filename:0': image_path,
-                                "target_bbox_feed:0": target_bbox, })
+                                feed_dict=self.get_feed_dict(image_path, target_bbox))
         if self.summary_writer is not None:
             self.summary_writer.add_summary(summaries, self.summary_count)
             self.summary_count += 1
@@ -256,11 +285,28 @@ class InferenceCFCF():
         image_path, target_bbox = input_feed
         log_level = self.config.log_level
         image_cropped_op = self.search_images if log_level > 0 else self.dumb_op
-        image_cropped, scale_xs, response_output, MMRs, summaries = sess.run(
-                fetches=[image_cropped_op, self.scale_xs, self.response_up, self.MMRs, self.summary_op],
-                feed_dict={
-                    "filename:0": image_path,
-                    "target_bbox_feed:0": target_bbox, })
+        if self.feature_cache is not None:
+            target_bbox = self.feature_cache.quantize(target_bbox)
+        feed_dict = self.get_feed_dict(image_path, target_bbox)
+
+        # Feed cached embeddings (if any) instead of running the backbone
+        cache_key = None
+        embeds = None
+        if self.feature_cache is not None:
+            cache_key = self.feature_cache.get_key(image_path, target_bbox, self.config.scale_step)
+            embeds = self.feature_cache.get(cache_key)
+        if embeds is not None:
+            feed_dict[self.embeds] = embeds
+            embeds_op = self.dumb_op
+        else:
+            embeds_op = self.embeds if cache_key is not None or self.fetch_embeds else self.dumb_op
+
+        image_cropped, scale_xs, response_output, MMRs, summaries, embeds_out = sess.run(
+                fetches=[image_cropped_op, self.scale_xs, self.response_up, self.MMRs, self.summary_op, embeds_op],
+                feed_dict=feed_dict)
+
+        if cache_key is not None and embeds is None:
+            self.feature_cache.put(cache_key, embeds_out)
 
         if self.summary_writer is not None:
             self.summary_writer.add_summary(summaries, self.summary_count)
@@ -269,6 +315,8 @@ class InferenceCFCF():
         output = {
           'image_cropped': image_cropped,
           'scale_xs': scale_xs,
+          'target_bbox': target_bbox, # box which was fed (snapped to the grid of the feature cache)
+          'embeds': embeds if embeds is not None else embeds_out,
           'response': response_output,
           'MMRs': MMRs,}
         return output, None
@@ -277,9 +325,9 @@ class InferenceCFCF():
         image_path, target_bbox = input_feed
         print(image_path)
         templates = sess.run(self.templates_out,
-                                feed_dict={'filename:0': image_path,
-                                "target_bbox_feed:0": target_bbox, })
-        sess.run(self.update_op, feed_dict={'templates_feed:0': templates})
+                                feed_dict=self.get_feed_dict(image_path, target_bbox))
+        sess.run(self.update_op, feed_dict={'templates_feed:0': templates,
+                                            'update_rate_feed:0': self.config.update_rate, })
                                 
 
 
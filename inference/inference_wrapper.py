@@ -15,6 +15,7 @@ import tensorflow as tf
 from utils.misc import *
 from models import *
 from cf_utils import *
+from utils.precision_utils import call_backbone
 
 class InferenceWrapper():
 
@@ -29,6 +30,8 @@ class InferenceWrapper():
         self.model_config = None
         self.track_config = None
         self.response_up = None
+        self.feature_cache = None # FeatureCache to skip backbone on repeated crops
+        self.fetch_embeds = False # return the embeddings of search images (e.g. for the scale filter)
 
         if config.backbone == 'alexnet':
             self.backbone = alexnet
@@ -44,10 +47,10 @@ class InferenceWrapper():
         # Filter out State variables
         variables_to_restore_filterd = {}
         for key, value in variables_to_restore.items():
-            print(key)
             if key.split('/')[1] != 'State':
                 variables_to_restore_filterd[key] = value
 
+        print('#variables to restore = {}'.format(len(variables_to_restore_filterd)))
         return variables_to_restore_filterd
 
 
@@ -96,7 +99,9 @@ class InferenceWrapper():
         num_scales = config.num_scales # 3
         scales = np.arange(num_scales) - get_center(num_scales) # [-1,0,1]
         assert np.sum(scales) == 0, 'scales should be symmetric'
-        search_factors = [config.scale_step ** x for x in scales] # scale_step=1.0375, [0.9638554216867469, 1.0, 1.0375]
+        # scale_step is fed at run time so that it can be changed without rebuilding the graph
+        self.scale_step = tf.placeholder_with_default(np.float32(config.scale_step), [], name='scale_step_feed')
+        search_factors = [self.scale_step ** float(x) for x in scales] # scale_step=1.0375, [0.9638554216867469, 1.0, 1.0375]
 
         frame_sz = tf.shape(self.image)
         target_yx = self.target_bbox_feed[0:2] #y,x
@@ -140,7 +145,7 @@ class InferenceWrapper():
 
 
     def get_image_embedding(self, images, reuse=None):
-        embed, _ = self.backbone(images, is_training=False, reuse=reuse)
+        embed, _ = call_backbone(self.backbone, images, getattr(self.config, 'precision', 'fp32'), is_training=False, reuse=reuse)
 
         return embed
 
@@ -212,12 +217,16 @@ class InferenceWrapper():
             tf.summary.histogram('response_up', response_up)
             self.response_up = response_up
 
+    def get_feed_dict(self, image_path, target_bbox):
+        return {'filename:0': image_path,
+                'target_bbox_feed:0': target_bbox,
+                'scale_step_feed:0': self.config.scale_step, }
+
     def initialize(self, sess, input_feed):
         image_path, target_bbox = input_feed
 
         scale_xs, _, summaries = sess.run([self.scale_xs, self.init, self.summary_op],
-                                feed_dict={'filename:0': image_path,
-                                "target_bbox_feed:0": target_bbox, })
+                                feed_dict=self.get_feed_dict(image_path, target_bbox))
         if self.summary_writer is not None:
             self.summary_writer.add_summary(summaries, self.summary_count)
             self.summary_count += 1
@@ -227,11 +236,28 @@ class InferenceWrapper():
         image_path, target_bbox = input_feed
         log_level = self.config.log_level
         image_cropped_op = self.search_images if log_level > 0 else self.dumb_op
-        image_cropped, scale_xs, response_output, summaries = sess.run(
-                fetches=[image_cropped_op, self.scale_xs, self.response_up, self.summary_op],
-                feed_dict={
-                    "filename:0": image_path,
-                    "target_bbox_feed:0": target_bbox, })
+        if self.feature_cache is not None:
+            target_bbox = self.feature_cache.quantize(target_bbox)
+        feed_dict = self.get_feed_dict(image_path, target_bbox)
+
+        # Feed cached embeddings (if any) instead of running the backbone
+        cache_key = None
+        embeds = None
+        if self.feature_cache is not None:
+            cache_key = self.feature_cache.get_key(image_path, target_bbox, self.config.scale_step)
+            embeds = self.feature_cache.get(cache_key)
+        if embeds is not None:
+            feed_dict[self.embeds] = embeds
+            embeds_op = self.dumb_op
+        else:
+            embeds_op = self.embeds if cache_key is not None or self.fetch_embeds else self.dumb_op
+
+        image_cropped, scale_xs, response_output, summaries, embeds_out = sess.run(
+                fetches=[image_cropped_op, self.scale_xs, self.response_up, self.summary_op, embeds_op],
+                feed_dict=feed_dict)
+
+        if cache_key is not None and embeds is None:
+            self.feature_cache.put(cache_key, embeds_out)
 
         if self.summary_writer is not None:
             self.summary_writer.add_summary(summaries, self.summary_count)
@@ -240,6 +266,8 @@ class InferenceWrapper():
         output = {
           'image_cropped': image_cropped,
           'scale_xs': scale_xs,
+          'target_bbox': target_bbox, # box which was fed (snapped to the grid of the feature cache)
+          'embeds': embeds if embeds is not None else embeds_out,
           'response': response_output}
         return output, None
 
@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class ScaleFilter(object):
+    """DSST-style 1-D correlation filter over a pyramid of target scales.
+
+    The samples are taken from the backbone embeddings of the (single-scale)
+    search image which the translation step already computed: for every scale
+    factor, the feature map is bilinearly sampled on a patch_size x patch_size
+    grid covering the target box scaled by that factor, and the flattened
+    patches form the columns of a [D, num_scales] sample. The filter is learned
+    and applied by 1-D FFTs along the scale axis, which costs a few microseconds
+    compared to a backbone pass per scale.
+
+    Args:
+        image_size: size of the search image in pixels (x_image_size)
+        num_scales: number of scale factors (33 in DSST)
+        scale_step: ratio between neighbouring scale factors
+        sigma_factor: width of the desired gaussian response (relative to sqrt(num_scales))
+        learning_rate: linear interpolation rate of the filter update
+        reglambda: regularization of the filter denominator
+        patch_size: grid size of the sampled feature patch per scale
+    """
+
+    def __init__(self, image_size, num_scales=33, scale_step=1.02, sigma_factor=0.25,
+                 learning_rate=0.025, reglambda=0.01, patch_size=4):
+        self.image_size = image_size
+        self.num_scales = num_scales
+        self.learning_rate = learning_rate
+        self.reglambda = reglambda
+        self.patch_size = patch_size
+
+        scale_offsets = np.arange(num_scales) - (num_scales - 1) // 2
+        self.scale_factors = scale_step ** scale_offsets.astype(np.float64)
+        sigma = np.sqrt(num_scales) * sigma_factor
+        desired = np.exp(-0.5 * np.square(scale_offsets) / sigma**2)
+        self.desired_f = np.fft.fft(np.roll(desired, -((num_scales - 1) // 2))) # peak at index 0
+        self.window = np.hanning(num_scales + 2)[1:-1] if num_scales > 1 else np.ones(1) # no zero weights
+        self.numerator = None
+        self.denominator = None
+
+    def get_samples(self, embeds, pos, target_size):
+        """Scale samples [D, num_scales] of the target at pos (y, x) with size (h, w) in search image pixels.
+
+        embeds: [N,H,W,C] embeddings of the search image (N layers or crops are concatenated along C)
+        """
+        embeds = np.asarray(embeds, dtype=np.float32)
+        num, height, width, channels = embeds.shape
+        feats = embeds.transpose(1, 2, 0, 3).reshape(height, width, num * channels)
+
+        # search image pixels --> feature map coordinates
+        ratio = np.array([height, width], dtype=np.float64) / self.image_size
+        center = (np.asarray(pos, dtype=np.float64) + 0.5) * ratio - 0.5
+        size = np.asarray(target_size, dtype=np.float64) * ratio
+
+        grid = (np.arange(self.patch_size) + 0.5) / self.patch_size - 0.5 # [-0.5, 0.5)
+        ys = center[0] + self.scale_factors[:, None] * size[0] * grid[None, :] # [S,P]
+        xs = center[1] + self.scale_factors[:, None] * size[1] * grid[None, :]
+        ys = np.clip(ys, 0, height - 1)
+        xs = np.clip(xs, 0, width - 1)
+        y0 = np.minimum(np.floor(ys).astype(np.int64), height - 2) if height > 1 else np.zeros_like(ys, np.int64)
+        x0 = np.minimum(np.floor(xs).astype(np.int64), width - 2) if width > 1 else np.zeros_like(xs, np.int64)
+        y1 = np.minimum(y0 + 1, height - 1)
+        x1 = np.minimum(x0 + 1, width - 1)
+        wy = (ys - y0)[:, :, None, None]
+        wx = (xs - x0)[:, None, :, None]
+
+        # bilinear sampling of every scale at once: [S,P,P,D]
+        patches = ((1 - wy) * (1 - wx) * feats[y0[:, :, None], x0[:, None, :]]
+                   + (1 - wy) * wx * feats[y0[:, :, None], x1[:, None, :]]
+                   + wy * (1 - wx) * feats[y1[:, :, None], x0[:, None, :]]
+                   + wy * wx * feats[y1[:, :, None], x1[:, None, :]])
+        samples = patches.reshape(self.num_scales, -1).T # [D,S]
+        return samples * self.window[None, :]
+
+    def _learn(self, samples):
+        samples_f = np.fft.fft(samples, axis=1)
+        numerator = np.conj(self.desired_f)[None, :] * samples_f
+        denominator = np.sum(np.real(samples_f * np.conj(samples_f)), axis=0)
+        return numerator, denominator
+
+    def initialize(self, embeds, pos, target_size):
+        self.numerator, self.denominator = self._learn(self.get_samples(embeds, pos, target_size))
+
+    def estimate(self, embeds, pos, target_size):
+        """Return the scale factor of the target (relative to target_size) with the highest filter response"""
+        samples_f = np.fft.fft(self.get_samples(embeds, pos, target_size), axis=1)
+        response = np.real(np.fft.ifft(np.sum(np.conj(self.numerator) * samples_f, axis=0)
+                                       / (self.denominator + self.reglambda)))
+        return self.scale_factors[(np.argmax(response) + (self.num_scales - 1) // 2) % self.num_scales]
+
+    def update(self, embeds, pos, target_size):
+        numerator, denominator = self._learn(self.get_samples(embeds, pos, target_size))
+        rate = self.learning_rate
+        self.numerator = (1 - rate) * self.numerator + rate * numerator
+        self.denominator = (1 - rate) * self.denominator + rate * denominator
@@ -14,6 +14,7 @@ from cv2 import imwrite
 
 from cf_utils import *
 from utils.misc import get_center
+from inference.scale_filter import ScaleFilter
 
 
 class TargetState(object):
@@ -32,7 +33,15 @@ class Tracker(object):
         self.siamese_model = siamese_model
         self.config = config
 
-        self.num_scales = self.config.num_scales
+        self.scale_estimator = getattr(self.config, 'scale_estimator', 'pyramid')
+        if self.scale_estimator == 'pyramid':
+            self.num_scales = self.config.num_scales
+        elif self.scale_estimator == 'dsst':
+            # single-scale search image, the scale is estimated by the 1-D scale filter
+            self.num_scales = 1
+        else:
+            raise ValueError('Unknown scale_estimator: {} (pyramid|dsst)'.format(self.scale_estimator))
+        self.scale_filter = None
         logging.info('track num scales -- {}'.format(self.num_scales))
         scales = np.arange(self.num_scales) - get_center(self.num_scales)
         self.search_factors = [self.config.scale_step ** x for x in scales]
@@ -56,6 +65,19 @@ class Tracker(object):
         input_feed = [frames[0], bbox_feed]
         frame2crop_scale = self.siamese_model.initialize(sess, input_feed)
 
+        if self.scale_estimator == 'dsst':
+            # learn the scale filter on the embeddings of the first search image
+            self.siamese_model.fetch_embeds = True
+            outputs, _ = self.siamese_model.inference_step(sess, input_feed)
+            self.scale_filter = ScaleFilter(self.x_image_size,
+                                            num_scales=self.config.dsst_num_scales,
+                                            scale_step=self.config.dsst_scale_step,
+                                            learning_rate=self.config.dsst_learning_rate,
+                                            patch_size=self.config.dsst_patch_size)
+            fed_bbox = outputs['target_bbox'] # y, x, height, width
+            self.scale_filter.initialize(outputs['embeds'], [get_center(self.x_image_size)] * 2,
+                                         np.array(fed_bbox[2:4]) * outputs['scale_xs'][0])
+
         # Storing target state
         original_target_height = bbox.height
         original_target_width = bbox.width
@@ -83,6 +105,8 @@ class Tracker(object):
 
                 outputs, metadata = self.siamese_model.inference_step(sess, input_feed)
                 search_scale_list = outputs['scale_xs']
+                # the search images are centered and scaled on the fed box (snapped if the feature cache quantizes)
+                fed_y, fed_x, fed_height, fed_width = outputs['target_bbox']
                 response = outputs['response']
                 response_size = response.shape[1]
 
@@ -135,16 +159,22 @@ class Tracker(object):
                 # ... in instance original crop (in frame coordinates)
                 disp_instance_frame = disp_instance_input / search_scale_list[best_scale]
                 # Position within frame in frame coordinates
-                y = current_target_state.bbox.y
-                x = current_target_state.bbox.x
+                y = fed_y
+                x = fed_x
                 y += disp_instance_frame[0]
                 x += disp_instance_frame[1]
 
                 # Target scale damping and saturation
-                target_scale = current_target_state.bbox.height / original_target_height
-                search_factor = self.search_factors[best_scale]
-                scale_damp = self.config.scale_damp  # damping factor for scale update
-                target_scale *= ((1 - scale_damp) * 1.0 + scale_damp * search_factor)
+                target_scale = fed_height / original_target_height
+                search_pos = search_center + disp_instance_input
+                if self.scale_filter is not None:
+                    # scale filter at the new position, applied without damping as in DSST
+                    target_size_search = np.array([fed_height, fed_width]) * search_scale_list[0]
+                    target_scale *= self.scale_filter.estimate(outputs['embeds'], search_pos, target_size_search)
+                else:
+                    search_factor = self.search_factors[best_scale]
+                    scale_damp = self.config.scale_damp  # damping factor for scale update
+                    target_scale *= ((1 - scale_damp) * 1.0 + scale_damp * search_factor)
                 target_scale = np.maximum(0.2, np.minimum(5.0, target_scale))
 
                 # Some book keeping
@@ -152,7 +182,10 @@ class Tracker(object):
                 width = original_target_width * target_scale
                 current_target_state.bbox = Rectangle(x, y, width, height)
                 current_target_state.scale_idx = best_scale
-                current_target_state.search_pos = search_center + disp_instance_input
+                current_target_state.search_pos = search_pos
+                if self.scale_filter is not None:
+                    self.scale_filter.update(outputs['embeds'], search_pos,
+                                             np.array([height, width]) * search_scale_list[0])
 
                 assert 0 <= current_target_state.search_pos[0] < self.x_image_size, \
                   'target position in feature space should be no larger than input image size'
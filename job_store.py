@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""SQLite backend of the job history used by run.py (--history=sqlite).
+
+Every run of a job is a row of the `runs` table, indexed by status and job,
+so state changes are single-row updates instead of rewriting jobs/HISTORY.
+The database is opened in WAL mode: readers never block the runners, and
+writers only serialize for the few milliseconds of a transaction.
+
+    python job_store.py --jobdir=jobs --migrate      # import jobs/HISTORY
+    python job_store.py --jobdir=jobs --status=RUNNING
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+
+STATUSES = ['READY', 'RUNNING', 'DONE', 'FAIL']
+
+def get_server_info():
+    hostname = os.uname()[1]
+    gpu_id = os.getenv('CUDA_VISIBLE_DEVICES')
+    if gpu_id is None:
+        gpu_id = -1
+    return hostname, int(gpu_id)
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True # owned by another user
+    return True
+
+class SQLiteJobStore(object):
+    def __init__(self, db_file, timeout=60):
+        self.db_file = db_file
+        # autocommit mode, transactions are opened explicitly with BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(db_file, timeout=timeout, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS runs (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                job TEXT NOT NULL,
+                                directory TEXT NOT NULL,
+                                status TEXT NOT NULL,
+                                time TEXT NOT NULL,
+                                updated REAL NOT NULL,
+                                hostname TEXT,
+                                gpu INTEGER,
+                                pid INTEGER)''')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(runs)')]
+        if 'pid' not in columns: # database of an older run.py
+            self.conn.execute('ALTER TABLE runs ADD COLUMN pid INTEGER')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS runs_status ON runs(status)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS runs_job ON runs(job)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS runs_job_time ON runs(job, time)')
+        self.run_ids = {} # job -> id of the run started by this process
+
+    def close(self):
+        self.conn.close()
+
+    def claim(self, job, todo_dir, queue_dir):
+        """Move job from todo_dir to queue_dir and register it as READY.
+
+        The rename is the claim: only one runner can move the file, the rows of
+        earlier runs of the same job (e.g. killed runners) do not matter.
+        Return False if the job was already taken by another runner.
+        """
+        hostname, gpu_id = get_server_info()
+        try:
+            os.rename(os.path.join(todo_dir, job), os.path.join(queue_dir, job))
+        except OSError:
+            return False
+        cur = self.conn.execute('INSERT INTO runs (job, directory, status, time, updated, hostname, gpu, pid) VALUES (?,?,?,?,?,?,?,?)',
+                                (job, queue_dir, 'READY', time.asctime(), time.time(), hostname, gpu_id, os.getpid()))
+        self.run_ids[job] = cur.lastrowid
+        return True
+
+    def mark_stale(self):
+        """Mark READY/RUNNING runs whose runner is gone as FAIL.
+
+        A run is stale if it was imported by migrate_history (no pid) or its
+        runner process on this host has exited. Runs of other hosts are kept.
+        Return: the number of runs marked as FAIL
+        """
+        hostname, _ = get_server_info()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self.conn.execute("SELECT id, hostname, pid FROM runs WHERE status IN ('READY','RUNNING')").fetchall()
+            stale_ids = [(run_id,) for run_id, run_host, pid in rows
+                            if pid is None or (run_host == hostname and not is_alive(pid))]
+            self.conn.executemany("UPDATE runs SET status='FAIL' WHERE id=?", stale_ids)
+            self.conn.execute('COMMIT')
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+        return len(stale_ids)
+
+    def update(self, job, next_dir, status):
+        hostname, gpu_id = get_server_info()
+        self.conn.execute('UPDATE runs SET directory=?, status=?, time=?, updated=?, hostname=?, gpu=? WHERE id=?',
+                          (next_dir, status, time.asctime(), time.time(), hostname, gpu_id, self.run_ids[job]))
+
+    def count(self, status):
+        return self.conn.execute('SELECT COUNT(*) FROM runs WHERE status=?', (status,)).fetchone()[0]
+
+    def list_runs(self, status=None):
+        # Return: list of (time, job, directory, status, hostname, gpu)
+        query = 'SELECT time, job, directory, status, hostname, gpu FROM runs'
+        if status is not None:
+            return self.conn.execute(query + ' WHERE status=? ORDER BY updated', (status,)).fetchall()
+        return self.conn.execute(query + ' ORDER BY updated').fetchall()
+
+    def migrate_history(self, history_file):
+        """Import the text HISTORY written by run.py (one line per run).
+
+        Runs already in the database (same job and time) are skipped, so importing twice is harmless.
+        Return: the number of imported runs
+        """
+        rows = []
+        with open(history_file, 'r') as f:
+            for line in f:
+                tokens = line.split()
+                if len(tokens) < 10:
+                    continue
+                curr_time = ' '.join(tokens[:5]) # time.asctime() e.g. Mon Oct 19 02:51:58 2026
+                job, directory, status, hostname, gpu_id = tokens[5:10]
+                try:
+                    updated = time.mktime(time.strptime(curr_time))
+                except ValueError:
+                    updated = 0.0
+                rows.append((job, directory, status, curr_time, updated, hostname, int(gpu_id)))
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            seen = set(self.conn.execute('SELECT job, time FROM runs').fetchall())
+            new_rows = []
+            for row in rows:
+                if (row[0], row[3]) not in seen:
+                    seen.add((row[0], row[3]))
+                    new_rows.append(row)
+            self.conn.executemany('INSERT INTO runs (job, directory, status, time, updated, hostname, gpu) VALUES (?,?,?,?,?,?,?)', new_rows)
+            self.conn.execute('COMMIT')
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+        return len(new_rows)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--jobdir', type=str, default='jobs',
+                            help='where to place the jobs')
+    parser.add_argument('--migrate', action='store_const',
+                            const=True, default=False,
+                            help='import jobdir/HISTORY into jobdir/HISTORY.db')
+    parser.add_argument('--status', type=str, default='',
+                            help='list runs of this status (READY|RUNNING|DONE|FAIL)')
+    config, unparsed = parser.parse_known_args()
+    if len(unparsed) > 0:
+        print('[Error] unparsed args: {}'.format(unparsed))
+        exit(1)
+
+    store = SQLiteJobStore(os.path.join(config.jobdir, 'HISTORY.db'))
+    if config.migrate:
+        num_rows = store.migrate_history(os.path.join(config.jobdir, 'HISTORY'))
+        print('Import {} runs from {}'.format(num_rows, os.path.join(config.jobdir, 'HISTORY')))
+        print('Mark {} READY/RUNNING runs without a live runner as FAIL'.format(store.mark_stale()))
+    if len(config.status) > 0:
+        for row in store.list_runs(config.status):
+            print('{} {} {} {} {} {}'.format(*row))
+    print(' '.join(['{}={}'.format(status, store.count(status)) for status in STATUSES]))
+    store.close()
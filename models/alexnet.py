@@ -18,6 +18,7 @@ from __future__ import print_function
 import logging
 import functools
 import tensorflow as tf
+from utils.precision_utils import batch_norm as fp32_batch_norm
 
 slim = tf.contrib.slim
 
@@ -75,7 +76,7 @@ def convolutional_alexnet_arg_scope(embed_config=None,
       },
       'updates_collections': None,  # Ensure that updates are done within a frame
     }
-    normalizer_fn = slim.batch_norm
+    normalizer_fn = fp32_batch_norm
   else:
     batch_norm_params = {}
     normalizer_fn = None
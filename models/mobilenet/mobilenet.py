@@ -23,6 +23,7 @@ import copy
 import os
 
 import tensorflow as tf
+from utils.precision_utils import batch_norm as fp32_batch_norm
 
 
 slim = tf.contrib.slim
@@ -422,7 +423,7 @@ def training_scope(is_training=True,
   with slim.arg_scope(
       [slim.conv2d, slim.fully_connected, slim.separable_conv2d],
       weights_initializer=weight_intitializer,
-      normalizer_fn=slim.batch_norm), \
+      normalizer_fn=fp32_batch_norm), \
       slim.arg_scope([mobilenet_base, mobilenet], is_training=is_training),\
       slim.arg_scope([slim.batch_norm], **batch_norm_params), \
       slim.arg_scope([slim.dropout], is_training=is_training,
@@ -30,6 +30,7 @@ import tensorflow as tf
 
 from models.mobilenet import conv_blocks as ops
 from models.mobilenet import mobilenet as lib
+from utils.precision_utils import batch_norm as fp32_batch_norm
 
 slim = tf.contrib.slim
 op = lib.op
@@ -42,14 +43,15 @@ V2_DEF = dict(
     defaults={
         # Note: these parameters of batch norm affect the architecture
         # that's why they are here and not in training_scope.
+        # fp32_batch_norm calls slim.batch_norm, so its defaults still apply.
         (slim.batch_norm,): {'center': True, 'scale': True},
         (slim.conv2d, slim.fully_connected, slim.separable_conv2d): {
-            'normalizer_fn': slim.batch_norm, 'activation_fn': tf.nn.relu6
+            'normalizer_fn': fp32_batch_norm, 'activation_fn': tf.nn.relu6
         },
         (ops.expanded_conv,): {
             'expansion_size': expand_input(6),
             'split_expansion': 1,
-            'normalizer_fn': slim.batch_norm,
+            'normalizer_fn': fp32_batch_norm,
             'residual': True
         },
         (slim.conv2d, slim.separable_conv2d): {'padding': 'SAME'}
@@ -2,11 +2,18 @@ import tensorflow as tf
 from .mobilenet.mobilenet_v2 import mobilenet, training_scope
 
 
-def mobilenet_v2(inputs, is_training, depth_multiplier=1.4, reuse=None, scope='MobilenetV2'):
+def mobilenet_v2(inputs, is_training, depth_multiplier=1.4, reuse=None, scope='MobilenetV2', output_layer=None):
+    # output_layer: stop at this endpoint (e.g. 'layer_14' or 'layer_14/expansion_output'), no pooling/logits
 
+    kwargs = {}
+    if output_layer is not None:
+        if output_layer.startswith(scope + '/'):
+            output_layer = output_layer[len(scope)+1:]
+        kwargs['final_endpoint'] = output_layer.split('/')[0]
+        kwargs['base_only'] = True
     with tf.contrib.slim.arg_scope(training_scope(is_training=is_training)):
         # depth_multiplier=1.4 if you load a checkpoint from MobileNet_v2_1.4_224
-        net, endpoints = mobilenet(inputs, num_classes=None, depth_multiplier=depth_multiplier, scope=scope, reuse=reuse)
+        net, endpoints = mobilenet(inputs, num_classes=None, depth_multiplier=depth_multiplier, scope=scope, reuse=reuse, **kwargs)
         var_list = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope)
         endpoints['var_list'] = var_list
         return net, endpoints
@@ -39,6 +39,7 @@ from __future__ import print_function
 
 import collections
 import tensorflow as tf
+from utils.precision_utils import batch_norm as fp32_batch_norm
 
 slim = tf.contrib.slim
 
@@ -259,7 +260,7 @@ def resnet_arg_scope(weight_decay=0.0001,
       weights_regularizer=slim.l2_regularizer(weight_decay),
       weights_initializer=slim.variance_scaling_initializer(),
       activation_fn=activation_fn,
-      normalizer_fn=slim.batch_norm if use_batch_norm else None,
+      normalizer_fn=fp32_batch_norm if use_batch_norm else None,
       normalizer_params=batch_norm_params):
     with slim.arg_scope([slim.batch_norm], **batch_norm_params):
       # The following implies padding='SAME' for pool1, which makes feature
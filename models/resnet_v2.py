@@ -51,6 +51,7 @@ from __future__ import division
 from __future__ import print_function
 
 import tensorflow as tf
+from utils.precision_utils import batch_norm as fp32_batch_norm
 
 import models.resnet_utils as resnet_utils
 
@@ -85,7 +86,7 @@ def bottleneck(inputs, depth, depth_bottleneck, stride, rate=1,
   """
   with tf.variable_scope(scope, 'bottleneck_v2', [inputs]) as sc:
     depth_in = slim.utils.last_dimension(inputs.get_shape(), min_rank=4)
-    preact = slim.batch_norm(inputs, activation_fn=tf.nn.relu, scope='preact')
+    preact = fp32_batch_norm(inputs, activation_fn=tf.nn.relu, scope='preact')
     if depth == depth_in:
       shortcut = resnet_utils.subsample(inputs, stride, 'shortcut')
     else:
@@ -117,7 +118,8 @@ def resnet_v2(inputs,
               include_root_block=True,
               spatial_squeeze=True,
               reuse=None,
-              scope=None):
+              scope=None,
+              base_only=False):
   """Generator for v2 (preactivation) ResNet models.
 
   This function generates a family of ResNet v2 models. See the resnet_v2_*()
@@ -200,10 +202,13 @@ def resnet_v2(inputs,
             net = resnet_utils.conv2d_same(net, 64, 7, stride=2, scope='conv1')
           net = slim.max_pool2d(net, [3, 3], stride=2, scope='pool1')
         net = resnet_utils.stack_blocks_dense(net, blocks, output_stride)
+        if base_only:
+          # truncated network (see output_layer of resnet_v2_50), no postnorm/pooling/logits
+          return net, slim.utils.convert_collection_to_dict(end_points_collection)
         # This is needed because the pre-activation variant does not have batch
         # normalization or activation functions in the residual unit output. See
         # Appendix of [2].
-        net = slim.batch_norm(net, activation_fn=tf.nn.relu, scope='postnorm')
+        net = fp32_batch_norm(net, activation_fn=tf.nn.relu, scope='postnorm')
         # Convert end_points_collection into a dictionary of end_points.
         end_points = slim.utils.convert_collection_to_dict(
             end_points_collection)
@@ -255,20 +260,32 @@ def resnet_v2_50(inputs,
                  output_stride=None,
                  spatial_squeeze=True,
                  reuse=None,
-                 scope='resnet_v2_50'):
-  """ResNet-50 model of [1]. See resnet_v2() for arg and return description."""
+                 scope='resnet_v2_50',
+                 output_layer=None):
+  """ResNet-50 model of [1]. See resnet_v2() for arg and return description.
+
+  output_layer: optional endpoint inside a block (e.g. 'resnet_v2_50/block3'),
+    the blocks after it, postnorm and logits are not created.
+  """
   blocks = [
       resnet_v2_block('block1', base_depth=64, num_units=3, stride=2),
       resnet_v2_block('block2', base_depth=128, num_units=4, stride=2),
       resnet_v2_block('block3', base_depth=256, num_units=6, stride=2),
       resnet_v2_block('block4', base_depth=512, num_units=3, stride=1),
   ]
+  base_only = False
+  if output_layer is not None:
+    for i, block in enumerate(blocks):
+      if output_layer.startswith('{}/{}'.format(scope, block.scope)):
+        blocks = blocks[:i+1]
+        base_only = True
+        break
 
   with slim.arg_scope(resnet_arg_scope()):
     net, end_points = resnet_v2(inputs, blocks, num_classes, is_training=is_training,
                      global_pool=global_pool, output_stride=output_stride,
                      include_root_block=True, spatial_squeeze=spatial_squeeze,
-                     reuse=reuse, scope=scope)
+                     reuse=reuse, scope=scope, base_only=base_only)
   var_list = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope)
   end_points['var_list'] = var_list
   return net, end_points
@@ -11,7 +11,8 @@ def vgg_16(inputs,
            scope='vgg_16',
            fc_conv_padding='VALID',
            global_pool=False,
-           reuse=False):
+           reuse=False,
+           output_layer=None):
     """Oxford Net VGG 16-Layers version D Example.
 
     Note: All the fully_connected layers have been transformed to conv2d layers.
@@ -36,6 +37,9 @@ def vgg_16(inputs,
     global_pool: Optional boolean flag. If True, the input to the classification
       layer is avgpooled to size 1x1, for any input size. (This is not part
       of the original VGG architecture.)
+    output_layer: Optional endpoint name (e.g. 'vgg_16/conv4/conv4_3'). If given,
+      the network is built only up to the block of this endpoint, and the layers
+      after it (and their variables) are not created.
 
     Returns:
     net: the output of the logits layer (if num_classes is a non-zero integer),
@@ -44,25 +48,40 @@ def vgg_16(inputs,
     """
     with tf.variable_scope(scope, 'vgg_16', [inputs], reuse=reuse) as sc:
         end_points_collection = sc.original_name_scope + '_end_points'
+
+        def reached(block):
+            # True if output_layer is in this block, e.g. vgg_16/conv4/conv4_3 for conv4
+            return output_layer is not None and output_layer.startswith('{}/{}'.format(sc.name, block))
+
+        def finish(net):
+            end_points = slim.utils.convert_collection_to_dict(end_points_collection)
+            var_list = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, sc.name)
+            end_points['var_list'] = var_list
+            return net, end_points
+
         # Collect outputs for conv2d, fully_connected and max_pool2d.
         with slim.arg_scope([slim.conv2d, slim.fully_connected, slim.max_pool2d],
                             outputs_collections=end_points_collection):
-            net = slim.repeat(inputs, 2, slim.conv2d, 64, [3, 3], scope='conv1')
-            net = slim.max_pool2d(net, [2, 2], scope='pool1')
-            net = slim.repeat(net, 2, slim.conv2d, 128, [3, 3], scope='conv2')
-            net = slim.max_pool2d(net, [2, 2], scope='pool2')
-            net = slim.repeat(net, 3, slim.conv2d, 256, [3, 3], scope='conv3')
-            net = slim.max_pool2d(net, [2, 2], scope='pool3')
-            net = slim.repeat(net, 3, slim.conv2d, 512, [3, 3], scope='conv4')
-            net = slim.max_pool2d(net, [2, 2], scope='pool4')
-            net = slim.repeat(net, 3, slim.conv2d, 512, [3, 3], scope='conv5')
-            net = slim.max_pool2d(net, [2, 2], scope='pool5')
+            net = inputs
+            for i, (num_convs, depth) in enumerate([(2, 64), (2, 128), (3, 256), (3, 512), (3, 512)]):
+                conv_name = 'conv{}'.format(i+1)
+                pool_name = 'pool{}'.format(i+1)
+                net = slim.repeat(net, num_convs, slim.conv2d, depth, [3, 3], scope=conv_name)
+                if reached(conv_name):
+                    return finish(net)
+                net = slim.max_pool2d(net, [2, 2], scope=pool_name)
+                if reached(pool_name):
+                    return finish(net)
             # comment out because siamse-fc template size is too small
             # Use conv2d instead of fully_connected layers.
             net = slim.conv2d(net, 4096, [7, 7], padding=fc_conv_padding, scope='fc6')
+            if reached('fc6'):
+                return finish(net)
             net = slim.dropout(net, dropout_keep_prob, is_training=is_training,
                              scope='dropout6')
             net = slim.conv2d(net, 4096, [1, 1], scope='fc7')
+            if reached('fc7'):
+                return finish(net)
             # Convert end_points_collection into a end_point dict.
             end_points = slim.utils.convert_collection_to_dict(end_points_collection)
             if global_pool:
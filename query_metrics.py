@@ -0,0 +1,61 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare many training runs from their metrics.jsonl (see utils/metrics_utils.py).
+
+    python query_metrics.py --log_dir='results/practice/CFNet/180711-cf-basic/**' --metrics=loss_ev,mean_error_dist_ev --agg=min
+"""
+from __future__ import print_function
+import os
+import sys
+import glob
+
+LOCAL_PATH = './'
+if LOCAL_PATH not in sys.path:
+    sys.path.append(LOCAL_PATH)
+
+from utils.metrics_utils import METRICS_FILE, summarize_runs
+
+def find_runs(pattern):
+    # directories which match the pattern (recursive with '**') and have metrics.jsonl
+    files = glob.glob(os.path.join(pattern, METRICS_FILE), recursive=True)
+    return sorted([os.path.dirname(x) for x in files])
+
+if __name__ == '__main__':
+
+    from utils.argparse_utils import *
+    parser = get_parser()
+    parser.add_argument('--log_dir', type=str, default='results/**',
+                        help='log directories of runs (wildcards are allowed, ** for recursive search)')
+    parser.add_argument('--phase', type=str, default='valid',
+                        help='train|valid')
+    parser.add_argument('--metrics', type=str, default='loss_ev',
+                        help='comma separated metrics to show')
+    parser.add_argument('--agg', type=str, default='last',
+                        help='last|min|max over the history of each run')
+    parser.add_argument('--sort_by', type=str, default='',
+                        help='sort runs by this metric (the first metric if empty)')
+    parser.add_argument('--descending', type=str2bool, default=False,
+                        help='larger is better')
+    parser.add_argument('--csv', type=str, default='',
+                        help='save the table as csv')
+    config, unparsed = get_config(parser)
+
+    if len(unparsed) > 0:
+        raise ValueError('Warning: miss identify argument ?? unparsed={}\n'.format(unparsed))
+
+    metrics = config.metrics.split(',')
+    sort_by = config.sort_by if len(config.sort_by) > 0 else metrics[0]
+    rows = summarize_runs(find_runs(config.log_dir), metrics, phase=config.phase, agg=config.agg)
+    rows = sorted(rows, key=lambda r: r[sort_by], reverse=config.descending)
+
+    columns = ['step'] + metrics + ['run']
+    print('  '.join(['{:>12s}'.format(c) if c != 'run' else c for c in columns]))
+    for row in rows:
+        print('  '.join(['{:>12g}'.format(row[c]) if c != 'run' else row[c] for c in columns]))
+    print('#runs = {}'.format(len(rows)))
+
+    if len(config.csv) > 0:
+        with open(config.csv, 'w') as f:
+            f.write(','.join(columns) + '\n')
+            for row in rows:
+                f.write(','.join([str(row[c]) for c in columns]) + '\n')
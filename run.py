@@ -11,16 +11,17 @@ import subprocess
 from flufl.lock import Lock
 from datetime import datetime, timedelta
 from inspect import currentframe, getframeinfo
+from sweep_planner import read_job_header
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('--logdir', type=str, default='',
                         help="where to save")
 parser.add_argument('--mode', type=str, default='run',
-                        help='run|monitor')
+                        help='run|monitor|daemon')
 parser.add_argument('--gpu', type=int, default=-1,
                         help='CUDA_VISIBLE_DEVICES')
-parser.add_argument('--N', type=int, default=1,
-                        help='the number of script (N<=0 means run-all)')
+parser.add_argument('--N', type=int, default=None,
+                        help='the number of script (N<=0 means run-all, 1 if not given). In pool mode (num_workers>1) a cap on the total number of jobs, no cap if not given')
 parser.add_argument('--time_from', type=str, default=None,
                         help='starting time of run.py')
 parser.add_argument('--time_to', type=str, default=None,
@@ -32,6 +33,16 @@ parser.add_argument('--least_memory', type=int, default=0,
                         help='the least gpu memory size (MB) which your program requires ')
 parser.add_argument('--jobdir', type=str, default='jobs',
                         help="where to place the jobs")
+parser.add_argument('--num_workers', type=int, default=1,
+                        help='the number of jobs run concurrently (>1 enables pool mode)')
+parser.add_argument('--mem_margin', type=int, default=2000,
+                        help='memory (MB) kept free when admitting jobs in pool mode')
+parser.add_argument('--history', type=str, default='text',
+                        help='job state backend: text (jobs/HISTORY) | sqlite (jobs/HISTORY.db, see job_store.py)')
+parser.add_argument('--max_poll_interval', type=float, default=60.0,
+                        help='max seconds between checks of the todo directory in daemon mode without inotify')
+parser.add_argument('--poll_interval', type=float, default=2.0,
+                        help='seconds between checks of running jobs in pool mode (and first polling interval in daemon mode)')
 
 
 ### GPU Checker (copy from pynvidia function)
@@ -64,6 +75,47 @@ def get_gpu_memory(gpu_id):
     _, used_mem, free_mem, total_mem = map(int, csv[gpu_id])
     return used_mem, free_mem, total_mem
 
+### CPU/Memory Checker for pool mode
+
+def get_num_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def get_mem_available():
+    # Return: available memory (MB) from /proc/meminfo, None if unknown
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024 # kB -> MB
+    except (IOError, OSError):
+        pass
+    return None
+
+def get_loadavg():
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return 0.0
+
+def get_job_resources(job_file):
+    header = read_job_header(job_file)
+    cpus = float(header.get('CPU', 1))
+    mem = int(header.get('MEM', 0))
+    return cpus, mem
+
+def can_admit(cpus, mem, running_cpus, config):
+    # Load average lags behind newly started jobs, so the declared usage of running jobs is also counted.
+    used_cpus = max(running_cpus, get_loadavg())
+    if used_cpus + cpus > get_num_cpus():
+        return False
+    mem_available = get_mem_available()
+    if mem_available is not None:
+        if mem_available - config.mem_margin < mem:
+            return False
+    return True
+
 def get_todo_script(todo_dir, latest_first=False):
     files = glob.glob(os.path.join(todo_dir, '*.sh'))
     files.sort(key=os.path.getmtime, reverse=latest_first)
@@ -144,16 +196,52 @@ def update_history(HISTORY, HISTORY_LOCK, job, prev_dir, prev_time, next_dir, ne
             f.write('{}\n'.format(line))
     set_unlock(check_lock)
 
+class TextJobStore(object):
+    """Job states in the text file jobdir/HISTORY guarded by a file lock"""
+    def __init__(self, jobdir):
+        self.HISTORY = os.path.join(jobdir, 'HISTORY')
+        self.HISTORY_LOCK = self.HISTORY + '.lock'
+        self.runs = {} # job -> (directory, time) of the line written by this process
+
+    def claim(self, job, todo_dir, queue_dir):
+        check_lock = set_lock(self.HISTORY_LOCK)
+        if not os.path.exists(os.path.join(todo_dir, job)):
+            set_unlock(check_lock) # taken by another runner
+            return False
+        shutil.move(os.path.join(todo_dir, job), os.path.join(queue_dir, job))
+        curr_time = get_now()
+        add_history(self.HISTORY, job, queue_dir, curr_time, 'READY')
+        set_unlock(check_lock)
+        self.runs[job] = (queue_dir, curr_time)
+        return True
+
+    def update(self, job, next_dir, status):
+        prev_dir, prev_time = self.runs[job]
+        next_time = prev_time if status == 'RUNNING' else get_now()
+        update_history(self.HISTORY, self.HISTORY_LOCK, job, prev_dir, prev_time, next_dir, next_time, status)
+        self.runs[job] = (next_dir, next_time)
+
+    def mark_stale(self):
+        return 0 # lines of killed runners stay as they are, claims only depend on the todo files
+
+    def close(self):
+        pass
+
+def get_job_store(config):
+    if config.history == 'text':
+        return TextJobStore(config.jobdir)
+    elif config.history == 'sqlite':
+        from job_store import SQLiteJobStore
+        return SQLiteJobStore(os.path.join(config.jobdir, 'HISTORY.db'))
+    else:
+        raise ValueError('Unknown history backend: {}'.format(config.history))
+
 def run_jobs(config):
 
-    # HISTORY = 'jobs/HISTORY'
-    # HISTORY_LOCK = HISTORY + '.lock'
     # TODO_DIR = 'jobs/todo'
     # QUEUE_DIR = 'jobs/queue'
     # DONE_DIR = 'jobs/done'
     # FAIL_DIR = 'jobs/fail'
-    HISTORY = os.path.join(config.jobdir, 'HISTORY')
-    HISTORY_LOCK = HISTORY + '.lock'
     TODO_DIR = os.path.join(config.jobdir, 'todo')
     QUEUE_DIR = os.path.join(config.jobdir, 'queue')
     DONE_DIR = os.path.join(config.jobdir, 'done')
@@ -170,8 +258,9 @@ def run_jobs(config):
     if len(sh_files) == 0:
         print('There remains no jobs...quit.')
         return -1
-    if config.N > 0:
-        N = min(config.N, len(sh_files))
+    num_scripts = config.N if config.N is not None else 1
+    if num_scripts > 0:
+        N = min(num_scripts, len(sh_files))
     else:
         N = len(sh_files)
 
@@ -179,19 +268,23 @@ def run_jobs(config):
         print('There is no jobs at {}'.format(TODO_DIR))
         return -1
 
-    jobfiles = sh_files[:N]
-    times = [None] * N
+    store = get_job_store(config)
+    num_stale = store.mark_stale()
+    if num_stale > 0:
+        print('Mark {} runs of exited runners as FAIL'.format(num_stale))
 
-    # move from 'todo' to 'queue', locking will be continued until all scripts move to queue directory.
-    check_lock = set_lock(HISTORY_LOCK)
-    for i, job in enumerate(jobfiles):
-        print('#{} {}'.format(i, job))
-        shutil.move(os.path.join(TODO_DIR, job), os.path.join(QUEUE_DIR, job))
-        times[i] = get_now()
-        add_history(HISTORY, job, QUEUE_DIR, times[i], 'READY')
-    set_unlock(check_lock)
+    # move from 'todo' to 'queue'
+    jobfiles = []
+    for job in sh_files[:N]:
+        if store.claim(job, TODO_DIR, QUEUE_DIR):
+            print('#{} {}'.format(len(jobfiles), job))
+            jobfiles.append(job)
+    N = len(jobfiles)
 
     print('Move {}/{} jobs to {}'.format(N, len(sh_files), QUEUE_DIR))
+    if N == 0:
+        store.close()
+        return -1 # all taken by other runners
 
     success_jobs = []
     fail_jobs = []
@@ -199,7 +292,7 @@ def run_jobs(config):
     for i, job in enumerate(jobfiles):
         try:
             print('[{}] RUN {}/{} {}'.format(get_now(), i+1, N, job))
-            update_history(HISTORY, HISTORY_LOCK, job, QUEUE_DIR, times[i], QUEUE_DIR, times[i], 'RUNNING')
+            store.update(job, QUEUE_DIR, 'RUNNING')
 
             p = subprocess.Popen(['sh', os.path.join(QUEUE_DIR, job)],
                                     stdin=subprocess.PIPE,
@@ -209,7 +302,7 @@ def run_jobs(config):
             if p.wait() == 0:
                 shutil.move(os.path.join(QUEUE_DIR, job), os.path.join(DONE_DIR, job))
                 new_time = get_now()
-                update_history(HISTORY, HISTORY_LOCK, job, QUEUE_DIR, times[i], DONE_DIR, new_time, 'DONE')
+                store.update(job, DONE_DIR, 'DONE')
                 print('[{}] job {} has done successfully.'.format(new_time, job))
                 success_jobs.append(job)
             else:
@@ -225,18 +318,131 @@ def run_jobs(config):
             shutil.move(os.path.join(QUEUE_DIR, job), os.path.join(FAIL_DIR, job))
 
             new_time = get_now()
-            update_history(HISTORY, HISTORY_LOCK, job, QUEUE_DIR, times[i], FAIL_DIR, new_time, 'FAIL')
+            store.update(job, FAIL_DIR, 'FAIL')
             print('[FAIL!! {}] job {} was failed.'.format(new_time, job))
             fail_jobs.append(job)
 
             if config.die_if_fail:
                 raise RuntimeError('Die because a job failed.')
 
+    store.close()
     print('[{}] {} jobs are finished.'.format(get_now(), N))
     print('Success: {} jobs, {}'.format(len(success_jobs), success_jobs))
     print('Fail: {} jobs, {}'.format(len(fail_jobs), fail_jobs))
     return 1
 
+def run_jobs_pool(config):
+    """Run up to config.num_workers jobs concurrently.
+
+    Jobs are taken from todo one by one whenever a slot is free and the CPU/MEM
+    declared in their header ('# [CPU] n', '# [MEM] MB') fit into the live
+    resources. stdout/stderr of each job are written to jobdir/logs/<job>.log.
+    --N (if given) caps the total number of jobs started by this call.
+    """
+    TODO_DIR = os.path.join(config.jobdir, 'todo')
+    QUEUE_DIR = os.path.join(config.jobdir, 'queue')
+    DONE_DIR = os.path.join(config.jobdir, 'done')
+    FAIL_DIR = os.path.join(config.jobdir, 'fail')
+    LOG_DIR = os.path.join(config.jobdir, 'logs')
+    if not os.path.exists(LOG_DIR):
+        os.makedirs(LOG_DIR)
+
+    # memory check
+    if config.least_memory > 0 and config.gpu >= 0:
+        used_mem, free_mem, total_mem = get_gpu_memory(config.gpu)
+        if config.least_memory > free_mem:
+            print('There are not enough gpu memory, only {}/{}MB are available on GPU#{}. all jobs are canceled.'.format(free_mem, total_mem, config.gpu))
+            return -1
+
+    if len(get_todo_script(TODO_DIR)) == 0:
+        print('There remains no jobs...quit.')
+        return -1
+
+    store = get_job_store(config)
+    num_stale = store.mark_stale()
+    if num_stale > 0:
+        print('Mark {} runs of exited runners as FAIL'.format(num_stale))
+    # concurrency is only limited by num_workers and the CPU/MEM budget, --N optionally caps the total
+    max_jobs = config.N if config.N is not None and config.N > 0 else None
+    skipped = set() # jobs which could not be claimed
+    running = {} # job -> (process, log file, cpus)
+    success_jobs = []
+    fail_jobs = []
+    num_started = 0
+    no_more_jobs = False
+
+    while True:
+        # Reap finished jobs
+        for job in list(running.keys()):
+            p, log_f, _ = running[job]
+            ret = p.poll()
+            if ret is None:
+                continue
+            log_f.close()
+            del running[job]
+            new_time = get_now()
+            if ret == 0:
+                shutil.move(os.path.join(QUEUE_DIR, job), os.path.join(DONE_DIR, job))
+                store.update(job, DONE_DIR, 'DONE')
+                print('[{}] job {} has done successfully.'.format(new_time, job))
+                success_jobs.append(job)
+            else:
+                shutil.move(os.path.join(QUEUE_DIR, job), os.path.join(FAIL_DIR, job))
+                shutil.copy(os.path.join(LOG_DIR, job+'.log'), os.path.join(FAIL_DIR, job+'.log'))
+                store.update(job, FAIL_DIR, 'FAIL')
+                print('[FAIL!! {}] job {} was failed (exit code {}).'.format(new_time, job, ret))
+                fail_jobs.append(job)
+                if config.die_if_fail:
+                    for other_p, _, _ in running.values():
+                        other_p.terminate()
+                    raise RuntimeError('Die because a job failed.')
+
+        # Admit new jobs
+        while not no_more_jobs and len(running) < config.num_workers:
+            if max_jobs is not None and num_started >= max_jobs:
+                no_more_jobs = True
+                break
+            sh_files = [job for job in get_todo_script(TODO_DIR) if job not in skipped]
+            if len(sh_files) == 0:
+                no_more_jobs = True
+                break
+            job = sh_files[0]
+            try:
+                cpus, mem = get_job_resources(os.path.join(TODO_DIR, job))
+            except (IOError, OSError):
+                skipped.add(job) # taken by another runner meanwhile
+                continue
+            running_cpus = sum([x[2] for x in running.values()])
+            # always admit when idle, otherwise a too large job would block forever
+            if len(running) > 0 and not can_admit(cpus, mem, running_cpus, config):
+                break
+
+            # move from 'todo' to 'queue'
+            if not store.claim(job, TODO_DIR, QUEUE_DIR):
+                skipped.add(job) # taken by another runner
+                continue
+
+            num_started += 1
+            print('[{}] RUN #{} {} (cpu={}, mem={}MB, running={})'.format(get_now(), num_started, job, cpus, mem, len(running)+1))
+            store.update(job, QUEUE_DIR, 'RUNNING')
+            log_f = open(os.path.join(LOG_DIR, job+'.log'), 'w')
+            p = subprocess.Popen(['sh', os.path.join(QUEUE_DIR, job)],
+                                    stdin=subprocess.DEVNULL,
+                                    stdout=log_f,
+                                    stderr=subprocess.STDOUT,
+                                    shell=False)
+            running[job] = (p, log_f, cpus)
+
+        if no_more_jobs and len(running) == 0:
+            break
+        time.sleep(config.poll_interval)
+
+    store.close()
+    print('[{}] {} jobs are finished.'.format(get_now(), num_started))
+    print('Success: {} jobs, {}'.format(len(success_jobs), success_jobs))
+    print('Fail: {} jobs, {}'.format(len(fail_jobs), fail_jobs))
+    return 1 if num_started > 0 else -1
+
 def get_scheduled_time(hhmm = None):
     if hhmm is None:
         return None
@@ -255,10 +461,101 @@ def get_scheduled_time(hhmm = None):
     schd_time = datetime(now.year, now.month, now.day, hours, minutes)
 
     if (schd_time - now).days < 0:
-        schd_time = datetime(now.year, now.month, now.day+1, hours, minutes)
+        schd_time = schd_time + timedelta(days=1)
 
     return schd_time
 
+class JobWatcher(object):
+    """Wait until a job script (or the stop file) appears.
+
+    Uses inotify (pip install inotify_simple) so that an idle runner sleeps in the kernel
+    and wakes up as soon as xxx_add_jobs.py writes a script. Without inotify it falls back to
+    polling with exponential backoff (poll_interval, 2*poll_interval, ..., max_poll_interval).
+    """
+    def __init__(self, todo_dir, stop_file, min_interval=2.0, max_interval=60.0):
+        self.stop_file = stop_file
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.inotify = None
+        try:
+            from inotify_simple import INotify, flags
+            self.inotify = INotify()
+            self.inotify.add_watch(todo_dir, flags.CREATE | flags.MOVED_TO | flags.CLOSE_WRITE)
+            self.inotify.add_watch(os.path.dirname(os.path.abspath(stop_file)), flags.CREATE | flags.MOVED_TO)
+            print('Watch {} with inotify'.format(todo_dir))
+        except ImportError:
+            print('inotify_simple is not installed, poll {} with backoff up to {}s'.format(todo_dir, max_interval))
+
+    def reset(self):
+        self.interval = self.min_interval
+
+    def is_stopped(self):
+        return os.path.exists(self.stop_file)
+
+    def wait(self, timeout=None):
+        # Return when something happens or after timeout seconds (None: no limit)
+        if self.inotify is not None:
+            timeout_ms = None if timeout is None else max(int(timeout * 1000), 0)
+            self.inotify.read(timeout=timeout_ms, read_delay=100) # read_delay merges bursts of new scripts
+        else:
+            sleep_sec = self.interval if timeout is None else min(self.interval, timeout)
+            time.sleep(max(sleep_sec, 0))
+            self.interval = min(self.interval * 2, self.max_interval)
+
+    def wait_until(self, target_time):
+        # Sleep until target_time (datetime), return False if the stop file appears meanwhile
+        while True:
+            if self.is_stopped():
+                return False
+            remain = (target_time - datetime.now()).total_seconds()
+            if remain <= 0:
+                return True
+            if self.inotify is not None:
+                self.wait(remain)
+            else:
+                time.sleep(min(remain, self.max_interval))
+
+def run_daemon(config, run_fn):
+    """Long-lived runner: start jobs as soon as they appear in todo within the daily time window"""
+    TODO_DIR = os.path.join(config.jobdir, 'todo')
+    stop_file = '{}_stop'.format(os.uname()[1])
+    watcher = JobWatcher(TODO_DIR, stop_file, config.poll_interval, config.max_poll_interval)
+
+    time_from = get_scheduled_time(config.time_from)
+    if time_from is not None:
+        print('Sleep until {}'.format(time_from))
+        if not watcher.wait_until(time_from):
+            print('Detect {} and running loop is finished'.format(stop_file))
+            return
+    time_to = get_scheduled_time(config.time_to)
+
+    print('-----<<< Run as daemon-mode >>>-----')
+    while True:
+        if watcher.is_stopped():
+            print('Detect {} and running loop is finished'.format(stop_file))
+            break # hostname_stop
+        if time_to is not None and datetime.now() >= time_to:
+            if config.time_from is None:
+                print("Time's up for today. Quit all jobs.")
+                break
+            time_from = get_scheduled_time(config.time_from)
+            print("Time's up for today. Sleep until {}".format(time_from))
+            if not watcher.wait_until(time_from):
+                print('Detect {} and running loop is finished'.format(stop_file))
+                break
+            time_to = get_scheduled_time(config.time_to)
+            continue
+
+        ret = run_fn(config)
+        if ret < 0:
+            timeout = None
+            if time_to is not None:
+                timeout = (time_to - datetime.now()).total_seconds()
+            watcher.wait(timeout)
+        else:
+            watcher.reset()
+
 def run_debug(config):
     print('run debug')
     try:
@@ -304,27 +601,26 @@ if __name__ == '__main__':
     time_from = get_scheduled_time(config.time_from)
     time_to = get_scheduled_time(config.time_to)
 
-    if time_from is not None:
-        while (True):
-            now = datetime.now()
-            if (time_from-now).days < 0:
-                print("It's time to run jobs. Let's start !!!")
-                break
-            else:
-                hostname, gpu_id = get_server_info()
-                print('[{} GPU#{}]It has not been the specified running time ({}) so I will sleep 300s.'.format(hostname, gpu_id, time_from))
-                time.sleep(300)
+    if time_from is not None and config.mode != 'daemon': # daemon handles the time window itself
+        wait_sec = (time_from - datetime.now()).total_seconds()
+        if wait_sec > 0:
+            hostname, gpu_id = get_server_info()
+            print('[{} GPU#{}]It has not been the specified running time ({}) so I will sleep {:.0f}s.'.format(hostname, gpu_id, time_from, wait_sec))
+            time.sleep(wait_sec)
+        print("It's time to run jobs. Let's start !!!")
 
     stop_file = '{}_stop'.format(os.uname()[1])
     if os.path.exists(stop_file):
     	print('[Warning] Did you forget removing {}?'.format(stop_file))
 
+    run_fn = run_jobs_pool if config.num_workers > 1 else run_jobs
+
     if config.mode == 'run':
-        run_jobs(config)
+        run_fn(config)
     elif config.mode == 'monitor':
         while True:
             print('-----<<< Run as monitor-mode >>>-----')
-            ret = run_jobs(config) # loop until no-jobs
+            ret = run_fn(config) # loop until no-jobs
             if ret < 0:
             	break
             if os.path.exists(stop_file):
@@ -336,6 +632,8 @@ if __name__ == '__main__':
                     print("Time's up for today. Quit all jobs.")
                     break
 
+    elif config.mode == 'daemon':
+        run_daemon(config, run_fn)
     elif config.mode == 'debug':
         run_debug(config)
     elif config.mode == 'clear':
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Launch the ps and worker tasks of a synchronous distributed training (see utils/dist_utils.py).
+
+All the tasks run on this host by default, e.g. 2 CPU workers and 1 parameter server:
+
+    python run_distributed.py --num_workers=2 --num_ps=1 --gpus= -- \
+        python cfcf_train.py --vid_dir=... --log_dir=... --batch_size=8
+
+The trainer command gets --job_name/--task_index/--ps_hosts/--worker_hosts
+appended. The output of every task is written to <out_dir>/<job>_<index>.log.
+The launcher waits for the chief (worker 0) and then terminates the other
+tasks (parameter servers never exit by themselves). For several hosts, pass
+--ps_hosts/--worker_hosts and --dry_run, and run the printed commands on the
+hosts.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+def get_hosts(hosts, num_tasks, port):
+    if len(hosts) > 0:
+        return [host.strip() for host in hosts.split(',') if len(host.strip()) > 0]
+    return ['localhost:{}'.format(port + i) for i in range(num_tasks)]
+
+def build_commands(command, ps_hosts, worker_hosts):
+    # Return: [(job_name, task_index, command)]
+    tasks = [('ps', i) for i in range(len(ps_hosts))] + [('worker', i) for i in range(len(worker_hosts))]
+    commands = []
+    for job_name, task_index in tasks:
+        commands.append((job_name, task_index, command + [
+            '--job_name={}'.format(job_name),
+            '--task_index={}'.format(task_index),
+            '--ps_hosts={}'.format(','.join(ps_hosts)),
+            '--worker_hosts={}'.format(','.join(worker_hosts)),
+        ]))
+    return commands
+
+def get_task_env(job_name, task_index, gpus):
+    env = os.environ.copy()
+    if job_name == 'ps':
+        env['CUDA_VISIBLE_DEVICES'] = '' # parameter servers only hold the variables
+    elif gpus is not None:
+        gpu_list = [gpu for gpu in gpus.split(',') if len(gpu) > 0]
+        env['CUDA_VISIBLE_DEVICES'] = gpu_list[task_index % len(gpu_list)] if len(gpu_list) > 0 else ''
+    return env
+
+def terminate_all(procs):
+    for _, _, proc in procs:
+        if proc.poll() is None:
+            proc.terminate()
+    for _, _, proc in procs:
+        try:
+            proc.wait()
+        except KeyboardInterrupt:
+            proc.kill()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--num_ps', type=int, default=1,
+                            help='the number of parameter servers on this host')
+    parser.add_argument('--num_workers', type=int, default=2,
+                            help='the number of workers on this host')
+    parser.add_argument('--port', type=int, default=2222,
+                            help='first port of the local tasks (ps, then workers)')
+    parser.add_argument('--ps_hosts', type=str, default='',
+                            help='comma separated host:port (overrides --num_ps/--port)')
+    parser.add_argument('--worker_hosts', type=str, default='',
+                            help='comma separated host:port (overrides --num_workers/--port)')
+    parser.add_argument('--gpus', type=str, default=None,
+                            help='CUDA_VISIBLE_DEVICES assigned to the workers in turn (empty: CPU only, default: inherit)')
+    parser.add_argument('--out_dir', type=str, default='dist_logs',
+                            help='where to write the output of the tasks')
+    parser.add_argument('--dry_run', action='store_const',
+                            const=True, default=False,
+                            help='print the commands of the tasks and quit')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                            help='trainer command after --')
+    config = parser.parse_args()
+
+    command = config.command[1:] if len(config.command) > 0 and config.command[0] == '--' else config.command
+    if len(command) == 0:
+        parser.error('trainer command is required, e.g. -- python cfcf_train.py ...')
+
+    ps_hosts = get_hosts(config.ps_hosts, config.num_ps, config.port)
+    worker_hosts = get_hosts(config.worker_hosts, config.num_workers, config.port + len(ps_hosts))
+    commands = build_commands(command, ps_hosts, worker_hosts)
+
+    if config.dry_run:
+        for job_name, task_index, cmd in commands:
+            print('# {}:{}'.format(job_name, task_index))
+            print(' '.join(cmd))
+        sys.exit(0)
+
+    if not os.path.isdir(config.out_dir):
+        os.makedirs(config.out_dir)
+    procs = []
+    for job_name, task_index, cmd in commands:
+        log_file = os.path.join(config.out_dir, '{}_{}.log'.format(job_name, task_index))
+        print('Start {}:{} (log: {})'.format(job_name, task_index, log_file))
+        with open(log_file, 'w') as f:
+            proc = subprocess.Popen(cmd, stdout=f, stderr=subprocess.STDOUT,
+                                    env=get_task_env(job_name, task_index, config.gpus))
+        procs.append((job_name, task_index, proc))
+
+    chief = [proc for job_name, task_index, proc in procs if job_name == 'worker' and task_index == 0][0]
+    returncode = 0
+    try:
+        while chief.poll() is None:
+            failed = [(job_name, task_index, proc.returncode) for job_name, task_index, proc in procs
+                        if proc.poll() is not None and proc.returncode != 0]
+            if len(failed) > 0:
+                print('[Error] {}:{} exited with {}'.format(*failed[0]))
+                returncode = failed[0][2]
+                break
+            time.sleep(1)
+        else:
+            returncode = chief.returncode
+            print('Chief finished with {}'.format(returncode))
+    except KeyboardInterrupt:
+        returncode = 1
+    terminate_all(procs)
+    sys.exit(returncode)
@@ -24,10 +24,18 @@ from models import *
 from cf_utils import *
 from inference import inference_wrapper, inference_cfcf
 from inference.tracker import Tracker
+from inference.feature_cache import FeatureCache
+from utils.restore_utils import get_checkpoint_hash, get_checkpoint_path, restore_variables, add_restore_arguments
+from utils.runtime_utils import setup_runtime, get_session_config, add_runtime_arguments
+from utils.precision_utils import add_precision_arguments
 
-def main(config):
+def build_tracking_model(config):
+    """Build the inference graph and restore the checkpoint. Return (model, sess)"""
     tf.reset_default_graph()
-    log_dir = config.log_dir
+    if config.scale_estimator == 'dsst' and config.num_scales != 1:
+        # translation only needs the center scale, the scale filter samples its embeddings
+        print('scale_estimator=dsst: search with a single scale (num_scales {} --> 1)'.format(config.num_scales))
+        config.num_scales = 1
     if config.net_type == 'siamese':
         model = inference_wrapper.InferenceWrapper(config)
     elif config.net_type == 'cfcf':
@@ -37,6 +45,49 @@ def main(config):
 
     var_list = model.build_graph_from_config()
 
+    setup_runtime(config) # no input pipeline, all CPUs go to compute
+    sess = tf.Session(config=get_session_config(config))
+    sess.run(tf.global_variables_initializer())
+    # restore_fn(sess)
+
+    checkpoint = get_checkpoint_path(config.model)
+    # every variable of the trained tracker must be restored (wrong --backbone/--feat_layer/--model fail here)
+    restore_variables(sess, var_list, checkpoint, num_threads=config.restore_threads, strict=True)
+
+    if config.feature_cache_size > 0 or len(config.feature_cache_dir) > 0:
+        # model settings which change the embeddings are hashed with the checkpoint
+        extra = '{}/{}/{}/{}/{}'.format(config.net_type, config.backbone,
+                                     getattr(config, 'feat_layer', ''), config.x_image_size, config.precision)
+        model.feature_cache = FeatureCache(max(config.feature_cache_size, 1),
+                                           cache_dir=config.feature_cache_dir,
+                                           checkpoint_hash=get_checkpoint_hash(checkpoint, extra),
+                                           quant=config.feature_cache_quant)
+
+    return model, sess
+
+def get_video_dirs(config):
+    seq_names = read_text(config.seq_text, dtype=np.str)
+    video_dirs = [os.path.join(config.root_dir, x) for x in seq_names]
+    return [x for x in video_dirs if os.path.isdir(x)]
+
+def load_sequence(video_dir):
+    filenames = sort_nicely(glob.glob(video_dir + '/img/*.jpg'))
+    first_line = open(video_dir + '/groundtruth_rect.txt').readline()
+    bb = [int(v) for v in first_line.strip().split(',')]
+    init_bb = Rectangle(bb[0] - 1, bb[1] - 1, bb[2], bb[3])  # 0-index in python
+    return filenames, init_bb
+
+def write_trajectory(filename, trajectory):
+    with open(filename, 'w') as f:
+        for region in trajectory:
+            rect_str = '{},{},{},{}\n'.format(region.x + 1, region.y + 1,
+                                            region.width, region.height)
+            f.write(rect_str)
+
+def main(config):
+    log_dir = config.log_dir
+    model, sess = build_tracking_model(config)
+
     if config.clear_logs and tf.gfile.Exists(log_dir):
         print('Clear all files in {}'.format(log_dir))
         try:
@@ -44,53 +95,33 @@ def main(config):
         except:
             print('Fail to delete {}. You probably have to kill tensorboard process.'.format(log_dir))
 
-    seq_names = read_text(config.seq_text, dtype=np.str)
-    video_dirs = [os.path.join(config.root_dir, x) for x in seq_names]
-
-    tfconfig = tf.ConfigProto()
-    tfconfig.gpu_options.allow_growth = True # almost the same as tf.InteractiveSession
-    sess = tf.Session(config=tfconfig)
-    sess.run(tf.global_variables_initializer())
-    # restore_fn(sess)
-
-    if osp.isdir(config.model):
-        checkpoint = tf.train.latest_checkpoint(config.model)
-    else:
-        checkpoint = config.model
-
-    saver = tf.train.Saver(var_list)
-    saver.restore(sess, checkpoint)
+    video_dirs = get_video_dirs(config)
 
     tracker = Tracker(model, config=config)
 
     for video_dir in video_dirs:
-        if not os.path.isdir(video_dir):
-            continue
-
         video_name = os.path.basename(video_dir)
         video_log_dir = os.path.join(log_dir, video_name)
         mkdir_p(video_log_dir)
 
-        filenames = sort_nicely(glob.glob(video_dir + '/img/*.jpg'))
-        first_line = open(video_dir + '/groundtruth_rect.txt').readline()
-        bb = [int(v) for v in first_line.strip().split(',')]
-        init_bb = Rectangle(bb[0] - 1, bb[1] - 1, bb[2], bb[3])  # 0-index in python
+        filenames, init_bb = load_sequence(video_dir)
 
         trajectory = tracker.track(sess, init_bb, filenames, video_log_dir)
-        with open(osp.join(video_log_dir, 'track_rect.txt'), 'w') as f:
-            for region in trajectory:
-                rect_str = '{},{},{},{}\n'.format(region.x + 1, region.y + 1,
-                                                region.width, region.height)
-                f.write(rect_str)
+        write_trajectory(osp.join(video_log_dir, 'track_rect.txt'), trajectory)
 
-if __name__ == '__main__':
+    if model.feature_cache is not None:
+        model.feature_cache.print_stats()
 
-    from utils.argparse_utils import *
+def get_tracking_parser():
+    from utils.argparse_utils import get_parser, add_argument_group, str2bool
     parser = get_parser()
 
     general_arg = add_argument_group('General', parser)
     general_arg.add_argument('--num_threads', type=int, default=8,
                             help='the number of threads (for dataset)')
+    add_runtime_arguments(parser)
+    add_precision_arguments(parser, training=False)
+    add_restore_arguments(parser, training=False)
 
     train_arg = add_argument_group('Train', parser)
     
@@ -122,7 +153,9 @@ if __name__ == '__main__':
     # train_arg.add_argument('--backbone', type=str, default='vgg16',
     #                         help='backbone CNN (alexnet|vgg16|resnet50|mobilenet)')
     # train_arg.add_argument('--feat_layer', type=str, default='vgg_16/conv4/conv4_3',
-    #                         help='feature layer')
+    #                         help='feature layer (comma separated layers are fused)')
+    # train_arg.add_argument('--feat_layer_weights', type=str, default='',
+    #                         help='comma separated weights of the fused layer responses (equal if empty)')
     # train_arg.add_argument('--reglambda', type=float, default=0.01,
     #                         help='lambda for regularization')
     # train_arg.add_argument('--log_dir', type=str, default='logs_track/cfcf_noupd',
@@ -154,6 +187,24 @@ if __name__ == '__main__':
                             help='scale step')
     track_arg.add_argument('--scale_penalty', type=float, default=0.9745,
                             help='scale penalty')
+    track_arg.add_argument('--scale_estimator', type=str, default='pyramid',
+                            help='pyramid: backbone on num_scales search images, dsst: 1-D scale filter on the embeddings of a single search image')
+    track_arg.add_argument('--dsst_num_scales', type=int, default=33,
+                            help='the number of scales of the scale filter')
+    track_arg.add_argument('--dsst_scale_step', type=float, default=1.02,
+                            help='scale step of the scale filter')
+    track_arg.add_argument('--dsst_learning_rate', type=float, default=0.025,
+                            help='update rate of the scale filter')
+    track_arg.add_argument('--dsst_patch_size', type=int, default=4,
+                            help='grid size of the embeddings sampled at each scale')
+
+    cache_arg = add_argument_group('FeatureCache', parser)
+    cache_arg.add_argument('--feature_cache_size', type=int, default=0,
+                            help='max number of search image embeddings cached in memory (disable if 0)')
+    cache_arg.add_argument('--feature_cache_dir', type=str, default='',
+                            help='directory to store embeddings across runs (disable if empty)')
+    cache_arg.add_argument('--feature_cache_quant', type=float, default=0.0,
+                            help='snap target boxes to a grid of this many pixels so that nearly identical crops hit the cache (exact if 0)')
 
     cf_arg = add_argument_group('CFNet', parser)
 
@@ -176,8 +227,15 @@ if __name__ == '__main__':
     cf_arg.add_argument('--embed_stride', type=int, default=8,
                             help='')
 
+    return parser
+
+if __name__ == '__main__':
+
+    from utils.argparse_utils import *
+    parser = get_tracking_parser()
+
     tmp_config, unparsed = get_config(parser)
     config = tmp_config
 
 
-    main(config)
\ No newline at end of file
+    main(config)
@@ -7,6 +7,7 @@ import hashlib
 import numpy as np
 import glob
 from hyper_params import HyperParamsBase, ParamGenerator
+from sweep_planner import SweepPlanner, get_param_hash, add_sweep_arguments, generate_params
 
 def is_cc(): # check server is compute canada
     hostname = os.uname()[1]
@@ -54,6 +55,10 @@ class HyperParams(HyperParamsBase):
         self.backbone = 'alexnet' # vgg16|resnet50|mobilenet
         self.adjust_response_config_scale = 0.001
 
+        # Resources (declared in the job header for run.py)
+        self.num_cpus = 8 # num_threads of the input pipeline + compute threads
+        self.mem_mb = 8000
+
 ROOT_JOB = 'jobs'
 TODO_DIR = '{}/todo'.format(ROOT_JOB)
 QUEUE_DIR = '{}/queue'.format(ROOT_JOB)
@@ -111,8 +116,11 @@ def get_log_dir(params):
 
     return log_dir
 
-def write_shell_script(command, memo=None, params=None, log_dir=None):
-    hash_str = hashlib.sha256(command.encode('utf-8')).hexdigest()[:16]
+def write_shell_script(command, memo=None, params=None, log_dir=None, cpus=None, mem=None, param_hash=None):
+    if param_hash is not None:
+        hash_str = param_hash
+    else:
+        hash_str = hashlib.sha256(command.encode('utf-8')).hexdigest()[:16]
     job_name = 'job-{}.sh'.format(hash_str)
     job_file = os.path.join(TODO_DIR, job_name)
 
@@ -125,8 +133,14 @@ def write_shell_script(command, memo=None, params=None, log_dir=None):
             f.write('# [MEMO] {}\n'.format(memo))
         if params is not None and len(params) > 0:
             f.write('# [PARAM] {}\n'.format(params))
+        if param_hash is not None:
+            f.write('# [HASH] {}\n'.format(param_hash))
         if log_dir is not None and len(log_dir) > 0:
             f.write('# [LOGDIR] {}\n'.format(log_dir))
+        if cpus is not None:
+            f.write('# [CPU] {}\n'.format(cpus)) # used by run.py for admission
+        if mem is not None:
+            f.write('# [MEM] {}\n'.format(mem)) # MB
 
         if is_cc():
             f.write("#SBATCH --account=def-kyi\n")
@@ -146,11 +160,11 @@ if __name__ == '__main__':
     parser.add_argument('--dry_run', action='store_const',
                         const=True, default=False,
                         help="Just print the result")
+    add_sweep_arguments(parser)
     config, unparsed = get_config(parser)
     if len(unparsed) > 0:
         raise ValueError('Warning: miss identify argument ?? unparsed={}\n'.format(unparsed))
 
-    exist_strategy = '' # skip, remove, recreate, overwrite
     memo = None
     pg = ParamGenerator()
 
@@ -164,12 +178,15 @@ if __name__ == '__main__':
     # pg.add_params('optim_method', ['adam'])
     # pg.add_params('lr', ['1e-3', '1e-4'])
 
-    all_params = pg.generate(base_params=HyperParams())
+    all_params = generate_params(pg, HyperParams(), config)
+    planner = SweepPlanner(ROOT_JOB, retry_failed=config.retry_failed,
+                           skip_existing_results=not config.overwrite_results)
 
     if not config.dry_run:
         check_job_pool()
 
     num_new_jobs = 0
+    num_skip_jobs = 0
 
     log_dir_set = set()
 
@@ -177,18 +194,21 @@ if __name__ == '__main__':
 
         log_dir = get_log_dir(params)
         log_dir_set.add(log_dir)
-        # print(os.path.join(params.res_root_dir, log_dir))
-        if os.path.exists(os.path.join(params.res_root_dir, log_dir)):
-            print('logdir {} has already existed ! strategy={}'.format(log_dir, exist_strategy))
-            if exist_strategy == 'skip':
-                continue
+        param_hash = get_param_hash(params)
+        skip_reason = planner.check(param_hash, log_dir)
+        if skip_reason is not None:
+            print('skip {} ({})'.format(log_dir, skip_reason))
+            num_skip_jobs += 1
+            continue
         cmd = get_command(params, log_dir)
         print(idx, log_dir)
         if not config.dry_run:
-            write_shell_script(cmd, memo=memo, params=params.param_str, log_dir=log_dir)
+            write_shell_script(cmd, memo=memo, params=params.param_str, log_dir=log_dir,
+                               cpus=params.num_cpus, mem=params.mem_mb, param_hash=param_hash)
+        planner.add(param_hash, log_dir)
         num_new_jobs += 1
 
-    print('Add {} {}/{}'.format(num_new_jobs, ROOT_JOB, len(all_params)))
+    print('Add {} {}/{} (skip {})'.format(num_new_jobs, ROOT_JOB, len(all_params), num_skip_jobs))
     total_num_jobs = len(glob.glob(os.path.join(TODO_DIR, 'job*sh')))
     if config.dry_run:
         total_num_jobs += num_new_jobs
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Deduplication of sweep jobs shared by the xxx_add_jobs.py scripts.
+
+Every parameter set is identified by a hash of its canonical form (sorted
+name/value pairs), written as '# [HASH]' in the job header and used as the
+job file name. A combination is skipped if a job with the same hash or log
+directory is already in todo/queue/done(/fail), or if its log directory
+already contains results.
+"""
+import os
+import glob
+import json
+import hashlib
+import inspect
+
+# attributes which do not change the experiment
+IGNORE_KEYS = ('param_str', 'num_cpus', 'mem_mb')
+
+def get_canonical_params(params):
+    canonical = {}
+    for name in dir(params):
+        if name.startswith('_') or name in IGNORE_KEYS:
+            continue
+        value = getattr(params, name)
+        if inspect.ismethod(value) or inspect.isfunction(value):
+            continue
+        canonical[name] = str(value)
+    return canonical
+
+def get_param_hash(params):
+    text = json.dumps(get_canonical_params(params), sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+def read_job_header(job_file):
+    # Parse '# [KEY] value' lines written by xxx_add_jobs.py (also used by run.py and asha_scheduler.py)
+    header = {}
+    with open(job_file, 'r') as f:
+        for line in f:
+            if not line.startswith('#'):
+                continue
+            if line.startswith('# [') and ']' in line:
+                key, value = line[3:].split(']', 1)
+                header[key.strip()] = value.strip()
+    return header
+
+def has_results(log_dir):
+    return os.path.isdir(log_dir) and len(os.listdir(log_dir)) > 0
+
+class SweepPlanner(object):
+    def __init__(self, job_root='jobs', retry_failed=False, skip_existing_results=True):
+        self.retry_failed = retry_failed
+        self.skip_existing_results = skip_existing_results
+        self.hashes = {} # hash -> state
+        self.log_dirs = {} # log_dir -> state
+        states = ['todo', 'queue', 'done']
+        if not retry_failed:
+            states.append('fail')
+        for state in states:
+            for job_file in glob.glob(os.path.join(job_root, state, '*.sh')):
+                header = read_job_header(job_file)
+                if 'HASH' in header:
+                    self.hashes[header['HASH']] = state
+                if 'LOGDIR' in header: # jobs created before [HASH] was written
+                    self.log_dirs[header['LOGDIR']] = state
+
+    def check(self, param_hash, log_dir):
+        # Return: reason to skip the combination, or None if it should be added
+        if param_hash in self.hashes:
+            return 'same params in {}'.format(self.hashes[param_hash])
+        if log_dir in self.log_dirs:
+            return 'same log_dir in {}'.format(self.log_dirs[log_dir])
+        if self.skip_existing_results and has_results(log_dir):
+            return 'results exist'
+        return None
+
+    def add(self, param_hash, log_dir):
+        # register a newly written job, so that duplicates within one sweep are skipped
+        self.hashes[param_hash] = 'todo'
+        self.log_dirs[log_dir] = 'todo'
+
+def add_sweep_arguments(parser):
+    parser.add_argument('--sampling', type=str, default='grid',
+                        help='grid|random|lhs (random/lhs draw --num_samples combinations lazily)')
+    parser.add_argument('--num_samples', type=int, default=0,
+                        help='the number of combinations for random/lhs sampling')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed of sampling')
+    parser.add_argument('--retry_failed', action='store_const',
+                        const=True, default=False,
+                        help='re-add combinations whose jobs are in the fail directory')
+    parser.add_argument('--overwrite_results', action='store_const',
+                        const=True, default=False,
+                        help='re-add combinations whose log_dir already has results')
+
+def generate_params(pg, base_params, config):
+    if config.sampling == 'grid':
+        return pg.generate(base_params=base_params)
+    if config.num_samples <= 0:
+        raise ValueError('--num_samples is required for --sampling={}'.format(config.sampling))
+    print('Sample {} of {} combinations ({})'.format(config.num_samples, pg.num_combinations(), config.sampling))
+    return pg.sample(config.num_samples, base_params=base_params, method=config.sampling, seed=config.seed)
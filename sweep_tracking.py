@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Grid/random search of tracking-time parameters with a single loaded model.
+
+The graph is built and the checkpoint is restored only once. Every trial reuses
+the same session, and the backbone embeddings of search images are cached so that
+trials which crop the same region of the same frame skip the forward pass.
+Each trial writes track_rect.txt under <log_dir>/<param_str>/<video> and is scored
+with evaluate_otb.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import numpy as np
+from collections import OrderedDict
+
+LOCAL_PATH = './'
+if LOCAL_PATH not in sys.path:
+    sys.path.append(LOCAL_PATH)
+
+from utils.misc import mkdir_p
+from hyper_params import ParamGenerator
+from inference.tracker import Tracker
+from run_tracking import build_tracking_model, get_video_dirs, load_sequence, write_trajectory, get_tracking_parser
+import evaluate_otb
+
+SWEEP_PARAMS = ['scale_step', 'scale_penalty', 'window_influence', 'scale_damp', 'mmr_thresh', 'update_rate']
+
+def get_trials(config):
+    param_gen = ParamGenerator()
+    for name in SWEEP_PARAMS:
+        values = getattr(config, 'sweep_' + name)
+        if len(values) > 0:
+            param_gen.add_params(name, [float(x) for x in values.split(',')], forced_var=True)
+        else:
+            param_gen.add_params(name, getattr(config, name))
+    np.random.seed(config.sweep_seed)
+    trials = param_gen.generate(base_params=config, shuffle=config.num_trials > 0)
+    if config.num_trials > 0:
+        trials = trials[:config.num_trials]
+    return trials
+
+def main(config):
+    trials = get_trials(config)
+    print('#trials = {}'.format(len(trials)))
+
+    model, sess = build_tracking_model(config)
+
+    video_dirs = get_video_dirs(config)
+    seq_names = [os.path.basename(x) for x in video_dirs]
+
+    # Sequence-major order so that cached embeddings of a sequence are shared by all trials
+    start_time = time.time()
+    for video_dir in video_dirs:
+        video_name = os.path.basename(video_dir)
+        filenames, init_bb = load_sequence(video_dir)
+        if model.feature_cache is not None:
+            model.feature_cache.clear()
+
+        for trial in trials:
+            video_log_dir = os.path.join(config.log_dir, trial.param_str, video_name)
+            result_file = os.path.join(video_log_dir, 'track_rect.txt')
+            if os.path.exists(result_file) and not config.overwrite:
+                continue
+            mkdir_p(video_log_dir)
+            model.config = trial
+            tracker = Tracker(model, config=trial)
+            trajectory = tracker.track(sess, init_bb, filenames, video_log_dir, write_summary=False)
+            write_trajectory(result_file, trajectory)
+        print('[{}] done {} trials (elapsed {:.1f} sec)'.format(video_name, len(trials), time.time()-start_time))
+        if model.feature_cache is not None:
+            model.feature_cache.print_stats()
+    model.config = config
+
+    # Score every trial
+    scores = []
+    for trial in trials:
+        trial_log_dir = os.path.join(config.log_dir, trial.param_str)
+        per_seq, overall = evaluate_otb.evaluate_run(trial_log_dir, config.root_dir, seq_names)
+        evaluate_otb.dump_results(os.path.join(trial_log_dir, 'otb_eval.json'), per_seq, overall)
+        params = OrderedDict([(name, getattr(trial, name)) for name in SWEEP_PARAMS])
+        scores.append((overall['auc'], overall['prec'], trial.param_str, params))
+    scores = sorted(scores, key=lambda x: x[0], reverse=True)
+
+    print('===== Ranking (AUC) =====')
+    for auc, prec, param_str, _ in scores[:config.num_show]:
+        print('AUC={:.3f} Prec@{}={:.3f} {}'.format(auc, evaluate_otb.PRECISION_AT, prec, param_str))
+
+    with open(os.path.join(config.log_dir, 'sweep_results.json'), 'w') as f:
+        json.dump([OrderedDict([('auc', auc), ('prec', prec), ('param_str', param_str), ('params', params)])
+                    for auc, prec, param_str, params in scores], f, indent=2)
+
+if __name__ == '__main__':
+
+    from utils.argparse_utils import *
+    parser = get_tracking_parser()
+
+    sweep_arg = add_argument_group('Sweep', parser)
+    for name in SWEEP_PARAMS:
+        sweep_arg.add_argument('--sweep_{}'.format(name), type=str, default='',
+                            help='comma separated values of {} (use --{} if empty)'.format(name, name))
+    sweep_arg.add_argument('--num_trials', type=int, default=0,
+                            help='evaluate randomly chosen num_trials combinations (grid search if 0)')
+    sweep_arg.add_argument('--sweep_seed', type=int, default=0,
+                            help='random seed to choose trials')
+    sweep_arg.add_argument('--overwrite', type=str2bool, default=False,
+                            help='re-run trials whose results already exist')
+    sweep_arg.add_argument('--num_show', type=int, default=20,
+                            help='the number of top trials to print')
+    parser.set_defaults(feature_cache_size=1000) # trials share crops of the first frames
+
+    tmp_config, unparsed = get_config(parser)
+    config = tmp_config
+
+    if len(unparsed) > 0:
+        raise ValueError('Warning: miss identify argument ?? unparsed={}\n'.format(unparsed))
+
+    config.log_level = 0 # no image dump during sweep
+
+    main(config)
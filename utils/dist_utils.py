@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""Synchronous data-parallel training with parameter servers (between-graph replication).
+
+Every task runs the same trainer with --job_name/--task_index/--ps_hosts/--worker_hosts
+(see run_distributed.py). The variables are placed on the ps tasks, every worker
+builds its own graph and reads a disjoint shard of the training index. The
+gradients of all workers are averaged by SyncReplicasOptimizer, so global_step
+advances once per update of all the workers (effective batch size:
+batch_size * #workers). Worker 0 is the chief: it initializes and restores the
+variables and is the only task writing checkpoints, summaries and metrics.
+Without --job_name the trainers run in a single process as before.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+import tensorflow as tf
+
+def parse_hosts(text):
+    # 'localhost:2222,localhost:2223' --> ['localhost:2222', 'localhost:2223']
+    return [host.strip() for host in text.split(',') if len(host.strip()) > 0]
+
+class DistributedContext(object):
+    def __init__(self, config, session_config=None):
+        self.job_name = getattr(config, 'job_name', '')
+        self.task_index = getattr(config, 'task_index', 0)
+        self.enabled = len(self.job_name) > 0
+        self.sync_optim = None
+        self.ready_flag = None
+        self.server = None
+
+        if not self.enabled:
+            self.num_workers = 1
+            self.worker_index = 0
+            self.is_chief = True
+            return
+
+        ps_hosts = parse_hosts(config.ps_hosts)
+        worker_hosts = parse_hosts(config.worker_hosts)
+        if self.job_name not in ('ps', 'worker'):
+            raise ValueError('Unknown job_name: {} (ps|worker)'.format(self.job_name))
+        if len(ps_hosts) == 0 or len(worker_hosts) == 0:
+            raise ValueError('--ps_hosts and --worker_hosts are required with --job_name')
+        self.num_workers = len(worker_hosts)
+        self.worker_index = self.task_index if self.job_name == 'worker' else 0
+        self.is_chief = (self.job_name == 'worker' and self.task_index == 0)
+        self.cluster = tf.train.ClusterSpec({'ps': ps_hosts, 'worker': worker_hosts})
+        self.server = tf.train.Server(self.cluster, job_name=self.job_name, task_index=self.task_index,
+                                      config=session_config)
+        print('[Distributed] {}:{} of {} ps / {} workers{}'.format(self.job_name, self.task_index,
+                    len(ps_hosts), self.num_workers, ' (chief)' if self.is_chief else ''))
+
+    def join_if_ps(self):
+        # parameter servers only serve the variables, the process is terminated by the launcher
+        if self.enabled and self.job_name == 'ps':
+            self.server.join()
+
+    def device(self):
+        if not self.enabled:
+            return tf.device(None) # no-op at the top level
+        return tf.device(tf.train.replica_device_setter(
+                    worker_device='/job:worker/task:{}'.format(self.task_index), cluster=self.cluster))
+
+    def local_device(self):
+        # device of the variables private to this worker (None without --job_name), see initialize()
+        if not self.enabled:
+            return None
+        return '/job:worker/task:{}'.format(self.task_index)
+
+    def wrap_optimizer(self, optim):
+        # use as get_optimizer(..., wrap_optimizer=dist.wrap_optimizer)
+        if not self.enabled:
+            return optim
+        self.sync_optim = tf.train.SyncReplicasOptimizer(optim, replicas_to_aggregate=self.num_workers,
+                                                         total_num_replicas=self.num_workers)
+        return self.sync_optim
+
+    def get_updated_step(self, minimize_op, global_step):
+        """global_step read after minimize_op, to be fetched with it (None without --job_name).
+
+        SyncReplicasOptimizer drops stale gradients, so global_step can lag behind
+        the number of updates run by a worker and is not counted in python.
+        """
+        if not self.enabled:
+            return None
+        with tf.control_dependencies([minimize_op]):
+            return tf.identity(global_step.read_value())
+
+    def create_session(self, session_config):
+        if not self.enabled:
+            return tf.Session(config=session_config)
+        # only see the parameter servers and this worker
+        session_config.device_filters.extend(['/job:ps', '/job:worker/task:{}'.format(self.task_index)])
+        return tf.Session(self.server.target, config=session_config)
+
+    def initialize(self, sess, poll_interval=1.0):
+        """Initialize the variables (chief) or wait until the chief has initialized and restored them (workers).
+
+        The workers are released by start() of the chief, after it restored the
+        pretrained or latest checkpoint.
+        """
+        if not self.enabled:
+            sess.run(tf.global_variables_initializer())
+            return
+        with tf.device('/job:ps/task:0'):
+            # shared by all the workers (same name and device), initialized by the chief in start()
+            self.ready_flag = tf.Variable(True, trainable=False, name='chief_ready',
+                                          collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        local_vars = [v for v in tf.local_variables() if v is not self.ready_flag]
+        if self.is_chief:
+            sess.run(tf.global_variables_initializer())
+            sess.run(tf.variables_initializer(local_vars))
+            return
+
+        report_op = tf.report_uninitialized_variables(tf.global_variables() + [self.ready_flag])
+        while len(sess.run(report_op)) > 0:
+            print('Wait for the chief to initialize the variables...')
+            time.sleep(poll_interval)
+        sess.run(tf.variables_initializer(local_vars))
+        if self.sync_optim is not None:
+            sess.run(self.sync_optim.local_step_init_op)
+
+    def start(self, sess):
+        # chief: release the workers and start the queue runner aggregating the gradients
+        if not self.enabled or not self.is_chief:
+            return
+        init_tokens_op = self.sync_optim.get_init_tokens_op() if self.sync_optim is not None else None
+        sess.run(self.ready_flag.initializer)
+        if self.sync_optim is not None:
+            sess.run(self.sync_optim.chief_init_op)
+            sess.run(init_tokens_op)
+            queue_runner = self.sync_optim.get_chief_queue_runner()
+            queue_runner.create_threads(sess, daemon=True, start=True)
+
+def add_distributed_arguments(parser):
+    from utils.argparse_utils import add_argument_group
+    dist_arg = add_argument_group('Distributed', parser)
+    dist_arg.add_argument('--job_name', type=str, default='',
+                            help='ps|worker (single process training if empty), set by run_distributed.py')
+    dist_arg.add_argument('--task_index', type=int, default=0,
+                            help='index of the task in its job, worker 0 is the chief')
+    dist_arg.add_argument('--ps_hosts', type=str, default='',
+                            help='comma separated host:port of the parameter servers')
+    dist_arg.add_argument('--worker_hosts', type=str, default='',
+                            help='comma separated host:port of the workers')
+    return dist_arg
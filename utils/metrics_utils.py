@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Append-only JSON-lines metrics of training runs.
+
+Every trainer writes log_dir/metrics.jsonl, one line per report:
+    {"step": 500, "phase": "valid", "time": 1531234567.8, "loss_ev": 0.12, ...}
+Reading a few KB of text is much cheaper than parsing TF event files, so many
+runs can be compared at once (see query_metrics.py).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import time
+from collections import OrderedDict, deque
+
+METRICS_FILE = 'metrics.jsonl'
+
+class MetricsLogger(object):
+    def __init__(self, log_dir, filename=METRICS_FILE):
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        self.filename = os.path.join(log_dir, filename)
+        self.f = open(self.filename, 'a')
+
+    def log(self, step, phase, **metrics):
+        record = OrderedDict([('step', int(step)), ('phase', phase), ('time', time.time())])
+        for key, value in metrics.items():
+            record[key] = float(value)
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush() # one line per write, readers never see a partial record except the last one
+
+    def close(self):
+        self.f.close()
+
+class StepTimer(object):
+    """Rolling throughput of the training loop.
+
+    Every step is timed with tic/toc around its sess.run. Profiled steps (see
+    tf_train_utils.run_profiled_step) split the step into the time waiting for
+    the input pipeline and the compute time, the input-bound ratio is the
+    fraction of profiled time spent waiting for input.
+    """
+    def __init__(self, batch_size, window=100):
+        self.batch_size = batch_size
+        self.step_times = deque(maxlen=window)
+        self.input_times = deque(maxlen=window)
+        self.compute_times = deque(maxlen=window)
+        self.start_time = None
+
+    def tic(self):
+        self.start_time = time.time()
+
+    def toc(self):
+        self.step_times.append(time.time() - self.start_time)
+
+    def add_profile(self, input_time, compute_time):
+        self.input_times.append(input_time)
+        self.compute_times.append(compute_time)
+        self.step_times.append(input_time + compute_time)
+
+    def sec_per_step(self):
+        if len(self.step_times) == 0:
+            return float('nan')
+        return sum(self.step_times) / len(self.step_times)
+
+    def examples_per_sec(self):
+        return self.batch_size / self.sec_per_step()
+
+    def input_bound_ratio(self):
+        total = sum(self.input_times) + sum(self.compute_times)
+        if total == 0:
+            return float('nan')
+        return sum(self.input_times) / total
+
+    def get_stats(self):
+        return OrderedDict([
+            ('sec_per_step', self.sec_per_step()),
+            ('examples_per_sec', self.examples_per_sec()),
+            ('input_bound_ratio', self.input_bound_ratio()),
+        ])
+
+def read_metrics(path, phase=None):
+    """Read records of a run (log_dir or metrics file). A truncated last line is ignored."""
+    if os.path.isdir(path):
+        path = os.path.join(path, METRICS_FILE)
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # being written
+            if phase is None or record.get('phase') == phase:
+                records.append(record)
+    return records
+
+def read_metric_history(path, metric, phase='valid'):
+    # Return: [(step, value)] of a metric
+    return [(r['step'], r[metric]) for r in read_metrics(path, phase) if metric in r]
+
+def summarize_runs(log_dirs, metrics, phase='valid', agg='last'):
+    """Aggregate metrics of many runs into rows (one OrderedDict per run).
+
+    agg: last|min|max, how to reduce the history of each metric
+    """
+    reduce_fn = {
+        'last': lambda values: values[-1],
+        'min': min,
+        'max': max,
+    }[agg]
+    rows = []
+    for log_dir in log_dirs:
+        records = read_metrics(log_dir, phase)
+        if len(records) == 0:
+            continue
+        row = OrderedDict([('run', log_dir), ('step', records[-1]['step'])])
+        for metric in metrics:
+            values = [r[metric] for r in records if metric in r]
+            row[metric] = reduce_fn(values) if len(values) > 0 else float('nan')
+        rows.append(row)
+    return rows
+
+def to_dataframe(rows):
+    import pandas as pd
+    return pd.DataFrame(rows)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Reduced precision (float16/bfloat16) compute for the backbones.
+
+Only the backbone runs in the compute dtype. Variables are stored in float32
+and cast when they are read (the optimizer updates the float32 copy), batch
+norm runs in float32, and the endpoints are cast back to float32 so that the
+loss and the CF solve in the frequency domain stay in float32.
+
+float16 training needs loss scaling to keep small gradients from flushing to
+zero, bfloat16 has the float32 exponent range and does not.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+slim = tf.contrib.slim
+
+PRECISIONS = {
+    'fp32': tf.float32,
+    'fp16': tf.float16,
+    'bf16': tf.bfloat16,
+}
+DEFAULT_LOSS_SCALE = 128.0 # static loss scale for fp16
+
+def get_compute_dtype(precision):
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision: {} ({})'.format(precision, '|'.join(sorted(PRECISIONS.keys()))))
+    return PRECISIONS[precision]
+
+def get_loss_scale(precision, loss_scale=0):
+    # loss_scale <= 0 means automatic: DEFAULT_LOSS_SCALE for fp16, otherwise 1
+    if loss_scale > 0:
+        return float(loss_scale)
+    return DEFAULT_LOSS_SCALE if precision == 'fp16' else 1.0
+
+def float32_storage_getter(getter, name, shape=None, dtype=None, *args, **kwargs):
+    # custom getter: create reduced precision variables in float32 and cast them on read
+    if dtype in (tf.float16, tf.bfloat16):
+        var = getter(name, shape, tf.float32, *args, **kwargs)
+        return tf.cast(var, dtype, name=name.split('/')[-1] + '_cast')
+    return getter(name, shape, dtype, *args, **kwargs)
+
+def batch_norm(inputs, *args, **kwargs):
+    """slim.batch_norm computed in float32 (parameters and moving statistics stay float32).
+
+    arg_scope of slim.batch_norm still applies, use it as normalizer_fn in the models.
+    """
+    if inputs.dtype.base_dtype == tf.float32:
+        return slim.batch_norm(inputs, *args, **kwargs)
+    outputs = slim.batch_norm(tf.cast(inputs, tf.float32), *args, **kwargs)
+    return tf.cast(outputs, inputs.dtype.base_dtype)
+
+def call_backbone(backbone, inputs, precision='fp32', **kwargs):
+    """Run backbone(inputs, **kwargs) in the compute dtype of precision.
+
+    Return: (net, endpoints) in float32, as returned by the backbone for fp32
+    """
+    dtype = get_compute_dtype(precision)
+    if dtype == tf.float32:
+        return backbone(inputs, **kwargs)
+
+    with tf.variable_scope(tf.get_variable_scope(), custom_getter=float32_storage_getter):
+        net, endpoints = backbone(tf.cast(inputs, dtype), **kwargs)
+
+    def to_float32(x):
+        if isinstance(x, tf.Tensor) and x.dtype.base_dtype == dtype:
+            return tf.cast(x, tf.float32)
+        return x
+    endpoints = dict([(k, to_float32(v)) for k, v in endpoints.items()])
+    return to_float32(net), endpoints
+
+def add_precision_arguments(parser, training=True):
+    from utils.argparse_utils import add_argument_group
+    precision_arg = add_argument_group('Precision', parser)
+    precision_arg.add_argument('--precision', type=str, default='fp32',
+                            help='compute dtype of the backbone: fp32|fp16|bf16 (variables, batch norm, loss and CF stay fp32)')
+    if training:
+        precision_arg.add_argument('--loss_scale', type=float, default=0,
+                            help='static loss scale (auto if 0: {:g} for fp16, 1 otherwise)'.format(DEFAULT_LOSS_SCALE))
+    return precision_arg
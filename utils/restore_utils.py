@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""Partial restore of checkpoints.
+
+Only the tensors of the variables in the current graph are read from the
+checkpoint (the variable map of a checkpoint index is read once and cached),
+optionally by several threads. The restored subset can be saved as a slimmed
+checkpoint, so that the next workers with the same backbone/feat_layer read a
+few MB instead of the full classification checkpoint.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import re
+import glob
+import time
+import shutil
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+import tensorflow as tf
+
+_variable_maps = {} # checkpoint -> {name: shape}
+
+def get_checkpoint_hash(checkpoint, extra=''):
+    """Identify a checkpoint by the path, size and mtime of its files (+ extra model settings)"""
+    h = hashlib.sha1()
+    h.update(os.path.abspath(checkpoint).encode('utf-8'))
+    for filename in sorted(glob.glob(checkpoint + '.*')):
+        stat = os.stat(filename)
+        h.update('{}:{}:{}'.format(os.path.basename(filename), stat.st_size, int(stat.st_mtime)).encode('utf-8'))
+    h.update(extra.encode('utf-8'))
+    return h.hexdigest()[:16]
+
+def get_checkpoint_path(model):
+    # directory (latest checkpoint) or checkpoint prefix
+    if os.path.isdir(model):
+        return tf.train.latest_checkpoint(model)
+    return model
+
+def get_variable_map(checkpoint):
+    if checkpoint not in _variable_maps:
+        reader = tf.train.NewCheckpointReader(checkpoint)
+        _variable_maps[checkpoint] = reader.get_variable_to_shape_map()
+    return _variable_maps[checkpoint]
+
+def match_variables(var_list, checkpoint):
+    """Match graph variables with checkpoint tensors by name and shape.
+
+    var_list: list of variables, or dict {checkpoint name: variable}
+    Return: ({checkpoint name: variable}, [names which are not restored])
+    """
+    if not isinstance(var_list, dict):
+        var_list = dict([(var.op.name, var) for var in var_list])
+    shape_map = get_variable_map(checkpoint)
+    var_map = {}
+    skipped = []
+    for name, var in var_list.items():
+        if name in shape_map and list(shape_map[name]) == var.get_shape().as_list():
+            var_map[name] = var
+        else:
+            skipped.append(name)
+    return var_map, sorted(skipped)
+
+def restore_variables(sess, var_list, checkpoint, num_threads=4, verbose=True, strict=False):
+    """Read only the tensors of var_list from checkpoint and load them into the variables.
+
+    strict: raise ValueError if some variables are not in the checkpoint or have
+            different shapes (otherwise they are skipped with a warning)
+    Return: ({checkpoint name: variable} of restored variables, [skipped names])
+    """
+    start_time = time.time()
+    var_map, skipped = match_variables(var_list, checkpoint)
+    if strict and len(skipped) > 0:
+        raise ValueError('{} variables are not in {} or have different shapes: {}{}'.format(
+                len(skipped), checkpoint, ', '.join(skipped[:5]), ' ...' if len(skipped) > 5 else ''))
+    names = sorted(var_map.keys())
+
+    local = threading.local() # readers are not shared between threads
+    def read_tensor(name):
+        if not hasattr(local, 'reader'):
+            local.reader = tf.train.NewCheckpointReader(checkpoint)
+        return local.reader.get_tensor(name)
+
+    if num_threads > 1 and len(names) > 1:
+        pool = ThreadPool(min(num_threads, len(names)))
+        values = pool.map(read_tensor, names)
+        pool.close()
+    else:
+        values = [read_tensor(name) for name in names]
+
+    num_bytes = 0
+    for name, value in zip(names, values):
+        var_map[name].load(value, sess)
+        num_bytes += value.nbytes
+
+    if verbose:
+        print('Restore {} variables ({:.1f} MB) from {} ({:.1f} sec)'.format(
+                len(names), num_bytes / 2**20, checkpoint, time.time()-start_time))
+        if len(skipped) > 0:
+            print('[Warning] {} variables are not in the checkpoint or have different shapes: {}{}'.format(
+                    len(skipped), ', '.join(skipped[:5]), ' ...' if len(skipped) > 5 else ''))
+    return var_map, skipped
+
+def restore_with_cache(sess, var_list, checkpoint, cache_dir='', cache_key='', num_threads=4):
+    """restore_variables through a slimmed checkpoint cached under cache_dir.
+
+    cache_key names the subset of variables (e.g. backbone and feat_layer), the
+    cached checkpoint is reused as long as the original checkpoint is unchanged.
+    """
+    if len(cache_dir) == 0:
+        return restore_variables(sess, var_list, checkpoint, num_threads=num_threads)
+
+    slim_dir = os.path.join(cache_dir, '{}-{}'.format(re.sub(r'[^\w.-]+', '_', cache_key),
+                                                      get_checkpoint_hash(checkpoint)))
+    slim_checkpoint = os.path.join(slim_dir, 'model.ckpt')
+    if tf.train.checkpoint_exists(slim_checkpoint):
+        return restore_variables(sess, var_list, slim_checkpoint, num_threads=num_threads)
+
+    var_map, skipped = restore_variables(sess, var_list, checkpoint, num_threads=num_threads)
+    # write into a temporary directory and rename it, concurrent workers never see a partial checkpoint
+    tmp_dir = '{}.tmp{}'.format(slim_dir, os.getpid())
+    os.makedirs(tmp_dir)
+    tf.train.Saver(var_map).save(sess, os.path.join(tmp_dir, 'model.ckpt'), write_meta_graph=False, write_state=False)
+    try:
+        os.rename(tmp_dir, slim_dir)
+        print('Save slimmed checkpoint to {}'.format(slim_checkpoint))
+    except OSError: # written by another worker
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return var_map, skipped
+
+def add_restore_arguments(parser, training=True):
+    from utils.argparse_utils import add_argument_group
+    restore_arg = add_argument_group('Restore', parser)
+    restore_arg.add_argument('--restore_threads', type=int, default=4,
+                            help='threads reading checkpoint tensors')
+    if training:
+        # only for the pretrained backbone, trained models change at every save
+        restore_arg.add_argument('--restore_cache_dir', type=str, default='',
+                            help='cache slimmed checkpoints of the pretrained backbone (only the restored variables) here (disable if empty)')
+    return restore_arg
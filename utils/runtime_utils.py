@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Session threading and CPU placement.
+
+Thread counts default to 0 (auto) and are derived from the CPUs this process
+may actually use (cgroup quota and affinity mask), so that the input pipeline
+threads (--num_threads) and the compute threads do not oversubscribe the cores
+of shared CPU nodes.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import math
+
+import tensorflow as tf
+
+def _read_first_line(filename):
+    try:
+        with open(filename, 'r') as f:
+            return f.readline().strip()
+    except (IOError, OSError):
+        return None
+
+def get_cgroup_cpu_limit():
+    # Return: CPU quota of the cgroup (float) or None if unlimited
+    # cgroup v2
+    line = _read_first_line('/sys/fs/cgroup/cpu.max')
+    if line is not None:
+        quota, period = (line.split() + ['100000'])[:2]
+        if quota != 'max' and int(period) > 0:
+            return int(quota) / int(period)
+        return None
+    # cgroup v1
+    quota = _read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = _read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota is not None and period is not None and int(quota) > 0 and int(period) > 0:
+        return int(quota) / int(period)
+    return None
+
+def get_num_cpus():
+    """The number of CPUs available to this process (affinity mask and cgroup quota)"""
+    if hasattr(os, 'sched_getaffinity'):
+        num_cpus = len(os.sched_getaffinity(0))
+    else:
+        num_cpus = os.cpu_count() or 1
+    limit = get_cgroup_cpu_limit()
+    if limit is not None:
+        num_cpus = min(num_cpus, max(1, int(math.ceil(limit))))
+    return num_cpus
+
+def parse_cpu_list(text):
+    # '0-3,8' --> [0,1,2,3,8]
+    cpus = []
+    for token in text.split(','):
+        token = token.strip()
+        if len(token) == 0:
+            continue
+        if '-' in token:
+            start, end = token.split('-')
+            cpus.extend(range(int(start), int(end)+1))
+        else:
+            cpus.append(int(token))
+    return cpus
+
+def add_runtime_arguments(parser):
+    from utils.argparse_utils import add_argument_group
+    runtime_arg = add_argument_group('Runtime', parser)
+    runtime_arg.add_argument('--intra_op_threads', type=int, default=0,
+                            help='threads used inside one op (auto if 0)')
+    runtime_arg.add_argument('--inter_op_threads', type=int, default=0,
+                            help='ops executed in parallel (auto if 0)')
+    runtime_arg.add_argument('--dataset_private_threads', type=int, default=0,
+                            help='run the input pipeline on its own threadpool of this size (share the compute pool if 0)')
+    runtime_arg.add_argument('--cpu_affinity', type=str, default='',
+                            help='pin the process to these CPUs, e.g. 0-7,16 (no change if empty)')
+    return runtime_arg
+
+def setup_runtime(config, num_input_threads=0):
+    """Apply CPU pinning and resolve automatic thread counts (written back to config).
+
+    Args:
+        num_input_threads: threads reserved for the input pipeline (num_parallel_calls)
+    """
+    cpu_affinity = getattr(config, 'cpu_affinity', '')
+    if len(cpu_affinity) > 0 and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, parse_cpu_list(cpu_affinity))
+
+    num_cpus = get_num_cpus()
+    num_input_threads = min(num_input_threads, num_cpus)
+    if getattr(config, 'intra_op_threads', 0) <= 0:
+        config.intra_op_threads = max(1, num_cpus - num_input_threads)
+    if getattr(config, 'inter_op_threads', 0) <= 0:
+        config.inter_op_threads = min(2, num_cpus)
+    print('[Runtime] #cpus={} intra_op={} inter_op={} input={}'.format(
+            num_cpus, config.intra_op_threads, config.inter_op_threads, num_input_threads))
+    return config
+
+def get_session_config(config=None):
+    tfconfig = tf.ConfigProto()
+    tfconfig.gpu_options.allow_growth = True # almost the same as tf.InteractiveSession
+    if config is not None:
+        tfconfig.intra_op_parallelism_threads = getattr(config, 'intra_op_threads', 0)
+        tfconfig.inter_op_parallelism_threads = getattr(config, 'inter_op_threads', 0)
+    return tfconfig
+
+def apply_dataset_threading(dataset, num_threads):
+    """Run the dataset on a private threadpool (needs tf.data.Options, ignored on older TF)"""
+    if num_threads <= 0:
+        return dataset
+    if not hasattr(tf.data, 'Options'):
+        print('[Warning] tf.data.Options is not available, dataset_private_threads is ignored')
+        return dataset
+    options = tf.data.Options()
+    options.experimental_threading.private_threadpool_size = num_threads
+    options.experimental_threading.max_intra_op_parallelism = 1
+    return dataset.with_options(options)
@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import re
+import time
 import numpy as np
 import tensorflow as tf
 
-def get_optimizer(method, global_step, learning_rate, loss, var_list, max_grad_norm=None, show_var_and_grad=False, verbose=True):
+def get_optimizer(method, global_step, learning_rate, loss, var_list, max_grad_norm=None, show_var_and_grad=False, verbose=True, loss_scale=1.0,
+                  checkpoints=None, accum_steps=1, wrap_optimizer=None, accum_device=None):
+    # loss_scale: gradients are computed from loss*loss_scale and divided back (for float16 backbones)
+    # checkpoints: recompute the activations between these tensors in the backward pass (see recompute_gradients)
+    # accum_steps: update with the mean gradients of accum_steps micro-batches,
+    #              return (accum_op, minimize_op) instead of minimize_op, see accumulate_gradients
+    # wrap_optimizer: optional function wrapping the optimizer (e.g. dist_utils.DistributedContext.wrap_optimizer)
+    # accum_device: keep the accumulators as local variables on this device (e.g. dist_utils.DistributedContext.local_device())
     method = method.lower()
     if method == 'adam':
         optim = tf.train.AdamOptimizer(learning_rate)
@@ -15,6 +24,8 @@ def get_optimizer(method, global_step, learning_rate, loss, var_list, max_grad_n
         optim = tf.train.RMSPropOptimizer(learning_rate)
     else:
         raise Exception('Invalid optimizer method: {}'.format(method))
+    if wrap_optimizer is not None:
+        optim = wrap_optimizer(optim)
 
     if verbose:
         print('========== get_optimizer ({}) =========='.format(method))
@@ -23,7 +34,9 @@ def get_optimizer(method, global_step, learning_rate, loss, var_list, max_grad_n
     with tf.variable_scope('Optimization') as sc:
         # gradient clipping
         if max_grad_norm is not None:
-            grads_and_vars = optim.compute_gradients(loss, var_list)
+            grads_and_vars = compute_scaled_gradients(optim, loss, var_list, loss_scale, checkpoints)
+            if accum_steps > 1:
+                accum_op, grads_and_vars, accumulators = accumulate_gradients(grads_and_vars, accum_steps, accum_device)
             new_grads_and_vars = []
             for idx, (grad, var) in enumerate(grads_and_vars):
                 if grad is not None and var in var_list:
@@ -43,7 +56,9 @@ def get_optimizer(method, global_step, learning_rate, loss, var_list, max_grad_n
                 minimize_op = optim.apply_gradients(
                     new_grads_and_vars, global_step=global_step)
         else:
-            grads_and_vars = optim.compute_gradients(loss, var_list)
+            grads_and_vars = compute_scaled_gradients(optim, loss, var_list, loss_scale, checkpoints)
+            if accum_steps > 1:
+                accum_op, grads_and_vars, accumulators = accumulate_gradients(grads_and_vars, accum_steps, accum_device)
 
             for g, v in grads_and_vars:
                 if verbose:
@@ -55,15 +70,164 @@ def get_optimizer(method, global_step, learning_rate, loss, var_list, max_grad_n
             # tf Batch norm requires update_ops to be added as a train_op dependency.
             update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
             with tf.control_dependencies(update_ops):
-                minimize_op = optim.minimize(
-                    loss, var_list=var_list, global_step=global_step)
+                if loss_scale == 1.0 and not checkpoints and accum_steps == 1:
+                    minimize_op = optim.minimize(
+                        loss, var_list=var_list, global_step=global_step)
+                else:
+                    minimize_op = optim.apply_gradients(
+                        grads_and_vars, global_step=global_step)
 
         if verbose:
             print('=======================================')
     
+        if accum_steps > 1:
+            return accum_op, reset_after(minimize_op, accumulators)
         return minimize_op
 
-def get_custom_optimizer(method, global_step, learning_rate, loss, var_list, max_grad_norm=None, check_numerics=False, verbose=True, show_summary=False):
+def accumulate_gradients(grads_and_vars, accum_steps, accum_device=None):
+    """Sum gradients of micro-batches into non-trainable accumulators.
+
+    accum_op adds the gradients of the current micro-batch and is run for the
+    first accum_steps-1 micro-batches, the returned gradients are the mean over
+    the accumulated and the current (last) micro-batch.
+    With accum_device (distributed training) the accumulators are local variables
+    on that device, otherwise every worker would add into the same variables on
+    the ps.
+    Return: (accum_op, grads_and_vars, accumulators to be reset after the update)
+    """
+    accum_ops = []
+    mean_grads_and_vars = []
+    accumulators = []
+    for grad, var in grads_and_vars:
+        if grad is None:
+            mean_grads_and_vars.append((grad, var))
+            continue
+        grad = tf.convert_to_tensor(grad)
+        with tf.control_dependencies(None): # the initializer must not depend on update_ops
+            if accum_device is None:
+                accum = tf.Variable(tf.zeros(var.get_shape(), dtype=grad.dtype), trainable=False,
+                                    name=var.op.name + '/accum')
+            else:
+                with tf.device(accum_device):
+                    accum = tf.Variable(tf.zeros(var.get_shape(), dtype=grad.dtype), trainable=False,
+                                        name=var.op.name + '/accum', collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        accum_ops.append(tf.assign_add(accum, grad))
+        mean_grads_and_vars.append(((accum + grad) / accum_steps, var))
+        accumulators.append(accum)
+
+    # batch norm statistics are updated on every micro-batch
+    update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+    with tf.control_dependencies(update_ops):
+        accum_op = tf.group(*accum_ops, name='accum_op')
+    return accum_op, mean_grads_and_vars, accumulators
+
+def reset_after(minimize_op, accumulators):
+    with tf.control_dependencies([minimize_op]):
+        return tf.group(*[accum.assign(tf.zeros_like(accum)) for accum in accumulators], name='minimize_op')
+
+def compute_scaled_gradients(optim, loss, var_list, loss_scale=1.0, checkpoints=None):
+    if loss_scale != 1.0:
+        loss = loss * loss_scale
+    if checkpoints:
+        grads_and_vars = list(zip(recompute_gradients(loss, var_list, checkpoints), var_list))
+    else:
+        grads_and_vars = optim.compute_gradients(loss, var_list)
+    if loss_scale == 1.0:
+        return grads_and_vars
+    return [(g / loss_scale if g is not None else None, v) for g, v in grads_and_vars]
+
+# block boundaries of the backbones (endpoint names), used as checkpoints of recompute_gradients
+BLOCK_ENDPOINT_PATTERNS = [
+    r'/pool\d+$', # vgg/alexnet conv blocks
+    r'/block\d+/unit_\d+/bottleneck_v2$', # resnet units
+    r'layer_\d+/output$', # mobilenet inverted residual blocks
+]
+
+def get_block_checkpoints(endpoints, extra_tensors=()):
+    """Block boundary tensors of backbone endpoints (+ extra_tensors, e.g. the feature maps read by the head)"""
+    checkpoints = [v for k, v in endpoints.items()
+                    if isinstance(v, tf.Tensor) and any(re.search(p, k) for p in BLOCK_ENDPOINT_PATTERNS)]
+    return checkpoints + list(extra_tensors)
+
+def _sum_gradients(grads):
+    grads = [g for g in grads if g is not None]
+    if len(grads) == 0:
+        return None
+    if len(grads) == 1:
+        return grads[0]
+    return tf.add_n([tf.convert_to_tensor(g) for g in grads])
+
+def recompute_gradients(loss, var_list, checkpoints):
+    """Gradients of loss w.r.t. var_list, keeping only the checkpoint activations for the backward pass.
+
+    The network between consecutive checkpoints (a segment) is copied and the
+    copy is run during the backward pass, right before the gradient of the
+    segment is needed, so that the original activations inside the segment can
+    be freed after the forward pass. It costs one more forward pass of the
+    backbone. The head after the last checkpoints (CF, loss) is not recomputed,
+    it may contain control flow which cannot be copied.
+    Only ops depending on the variables are copied, so random ops (dropout) and
+    the input pipeline are not run again.
+    Return: list of gradients (or None) in the order of var_list
+    """
+    ge = tf.contrib.graph_editor
+    xs = [v.value() for v in var_list] # read tensors of the variables
+    unique = dict([(t.name, t) for t in checkpoints])
+    # ops are numbered in creation order, which is a topological order
+    checkpoints = sorted(unique.values(), key=lambda t: t.op._id)
+    stop_ts = checkpoints + xs
+    fwd_ops = set(ge.get_forward_walk_ops([x.op for x in xs], inclusive=True))
+
+    def used_by(t, ops):
+        return any(op in ops for op in t.consumers())
+
+    # head: plain gradients through the original ops
+    head_ops = set(ge.get_backward_walk_ops([loss.op], inclusive=True, stop_at_ts=stop_ts))
+    frontier = [t for t in checkpoints if used_by(t, head_ops)]
+    head_xs = [x for x in xs if used_by(x, head_ops)]
+    frontier_ops = set([t.op for t in frontier])
+    if len(frontier_ops & set(ge.get_forward_walk_ops(list(frontier_ops), inclusive=False))) > 0:
+        raise ValueError('The head reads checkpoints which depend on each other, drop the earlier ones: {}'.format(
+                            [t.name for t in frontier]))
+    grads = tf.gradients(loss, frontier + head_xs)
+    ckpt_grads = dict([(t, [g]) for t, g in zip(frontier, grads[:len(frontier)])])
+    var_grads = dict([(x, [g]) for x, g in zip(head_xs, grads[len(frontier):])])
+
+    disconnected = dict([(t, tf.stop_gradient(t)) for t in checkpoints])
+    segment_xs = set()
+    for ckpt in reversed(checkpoints):
+        grad_ys = _sum_gradients(ckpt_grads.get(ckpt, []))
+        if grad_ys is None:
+            continue # does not affect the loss
+        ops = ge.get_backward_walk_ops([ckpt.op], inclusive=True, within_ops=fwd_ops,
+                                       stop_at_ts=[t for t in stop_ts if t is not ckpt])
+        if len(ops) == 0:
+            continue # does not depend on the variables
+        inputs = [t for t in checkpoints if t is not ckpt and used_by(t, ops)]
+        seg_xs = [x for x in xs if used_by(x, ops)]
+        segment_xs.update(seg_xs)
+
+        _, info = ge.copy_with_input_replacements(ge.sgv(ops), dict([(t, disconnected[t]) for t in inputs]))
+        copied_ops = [info.transformed(op) for op in ops]
+        copied_set = set(copied_ops)
+        # run the copy only after the gradient of its output is available
+        for op in copied_ops:
+            if all(t.op not in copied_set for t in op.inputs):
+                ge.add_control_inputs(op, [grad_ys.op])
+
+        grads = tf.gradients(info.transformed(ckpt), [disconnected[t] for t in inputs] + seg_xs, grad_ys=grad_ys)
+        for t, g in zip(inputs, grads[:len(inputs)]):
+            ckpt_grads.setdefault(t, []).append(g)
+        for x, g in zip(seg_xs, grads[len(inputs):]):
+            var_grads.setdefault(x, []).append(g)
+
+    if len(segment_xs & set(head_xs)) > 0:
+        raise ValueError('Variables are read both by the head and by the checkpointed segments')
+    return [_sum_gradients(var_grads.get(x, [])) for x in xs]
+
+def get_custom_optimizer(method, global_step, learning_rate, loss, var_list, max_grad_norm=None, check_numerics=False, verbose=True, show_summary=False,
+                         checkpoints=None, accum_steps=1, wrap_optimizer=None, accum_device=None):
+    # see get_optimizer for checkpoints, accum_steps, wrap_optimizer and accum_device
 
     method = method.lower()
     if method == 'adam':
@@ -76,6 +240,8 @@ def get_custom_optimizer(method, global_step, learning_rate, loss, var_list, max
         optim = tf.train.RMSPropOptimizer(learning_rate)
     else:
         raise Exception('Invalid optimizer method: {}'.format(method))
+    if wrap_optimizer is not None:
+        optim = wrap_optimizer(optim)
 
     if verbose:
         print('========== get_optimizer ({}) =========='.format(method))
@@ -85,7 +251,9 @@ def get_custom_optimizer(method, global_step, learning_rate, loss, var_list, max
 
         update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
         with tf.control_dependencies(update_ops):
-            grads_and_vars = optim.compute_gradients(loss, var_list=var_list)
+            grads_and_vars = compute_scaled_gradients(optim, loss, var_list, checkpoints=checkpoints)
+            if accum_steps > 1:
+                accum_op, grads_and_vars, accumulators = accumulate_gradients(grads_and_vars, accum_steps, accum_device)
 
             if max_grad_norm is not None:
                 new_grads_and_vars = []
@@ -120,8 +288,37 @@ def get_custom_optimizer(method, global_step, learning_rate, loss, var_list, max
     if verbose:
         print('=======================================')
 
+    if accum_steps > 1:
+        return accum_op, reset_after(minimize_op, accumulators)
     return minimize_op
 
+def run_accumulation(sess, accum_op, accum_steps, feed_dict):
+    # gradients of the micro-batches before an update (see accumulate_gradients)
+    for _ in range(accum_steps - 1):
+        sess.run(accum_op, feed_dict=feed_dict)
+
+def run_profiled_step(sess, batch_tensors, fetches, feed_dict, accum_op=None, accum_steps=1):
+    """Run a training step in two parts to separate input wait from compute.
+
+    batch_tensors: raw outputs of iterator.get_next(), fetched first and then fed
+    back so that the second run does not touch the iterator.
+    With gradient accumulation, accum_op is run on accum_steps-1 micro-batches
+    before fetches, the times are summed over all the micro-batches.
+    Return: (outputs of fetches, input_time, compute_time)
+    """
+    input_time = compute_time = 0
+    for i in range(accum_steps):
+        start_time = time.time()
+        batch_values = sess.run(batch_tensors, feed_dict=feed_dict)
+        input_time += time.time() - start_time
+
+        step_feed_dict = dict(feed_dict)
+        step_feed_dict.update(zip(batch_tensors, batch_values))
+        start_time = time.time()
+        outs = sess.run(fetches if i == accum_steps - 1 else accum_op, feed_dict=step_feed_dict)
+        compute_time += time.time() - start_time # includes copying the batch back (small compared to the network)
+    return outs, input_time, compute_time
+
 def get_piecewise_lr(global_step, boundaries, lr_values, show_summary=True):
     ''' Piesewise learning rate'''
     # args example: (from https://github.com/tensorflow/models/blob/master/official/resnet/imagenet_main.py)